@@ -1,16 +1,47 @@
 #%%
-import pandas as pd
 import numpy as np
 from torch.utils.data import Dataset, DataLoader
-from sklearn.model_selection import train_test_split
 from collections import Counter
 from torch.utils.data.distributed import DistributedSampler
-from sklearn.decomposition import PCA
-import seaborn as sns
-import matplotlib.pyplot as plt
-import cv2
+
+def render_heatmaps(samples, height=64, width=80):
+    # seaborn, matplotlib and cv2 are only needed here, so they are imported on first use
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    import cv2
+
+    # Initialize an empty array for the heatmaps
+    heatmaps = np.zeros((samples.shape[0], 3, height, width), dtype=np.float32)
+
+    # Generate and resize heatmap for each sample
+    for i, sample in enumerate(samples):
+        # Create a heatmap using seaborn
+        plt.figure(figsize=(1.6, 2))  # Temporary figure size, will be resized later
+        sns.heatmap(sample, cmap='viridis', cbar=False)
+
+        # Save the heatmap to a buffer
+        plt.savefig('heatmap.png', bbox_inches='tight', pad_inches=0)
+        plt.close()  # Close the figure to free memory
+
+        # Read the saved heatmap and resize
+        heatmap_img = cv2.imread('heatmap.png')
+        heatmap_img_resized = cv2.resize(heatmap_img, (width, height), interpolation=cv2.INTER_LINEAR)
+
+        # Normalize the image to have values between 0 and 1
+        heatmap_img_normalized = cv2.normalize(heatmap_img_resized, None, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
+
+        # Rearrange the dimensions from (H, W, C) to (C, H, W) to fit PyTorch's convention
+        heatmap_img_normalized = np.transpose(heatmap_img_normalized, (2, 0, 1))
+
+        # Store the resized heatmap
+        heatmaps[i] = heatmap_img_normalized
+    return heatmaps
 
 def load_data(file_path, batch_size=8, Multi_gpu_flag=False):
+    import pandas as pd
+    from sklearn.model_selection import train_test_split
+    from sklearn.decomposition import PCA
+
     # 1. Read the CSV file with MultiIndex
     print("Loading data...")
     data_dir = file_path
@@ -122,85 +153,10 @@ def load_data(file_path, batch_size=8, Multi_gpu_flag=False):
     X_test = pca.transform(X_test).reshape(-1, 16, 20)
     print(X_train.shape)
     
-    # Initialize an empty array for the heatmaps
-    heatmaps_train = np.zeros((X_train.shape[0], 3, 64, 80), dtype=np.float32)
-
-    # Generate and resize heatmap for each sample
-    for i, sample in enumerate(X_train):
-        # Create a heatmap using seaborn
-        plt.figure(figsize=(1.6, 2))  # Temporary figure size, will be resized later
-        sns.heatmap(sample, cmap='viridis', cbar=False)
-        
-        # Save the heatmap to a buffer
-        plt.savefig('heatmap.png', bbox_inches='tight', pad_inches=0)
-        plt.close()  # Close the figure to free memory
-        
-        # Read the saved heatmap and resize
-        heatmap_img = cv2.imread('heatmap.png')
-        heatmap_img_resized = cv2.resize(heatmap_img, (80, 64), interpolation=cv2.INTER_LINEAR)
-        
-        # Normalize the image to have values between 0 and 1
-        heatmap_img_normalized = cv2.normalize(heatmap_img_resized, None, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-        
-        # Rearrange the dimensions from (H, W, C) to (C, H, W) to fit PyTorch's convention
-        heatmap_img_normalized = np.transpose(heatmap_img_normalized, (2, 0, 1))
-        
-        # Store the resized heatmap
-        heatmaps_train[i] = heatmap_img_normalized
-
+    heatmaps_train = render_heatmaps(X_train)
     print(heatmaps_train.shape)
-
-        # Initialize an empty array for the heatmaps
-    heatmaps_val = np.zeros((X_val.shape[0], 3, 64, 80), dtype=np.float32)
-
-    # Generate and resize heatmap for each sample
-    for i, sample in enumerate(X_val):
-        # Create a heatmap using seaborn
-        plt.figure(figsize=(1.6, 2))  # Temporary figure size, will be resized later
-        sns.heatmap(sample, cmap='viridis', cbar=False)
-        
-        # Save the heatmap to a buffer
-        plt.savefig('heatmap.png', bbox_inches='tight', pad_inches=0)
-        plt.close()  # Close the figure to free memory
-        
-        # Read the saved heatmap and resize
-        heatmap_img = cv2.imread('heatmap.png')
-        heatmap_img_resized = cv2.resize(heatmap_img, (80, 64), interpolation=cv2.INTER_LINEAR)
-        
-        # Normalize the image to have values between 0 and 1
-        heatmap_img_normalized = cv2.normalize(heatmap_img_resized, None, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-        
-        # Rearrange the dimensions from (H, W, C) to (C, H, W) to fit PyTorch's convention
-        heatmap_img_normalized = np.transpose(heatmap_img_normalized, (2, 0, 1))
-        
-        # Store the resized heatmap
-        heatmaps_val[i] = heatmap_img_normalized
-
-        # Initialize an empty array for the heatmaps
-    heatmaps_test = np.zeros((X_test.shape[0], 3, 64, 80), dtype=np.float32)
-
-    # Generate and resize heatmap for each sample
-    for i, sample in enumerate(X_test):
-        # Create a heatmap using seaborn
-        plt.figure(figsize=(1.6, 2))  # Temporary figure size, will be resized later
-        sns.heatmap(sample, cmap='viridis', cbar=False)
-        
-        # Save the heatmap to a buffer
-        plt.savefig('heatmap.png', bbox_inches='tight', pad_inches=0)
-        plt.close()  # Close the figure to free memory
-        
-        # Read the saved heatmap and resize
-        heatmap_img = cv2.imread('heatmap.png')
-        heatmap_img_resized = cv2.resize(heatmap_img, (80, 64), interpolation=cv2.INTER_LINEAR)
-        
-        # Normalize the image to have values between 0 and 1
-        heatmap_img_normalized = cv2.normalize(heatmap_img_resized, None, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-        
-        # Rearrange the dimensions from (H, W, C) to (C, H, W) to fit PyTorch's convention
-        heatmap_img_normalized = np.transpose(heatmap_img_normalized, (2, 0, 1))
-        
-        # Store the resized heatmap
-        heatmaps_test[i] = heatmap_img_normalized
+    heatmaps_val = render_heatmaps(X_val)
+    heatmaps_test = render_heatmaps(X_test)
 
     # Create PyTorch Datasets
     train_dataset = TumorDataset(heatmaps_train, y_train)
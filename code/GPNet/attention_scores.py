@@ -0,0 +1,75 @@
+#%%
+# Per-class aggregation of the attention pooling weights of every gene.
+#
+# The attention weights of a batch, (B, n_genes), are added to their class rows
+# of a (class_num, n_genes) sum with one index_add_ on the device, so nothing is
+# copied to the host per batch or per sample. Optionally the sums of squares are
+# kept as well, for a per-class standard deviation. The top-k genes per class
+# come from one torch.topk over the class means.
+#
+#   aggregator, confusion_matrix = aggregate_attention(model, train_loader, class_num, device)
+#   indices, scores = aggregator.top_k(20)
+import torch
+
+from metrics import ConfusionMatrixMeter
+from trainer import pointnet_forward
+
+
+class AttentionScoreAggregator:
+    def __init__(self, class_num, n_genes, device, second_moment=False, dtype=torch.float64):
+        """
+        Args:
+            second_moment: Also accumulate squared scores, needed for std().
+            dtype: Accumulator type; float64 keeps the sums exact enough over large cohorts.
+        """
+        self.sums = torch.zeros(class_num, n_genes, dtype=dtype, device=device)
+        self.counts = torch.zeros(class_num, dtype=torch.long, device=device)
+        self.squares = torch.zeros_like(self.sums) if second_moment else None
+
+    def update(self, scores, labels):
+        # scores: (B, n_genes) or the (B, n_genes, 1) attention output; labels: (B,)
+        scores = scores.reshape(scores.shape[0], -1).to(self.sums.dtype)
+        self.sums.index_add_(0, labels, scores)
+        self.counts += torch.bincount(labels, minlength=self.counts.shape[0])
+        if self.squares is not None:
+            self.squares.index_add_(0, labels, scores * scores)
+
+    def mean(self):
+        # classes without samples get zeros rather than NaN
+        return self.sums / self.counts.clamp(min=1).unsqueeze(1).to(self.sums.dtype)
+
+    def std(self):
+        if self.squares is None:
+            raise ValueError("created without second_moment=True")
+        counts = self.counts.clamp(min=1).unsqueeze(1).to(self.sums.dtype)
+        mean = self.sums / counts
+        return (self.squares / counts - mean * mean).clamp(min=0).sqrt()
+
+    def top_k(self, k=20):
+        """(class_num, k) gene numbers and mean scores of the k highest-scoring genes per class."""
+        scores, indices = torch.topk(self.mean(), k, dim=1)
+        return indices, scores
+
+
+def aggregate_attention(model, loader, class_num, device, forward_fn=pointnet_forward, second_moment=False):
+    """Runs the model over the loader and aggregates its attention weights per true class.
+
+    The model needs attention pooling (atention_pooling_flag=True). Returns the
+    aggregator and the confusion matrix of the predictions on the same loader.
+    """
+    captured = {}
+    handle = model.feat.atention_pooling.register_forward_hook(lambda module, inputs, output: captured.__setitem__('A', output))
+    meter = ConfusionMatrixMeter(class_num, device)
+    aggregator = AttentionScoreAggregator(class_num, model.feat.n_gene, device, second_moment)
+    model.eval()
+    try:
+        with torch.inference_mode():
+            for data in loader:
+                pred, labels, _ = forward_fn(model, data, device)
+                meter.update(torch.argmax(pred, dim=1), labels)
+                aggregator.update(captured['A'], labels)
+    finally:
+        handle.remove()
+    if aggregator.counts.sum() == 0:
+        raise ValueError("the loader gave no samples, there are no attention scores to aggregate")
+    return aggregator, meter.compute()
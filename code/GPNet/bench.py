@@ -0,0 +1,246 @@
+#%%
+# Benchmark suite for the data and model hot paths on a synthetic cohort.
+#
+# Times load_data on a generated CSV, one pass over the TumorDataset train
+# loader, PointNetCls forward and backward for every flag combination, and a
+# full train step of SimpleFNN, SparseAutoencoder and CustomCNN. Each result is
+# the median (and p90) over --repeat timed runs after warm-up runs. Results
+# go to one JSON file per run, tagged with the git commit and environment, so
+# two commits can be compared with --compare.
+#
+#   python bench.py --out bench_results/            # writes bench_results/<commit>.json
+#   python bench.py --compare old.json new.json
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from dataloader import load_data
+from export_onnx import FLAG_NAMES
+from models import PointNetCls, SimpleFNN
+from phase_report import PhaseReport
+from quantize import CODE_DIR, load_module_from_path
+from synthetic import build_parser as synthetic_parser, cohort_kwargs, write_cohort
+from trainer import expression_forward, image_forward, pointnet_forward
+
+
+def git_info():
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    status = git('status', '--porcelain')
+    return {"commit": git('rev-parse', 'HEAD'), "dirty": bool(status) if status is not None else None}
+
+
+def environment(device, threads):
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "threads": threads,
+        "device": str(device),
+        "cuda_device": torch.cuda.get_device_name(device) if device.type == 'cuda' else None,
+    }
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_fn(fn, device, warmup=2, repeat=10):
+    """Seconds per call of fn(), one entry per timed repeat."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        sync(device)
+        t0 = time.perf_counter()
+        fn()
+        sync(device)
+        times.append(time.perf_counter() - t0)
+    return np.array(times)
+
+
+def result(name, times, params=None, samples=None):
+    row = {
+        "name": name,
+        "params": params or {},
+        "median_ms": float(np.median(times) * 1e3),
+        "p90_ms": float(np.percentile(times, 90) * 1e3),
+        "repeat": len(times),
+    }
+    if samples is not None:
+        row["samples_per_s"] = float(samples / np.median(times))
+    print(f"{name} {json.dumps(row['params'])}: {row['median_ms']:.2f} ms")
+    return row
+
+
+def bench_data(csv_path, batch_size, device, repeat):
+    rows = []
+    times = time_fn(lambda: load_data(file_path=csv_path, batch_size=batch_size), device, warmup=0, repeat=max(1, repeat // 5))
+    rows.append(result("load_data", times))
+
+    # one instrumented run, so a load_data regression can be traced to its phase
+    report = PhaseReport(trace_allocations=False)
+    _, _, _, train_loader, _, _ = load_data(file_path=csv_path, batch_size=batch_size, report=report)
+    report.close()
+    for phase in report.phases:
+        row = result("load_data_phase", np.array([phase["wall_s"]]), {"phase": phase["name"]})
+        row["peak_rss_mb"] = phase["peak_rss_bytes"] / 2**20
+        rows.append(row)
+
+    def iterate():
+        for _ in train_loader:
+            pass
+    times = time_fn(iterate, device, warmup=1, repeat=repeat)
+    rows.append(result("tumor_dataset_iteration", times, {"batch_size": batch_size}, samples=len(train_loader.dataset)))
+    return rows, train_loader
+
+
+def train_step_fns(model, forward_fn, loss_fn, data, device):
+    # forward only, and forward + backward + optimizer step
+    optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    model.train()
+
+    def forward():
+        with torch.no_grad():
+            forward_fn(model, data, device)
+
+    def step():
+        optimizer.zero_grad()
+        pred, labels, aux = forward_fn(model, data, device)
+        loss_fn(pred, labels, aux).backward()
+        optimizer.step()
+    return forward, step
+
+
+def bench_pointnet(batch, n_genes, class_num, device, repeat, gene_space_dim=3):
+    rows = []
+    ce = nn.CrossEntropyLoss()
+    for combo in itertools.product([False, True], repeat=len(FLAG_NAMES)):
+        flags = dict(zip(FLAG_NAMES, combo))
+        torch.manual_seed(0)
+        model = PointNetCls(gene_idx_dim=2, gene_space_num=gene_space_dim, class_num=class_num, gene_num=n_genes, **flags).to(device)
+        forward, step = train_step_fns(model, pointnet_forward, lambda pred, labels, aux: ce(pred, labels), batch, device)
+        rows.append(result("pointnet_forward", time_fn(forward, device, repeat=repeat), flags, samples=len(batch[2])))
+        rows.append(result("pointnet_train_step", time_fn(step, device, repeat=repeat), flags, samples=len(batch[2])))
+    return rows
+
+
+def bench_baselines(batch, n_genes, class_num, device, repeat):
+    rows = []
+    ce = nn.CrossEntropyLoss()
+    features, _, labels = batch
+    torch.manual_seed(0)
+
+    fnn = SimpleFNN(input_size=n_genes, output_size=class_num).to(device)
+    _, step = train_step_fns(fnn, expression_forward, lambda pred, labels, aux: ce(pred, labels), batch, device)
+    rows.append(result("simple_fnn_train_step", time_fn(step, device, repeat=repeat), samples=len(labels)))
+
+    ssae_model = load_module_from_path('ssae_model', os.path.join(CODE_DIR, 'SSAE', 'model.py'))
+    ssae = ssae_model.SparseAutoencoder(n_input=n_genes, n_output=class_num).to(device)
+    ssae_loss = lambda pred, labels, aux: ssae_model.sparse_autoencoder_loss(ssae, aux["decode"], pred, labels, aux["input"], 0.7, 1, 0, 0, None)[0]
+    _, step = train_step_fns(ssae, expression_forward, ssae_loss, batch, device)
+    rows.append(result("sparse_autoencoder_train_step", time_fn(step, device, repeat=repeat), samples=len(labels)))
+
+    # CustomCNN takes the 3 x 64 x 80 heatmaps made by dataloader_heatmap; random images time the same
+    cnn_model = load_module_from_path('cnn_model', os.path.join(CODE_DIR, 'CNN_for_gene_expression', 'model.py'))
+    cnn = cnn_model.CustomCNN(class_num=class_num).to(device)
+    images = (torch.rand(len(labels), 3, 64, 80), labels)
+    _, step = train_step_fns(cnn, image_forward, lambda pred, labels, aux: ce(pred, labels), images, device)
+    rows.append(result("custom_cnn_train_step", time_fn(step, device, repeat=repeat), samples=len(labels)))
+    return rows
+
+
+def run(args):
+    device = torch.device(args.device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    cohort = cohort_kwargs(args)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = args.csv or os.path.join(tmp_dir, "synthetic.csv")
+        if args.csv is None:
+            write_cohort(csv_path, **cohort)
+        rows, train_loader = bench_data(csv_path, args.batch_size, device, args.repeat)
+
+    batch = next(iter(train_loader))
+    n_genes = batch[0].shape[1]
+    class_num = args.classes
+    if not args.skip_models:
+        rows += bench_pointnet(batch, n_genes, class_num, device, args.repeat)
+        rows += bench_baselines(batch, n_genes, class_num, device, args.repeat)
+
+    report = {
+        "git": git_info(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": environment(device, torch.get_num_threads()),
+        "cohort": cohort if args.csv is None else {"csv": args.csv},
+        "batch_size": args.batch_size,
+        "results": rows,
+    }
+    out = args.out
+    if out.endswith('/') or os.path.isdir(out):
+        os.makedirs(out, exist_ok=True)
+        commit = (report["git"]["commit"] or "nogit")[:12] + ("-dirty" if report["git"]["dirty"] else "")
+        out = os.path.join(out, f"{commit}.json")
+    with open(out, 'w') as fp:
+        json.dump(report, fp, indent=1)
+    print(f"results written to {out}")
+    return report
+
+
+def result_key(row):
+    return row["name"], json.dumps(row["params"], sort_keys=True)
+
+
+def compare(old_path, new_path):
+    """Prints new/old median time per benchmark; below 1 means the new run is faster."""
+    with open(old_path) as fp:
+        old = json.load(fp)
+    with open(new_path) as fp:
+        new = json.load(fp)
+    if old["environment"] != new["environment"]:
+        print("warning: the two runs come from different environments")
+    old_rows = {result_key(r): r for r in old["results"]}
+    print(f"{'benchmark':60s} {'old ms':>10s} {'new ms':>10s} {'ratio':>7s}")
+    for row in new["results"]:
+        key = result_key(row)
+        if key not in old_rows:
+            continue
+        ratio = row["median_ms"] / old_rows[key]["median_ms"]
+        label = key[0] + (" " + " ".join(k if v is True else f"{k}={v}" for k, v in row["params"].items() if v is not False) if row["params"] else "")
+        print(f"{label[:60]:60s} {old_rows[key]['median_ms']:10.2f} {row['median_ms']:10.2f} {ratio:7.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Data and model hot-path benchmarks on a synthetic cohort')
+    synthetic_parser(parser)
+    parser.add_argument('--out', default='bench_results/', type=str, help='Result file, or a folder to write <commit>.json into.')
+    parser.add_argument('--csv', default=None, type=str, help='Benchmark an existing CSV instead of a generated one.')
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--repeat', default=10, type=int)
+    parser.add_argument('--device', default=None, type=str)
+    parser.add_argument('--threads', default=None, type=int)
+    parser.add_argument('--skip_models', action='store_true', help='Only time the data path.')
+    parser.add_argument('--compare', nargs=2, default=None, metavar=('OLD', 'NEW'), help='Compare two result files instead of running.')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args)
@@ -0,0 +1,94 @@
+#%%
+# Cold-start time of the cli.py subcommands.
+#
+# Every run is a fresh interpreter executing `cli.py <subcommand> --help`, which
+# imports everything the subcommand imports at module level and builds its
+# parser, but does no work. Besides the median wall time it reports which of the
+# heavy optional packages got imported, and with --importtime the slowest
+# imports (python -X importtime). Exits non-zero if predict is slower than
+# --target_ms or imports one of the packages it should not need.
+#
+#   python bench_startup.py --repeat 5 --target_ms 3000
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from cli import COMMANDS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = ['scipy', 'sklearn', 'networkx', 'leidenalg', 'igraph', 'matplotlib', 'seaborn', 'cv2', 'pandas', 'pyarrow', 'onnxruntime']
+# predict reads the cohort with pandas, but only once it runs
+PREDICT_ALLOWED = set()
+
+
+def time_command(name, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(HERE, 'cli.py'), name, '--help'], cwd=HERE,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - t0)
+    return np.array(times)
+
+
+def imported_heavy_modules(name):
+    code = ("import json, sys; import cli; cli.command_parser(%r); "
+            "print(json.dumps([m for m in %r if m in sys.modules]))" % (name, HEAVY_MODULES))
+    out = subprocess.run([sys.executable, '-c', code], cwd=HERE, capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def slowest_imports(name, top=15):
+    # -X importtime writes "import time: self [us] | cumulative | package" lines to stderr
+    err = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(HERE, 'cli.py'), name, '--help'], cwd=HERE,
+                         capture_output=True, text=True).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, package = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), package.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def run(args):
+    commands = args.commands or list(COMMANDS)
+    failed = False
+    results = {}
+    print(f"{'subcommand':12s} {'median ms':>10s} {'p90 ms':>8s}  heavy imports")
+    for name in commands:
+        times = time_command(name, args.repeat)
+        heavy = imported_heavy_modules(name)
+        results[name] = {"median_ms": float(np.median(times) * 1e3), "p90_ms": float(np.percentile(times, 90) * 1e3), "heavy_imports": heavy}
+        print(f"{name:12s} {results[name]['median_ms']:10.0f} {results[name]['p90_ms']:8.0f}  {', '.join(heavy) or '-'}")
+        if args.importtime:
+            for cumulative, package in slowest_imports(name):
+                print(f"    {cumulative / 1e3:8.1f} ms {package}")
+    if 'predict' in results:
+        unexpected = set(results['predict']['heavy_imports']) - PREDICT_ALLOWED
+        if results['predict']['median_ms'] > args.target_ms:
+            print(f"predict cold start {results['predict']['median_ms']:.0f} ms is above the {args.target_ms:.0f} ms target")
+            failed = True
+        if unexpected:
+            print(f"predict imports {', '.join(sorted(unexpected))} at startup")
+            failed = True
+    if args.out:
+        with open(args.out, 'w') as fp:
+            json.dump(results, fp, indent=1)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold-start time of the cli.py subcommands')
+    parser.add_argument('commands', nargs='*', help='Subcommands to time (default: all).')
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--target_ms', default=3000, type=float, help='Cold-start budget of predict.')
+    parser.add_argument('--importtime', action='store_true', help='Also list the slowest imports of every subcommand.')
+    parser.add_argument('--out', default=None, type=str, help='Write the results as JSON.')
+    args = parser.parse_args()
+    sys.exit(1 if run(args) else 0)
@@ -0,0 +1,124 @@
+#%%
+# Per-rank memory of DDP + Adam versus DDP + ZeroRedundancyOptimizer.
+#
+# Spawns world_size CPU processes on the gloo backend for every requested world
+# size, trains PointNetCls (encoder on, so encoder1 dominates the parameter
+# count) for a few steps on random data and reports, per rank, the parameter,
+# gradient and optimizer-state memory, the peak RSS and the step time. Both
+# optimizers see the same data from the same initial weights, so the final
+# weights are compared as a correctness check.
+#
+#   python bench_zero.py --world_sizes 1 2 4 --gene_num 60660
+import argparse
+import os
+import socket
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.distributed.optim import ZeroRedundancyOptimizer
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+from dataloader import gene_index_2d
+from models import PointNetCls, freeze_unused_parameters
+from trainer import pointnet_forward
+from utils import memory_per_rank
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def worker(rank, world_size, port, args, zero, result_queue, params_path):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(args.threads)
+
+    torch.manual_seed(0)
+    model = DDP(freeze_unused_parameters(PointNetCls(gene_idx_dim=2, class_num=args.class_num, encoder_flag=True, gene_num=args.gene_num)))
+    if zero:
+        optimizer = ZeroRedundancyOptimizer(model.parameters(), optimizer_class=optim.Adam, lr=1e-3)
+    else:
+        optimizer = optim.Adam(model.parameters(), lr=1e-3)
+
+    # every rank draws its own batches, the same ones for both optimizers
+    g = torch.Generator().manual_seed(1000 + rank)
+    gene_idx = torch.from_numpy(gene_index_2d(args.gene_num)).float()
+    step_times = []
+    for step in range(args.steps):
+        features = torch.randn(args.batch_size, args.gene_num, generator=g)
+        labels = torch.randint(0, args.class_num, (args.batch_size,), generator=g)
+        data = (features, gene_idx.expand(args.batch_size, -1, -1), labels)
+        t0 = time.perf_counter()
+        optimizer.zero_grad()
+        pred, labels, _ = pointnet_forward(model, data, torch.device('cpu'))
+        F.cross_entropy(pred, labels).backward()
+        optimizer.step()
+        step_times.append(time.perf_counter() - t0)
+
+    report = memory_per_rank(model.module, optimizer)
+    # the first step allocates the optimizer state, leave it out of the timing
+    report["step_ms"] = float(np.mean(step_times[1:] or step_times) * 1e3)
+    report.update({"world_size": world_size, "optimizer": "zero" if zero else "adam", "rank": rank})
+    result_queue.put(report)
+    if rank == 0:
+        torch.save({k: v.detach().clone() for k, v in model.module.state_dict().items()}, params_path)
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def run(world_size, args, zero, params_path):
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.SimpleQueue()
+    mp.spawn(worker, args=(world_size, free_port(), args, zero, result_queue, params_path), nprocs=world_size, join=True)
+    return [result_queue.get() for _ in range(world_size)]
+
+
+def max_param_diff(path_a, path_b):
+    a, b = torch.load(path_a), torch.load(path_b)
+    return max(float((a[k].float() - b[k].float()).abs().max()) for k in a if a[k].numel() > 0)
+
+
+def main(args):
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for world_size in args.world_sizes:
+            paths = {}
+            for zero in (False, True):
+                paths[zero] = os.path.join(tmp_dir, f"params_{world_size}_{zero}.pth")
+                rows += run(world_size, args, zero, paths[zero])
+            diff = max_param_diff(paths[False], paths[True])
+            print(f"world size {world_size}: max |adam - zero| weight difference after {args.steps} steps {diff:.2e}")
+            if diff > args.tolerance:
+                raise RuntimeError(f"ZeroRedundancyOptimizer diverged from Adam at world size {world_size}")
+
+    table = pd.DataFrame(rows).sort_values(["world_size", "optimizer", "rank"])
+    # one line per (world size, optimizer): the ranks hold near-equal shards, so report the largest
+    summary = table.groupby(["world_size", "optimizer"]).max(numeric_only=True).drop(columns="rank")
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:.1f}'.format):
+        print(summary)
+    if args.out:
+        table.to_csv(args.out, index=False)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-rank memory of Adam vs ZeroRedundancyOptimizer on gloo/CPU')
+    parser.add_argument('--world_sizes', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--gene_num', default=60660, type=int, help='Encoder input size (60660 matches the full gene set).')
+    parser.add_argument('--class_num', default=10, type=int)
+    parser.add_argument('--batch_size', default=4, type=int)
+    parser.add_argument('--steps', default=3, type=int)
+    parser.add_argument('--threads', default=1, type=int, help='Intra-op threads per process.')
+    parser.add_argument('--tolerance', default=1e-4, type=float, help='Largest allowed weight difference between the two optimizers.')
+    parser.add_argument('--out', default=None, type=str, help='Optional CSV with one row per rank.')
+    main(parser.parse_args())
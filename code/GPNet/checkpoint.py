@@ -0,0 +1,125 @@
+#%%
+# Asynchronous checkpoint writer.
+#
+# save() snapshots the state to host memory on the calling thread and returns;
+# a background thread writes it to a temporary file next to the target and
+# renames it into place, so a crash never leaves a truncated .pth behind.
+# When the same snapshot is also the new best model it is written once and the
+# best file is hard-linked to it instead of being written a second time.
+import os
+import queue
+import random
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+
+def snapshot_to_cpu(state):
+    # detached host copies, so training can keep updating the live tensors
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        return type(state)((k, snapshot_to_cpu(v)) for k, v in state.items())
+    elif isinstance(state, (list, tuple)):
+        return type(state)(snapshot_to_cpu(v) for v in state)
+    return state
+
+
+def atomic_save(obj, path):
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def atomic_link(src, dst):
+    # hard link when src and dst share a filesystem, copy otherwise
+    tmp_path = f"{dst}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class AsyncCheckpointWriter:
+    def __init__(self, keep_last=None, max_pending=2):
+        """Background checkpoint writer.
+
+        Args:
+            keep_last: Number of most recent periodic checkpoints to keep on disk.
+                Files written as best_path are never removed. None keeps everything.
+            max_pending: Snapshots allowed to wait in host memory; save() blocks
+                beyond that instead of growing memory without bound.
+        """
+        self.keep_last = keep_last
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.written = []
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, path, best_path=None, periodic=True):
+        # periodic files count towards keep_last; others (e.g. a rolling resume
+        # state that is overwritten in place) are never pruned
+        self._raise_error()
+        self.queue.put((snapshot_to_cpu(state), path, best_path, periodic))
+
+    def close(self):
+        # wait for all pending writes
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("checkpoint write failed") from error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            state, path, best_path, periodic = item
+            try:
+                atomic_save(state, path)
+                if best_path is not None:
+                    atomic_link(path, best_path)
+                if periodic:
+                    self._apply_retention(path)
+            except Exception as e:
+                self.error = e
+
+    def _apply_retention(self, path):
+        if path in self.written:
+            self.written.remove(path)
+        self.written.append(path)
+        if self.keep_last is None:
+            return
+        while len(self.written) > self.keep_last:
+            old_path = self.written.pop(0)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+
+def capture_rng_state():
+    state = {
+        "torch": torch.get_rng_state(),
+        "numpy": np.random.get_state(),
+        "python": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
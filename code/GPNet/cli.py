@@ -0,0 +1,55 @@
+#%%
+# Single entry point for the GPNet tools.
+#
+#   python cli.py train   [main.py options]
+#   python cli.py eval    [eval_best_model.py eval options]
+#   python cli.py predict [predict.py options]
+#   python cli.py cluster [eval_best_model.py cluster options]
+#   python cli.py export  [export_onnx.py export options]
+#
+# The module behind a subcommand is imported only once the subcommand is known,
+# so e.g. predict does not pay for the clustering and plotting stack (scipy,
+# networkx, leidenalg, igraph, matplotlib, sklearn) or for seaborn/cv2.
+# bench_startup.py measures the cold start of every subcommand.
+import argparse
+import importlib
+import sys
+
+# subcommand: (module, function adding its arguments to a parser, function running it, description)
+COMMANDS = {
+    'train': ('main', 'build_parser', 'main', 'Train GPNet.'),
+    'eval': ('eval_best_model', 'add_eval_args', 'run_eval', 'Test accuracy and per-class attention scores of a trained model.'),
+    'predict': ('predict', 'build_parser', 'main', 'Streaming batch prediction for a new cohort.'),
+    'cluster': ('eval_best_model', 'add_cluster_args', 'run_cluster', 'Leiden clusters of the learned gene token space.'),
+    'export': ('export_onnx', 'add_export_args', 'run_export', 'Export a trained model to ONNX and check parity.'),
+}
+
+
+def command_parser(name):
+    """Imports the module of subcommand `name`; returns its parser and run function."""
+    module_name, add_args, run, description = COMMANDS[name]
+    module = importlib.import_module(module_name)
+    parser = argparse.ArgumentParser(prog=f"cli.py {name}", description=description)
+    getattr(module, add_args)(parser)
+    return parser, getattr(module, run)
+
+
+def usage():
+    lines = ["usage: cli.py {" + ",".join(COMMANDS) + "} [options]", "", "subcommands:"]
+    lines += [f"  {name:10s} {spec[3]}" for name, spec in COMMANDS.items()]
+    lines += ["", "cli.py <subcommand> --help lists the options of a subcommand."]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS:
+        print(usage())
+        return 0 if argv and argv[0] in ('-h', '--help') else 2
+    parser, run = command_parser(argv[0])
+    run(parser.parse_args(argv[1:]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
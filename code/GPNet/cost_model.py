@@ -0,0 +1,311 @@
+#%%
+# Cost model and batch-size finder for PointNetCls.
+#
+# Whether a batch fits depends on n_gene, gene_space_dim and the
+# snet/tnet/feature_transform/attention flags, since every per-gene layer keeps
+# a (B, C, n_gene) activation for the backward pass. pointnet_cost() builds the
+# model and measures, per sample:
+#   - parameters (and the bytes of weights, gradients and Adam state),
+#   - forward FLOPs (torch FlopCounterMode, or Conv1d/Linear hooks on old torch),
+#   - activation bytes saved for backward (saved_tensors_hooks),
+# from two small batches, so the batch-independent part is separated out.
+# find_batch_size() then probes real train steps on the current device
+# (CUDA or CPU) for the largest batch under a memory budget; on the CPU each
+# trial runs in a fresh process and is measured by its peak RSS.
+#
+#   python cost_model.py --genes 60660 --budget_gb 16 --probe
+import argparse
+import functools
+import itertools
+import os
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from export_onnx import FLAG_NAMES
+from models import PointNetCls
+from trainer import pointnet_forward
+from utils import tensor_bytes
+
+
+def parameter_bytes(model, optimizer_slots=2):
+    """Weights + gradients + optimizer state; Adam keeps two slots per parameter."""
+    n = sum(p.numel() for p in model.parameters())
+    trainable = [p for p in model.parameters() if p.requires_grad]
+    weights = tensor_bytes(model.parameters())
+    grads = tensor_bytes(trainable)
+    return {"params": n, "weights_bytes": weights, "grads_bytes": grads, "optimizer_bytes": optimizer_slots * grads}
+
+
+def count_flops(model, forward):
+    # forward() runs the model once; FLOPs of one forward pass
+    try:
+        from torch.utils.flop_counter import FlopCounterMode
+    except ImportError:
+        return count_flops_hooks(model, forward)
+    counter = FlopCounterMode(display=False)
+    with counter:
+        forward()
+    return counter.get_total_flops()
+
+
+def count_flops_hooks(model, forward):
+    # older torch: the 1x1 convolutions and linear layers carry nearly all of the work
+    flops = []
+
+    def hook(module, inputs, output):
+        if isinstance(module, nn.Conv1d):
+            flops.append(2 * output.numel() * module.in_channels * module.kernel_size[0] // module.groups)
+        else:
+            flops.append(2 * output.numel() * module.in_features)
+    handles = [m.register_forward_hook(hook) for m in model.modules() if isinstance(m, (nn.Conv1d, nn.Linear))]
+    try:
+        forward()
+    finally:
+        for h in handles:
+            h.remove()
+    return sum(flops)
+
+
+def saved_activation_bytes(forward):
+    """Bytes of the tensors autograd keeps for backward during forward()."""
+    seen = {}
+
+    def pack(t):
+        # parameters and views of one storage are saved more than once
+        key = (t.untyped_storage().data_ptr() if hasattr(t, 'untyped_storage') else t.data_ptr(), t.dtype)
+        seen[key] = max(seen.get(key, 0), t.numel() * t.element_size())
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = forward()
+    return sum(seen.values()), out
+
+
+def pointnet_batch(batch_size, n_gene, gene_idx_dim=2, class_num=10):
+    # the loader layout: (B, n_gene) counts, (B, n_gene, 2) gene index, (B,) labels
+    return (torch.randn(batch_size, n_gene),
+            torch.randn(batch_size, n_gene, gene_idx_dim),
+            torch.randint(0, class_num, (batch_size,)))
+
+
+def pointnet_cost(n_gene, gene_space_dim=3, class_num=10, device="cpu", sizes=(2, 4), **flags):
+    """Parameters, FLOPs and activation bytes of PointNetCls, split into per-sample and fixed parts.
+
+    Activation memory and FLOPs grow linearly in the batch size, so two batch
+    sizes (BatchNorm needs at least 2 in train mode) give the per-sample slope.
+    """
+    device = torch.device(device)
+    torch.manual_seed(0)
+    model = PointNetCls(gene_idx_dim=2, gene_space_num=gene_space_dim, class_num=class_num, gene_num=n_gene, **flags).to(device)
+    model.train()
+    activations, flops = [], []
+    for b in sizes:
+        data = pointnet_batch(b, n_gene, class_num=class_num)
+        forward = lambda: pointnet_forward(model, data, device)[0]
+        nbytes, _ = saved_activation_bytes(forward)
+        activations.append(nbytes)
+        with torch.no_grad():
+            flops.append(count_flops(model, forward))
+    span = sizes[1] - sizes[0]
+    act_per_sample = (activations[1] - activations[0]) / span
+    flops_per_sample = (flops[1] - flops[0]) / span
+    cost = parameter_bytes(model)
+    cost.update({
+        "n_gene": n_gene,
+        "gene_space_dim": gene_space_dim,
+        **flags,
+        "forward_flops_per_sample": flops_per_sample,
+        # backward costs about twice the forward
+        "train_flops_per_sample": 3 * flops_per_sample,
+        "activation_bytes_per_sample": act_per_sample,
+        "activation_bytes_fixed": max(activations[0] - act_per_sample * sizes[0], 0),
+    })
+    return cost
+
+
+def estimate_peak_bytes(cost, batch_size):
+    """Predicted train-step memory: parameters, gradients, Adam state and saved activations."""
+    return (cost["weights_bytes"] + cost["grads_bytes"] + cost["optimizer_bytes"]
+            + cost["activation_bytes_fixed"] + batch_size * cost["activation_bytes_per_sample"])
+
+
+def predicted_batch_size(cost, budget_bytes):
+    fixed = estimate_peak_bytes(cost, 0)
+    return max(int((budget_bytes - fixed) // max(cost["activation_bytes_per_sample"], 1)), 0)
+
+
+def available_memory(device):
+    device = torch.device(device)
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        with open('/proc/meminfo') as fp:
+            fields = dict(line.split(':', 1) for line in fp)
+        return int(fields['MemAvailable'].split()[0]) * 1024
+    except (OSError, KeyError):
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def is_out_of_memory(error):
+    # CUDA raises OutOfMemoryError, the CPU allocator a RuntimeError "can't allocate memory"
+    if isinstance(error, (MemoryError, getattr(torch, 'OutOfMemoryError', MemoryError))):
+        return True
+    message = str(error).lower()
+    return 'out of memory' in message or "can't allocate memory" in message
+
+
+def train_step(model, optimizer, data, forward_fn, device, loss_fn=nn.CrossEntropyLoss()):
+    optimizer.zero_grad()
+    pred, labels, aux = forward_fn(model, data, device)
+    loss_fn(pred, labels).backward()
+    optimizer.step()
+
+
+def cuda_trial_bytes(make_model, make_batch, forward_fn, device, batch_size):
+    """Train-step memory of a fresh model on a CUDA device, or None if it runs out of memory."""
+    model = optimizer = data = None
+    try:
+        model = make_model().to(device)
+        model.train()
+        optimizer = optim.Adam(model.parameters(), lr=1e-3)
+        data = make_batch(batch_size)
+        held = tensor_bytes(model.parameters())
+        # the first step allocates the Adam state, the second one shows the steady state
+        train_step(model, optimizer, data, forward_fn, device)
+        held += tensor_bytes(p.grad for p in model.parameters() if p.grad is not None) \
+            + tensor_bytes(v for s in optimizer.state.values() for v in s.values())
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        start = torch.cuda.memory_allocated(device)
+        train_step(model, optimizer, data, forward_fn, device)
+        torch.cuda.synchronize(device)
+        return held + torch.cuda.max_memory_allocated(device) - start
+    except (RuntimeError, MemoryError) as e:
+        if not is_out_of_memory(e):
+            raise
+        return None
+    finally:
+        del model, optimizer, data
+        torch.cuda.empty_cache()
+
+
+def _cpu_trial(make_model, make_batch, forward_fn, batch_size):
+    # runs in a fresh process: its peak RSS above the RSS before the model and
+    # batch exist is the whole train step (weights, gradients, Adam state,
+    # activations); freed memory that the allocator kept from an earlier trial
+    # cannot hide any of it
+    import resource
+    from phase_report import current_rss
+    start = current_rss()
+    device = torch.device("cpu")
+    try:
+        model = make_model()
+        model.train()
+        optimizer = optim.Adam(model.parameters(), lr=1e-3)
+        data = make_batch(batch_size)
+        train_step(model, optimizer, data, forward_fn, device)
+        train_step(model, optimizer, data, forward_fn, device)
+    except (RuntimeError, MemoryError) as e:
+        if not is_out_of_memory(e):
+            raise
+        return None
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - start
+
+
+def cpu_trial_bytes(make_model, make_batch, forward_fn, batch_size):
+    """Train-step memory on the CPU, measured in a spawned process; None if it runs out of memory."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            return pool.submit(_cpu_trial, make_model, make_batch, forward_fn, batch_size).result()
+    except BrokenProcessPool:
+        # the worker was killed, normally by the kernel's out-of-memory killer
+        return None
+
+
+def find_batch_size(make_model, make_batch, forward_fn, device, budget_bytes=None, max_batch=4096, min_batch=2):
+    """Largest batch size whose train step stays within budget_bytes on `device`.
+
+    make_model() builds a fresh model and make_batch(b) a loader batch of size b.
+    On the CPU every trial runs in its own spawned process, so make_model,
+    make_batch and forward_fn have to be picklable (module-level functions or
+    functools.partial). Doubles the batch until a step fails (out of memory) or
+    exceeds the budget, then bisects. The budget defaults to 90% of the free
+    memory of the device.
+    Returns (batch_size, {batch_size: measured bytes or None if it failed}).
+    """
+    device = torch.device(device)
+    budget_bytes = budget_bytes or int(0.9 * available_memory(device))
+    trials = {}
+
+    def fits(b):
+        if device.type == 'cuda':
+            trials[b] = cuda_trial_bytes(make_model, make_batch, forward_fn, device, b)
+        else:
+            trials[b] = cpu_trial_bytes(make_model, make_batch, forward_fn, b)
+        print(f"batch {b}: {'out of memory' if trials[b] is None else f'{trials[b] / 2**20:.1f} MB'}")
+        return trials[b] is not None and trials[b] <= budget_bytes
+
+    if not fits(min_batch):
+        return 0, trials
+    lo, hi = min_batch, None
+    while hi is None and lo < max_batch:
+        b = min(lo * 2, max_batch)
+        if fits(b):
+            lo = b
+        else:
+            hi = b
+    while hi is not None and hi - lo > 1:
+        mid = (lo + hi) // 2
+        if fits(mid):
+            lo = mid
+        else:
+            hi = mid
+    return lo, trials
+
+
+def pointnet_batch_size(n_gene, budget_bytes=None, device="cpu", gene_space_dim=3, class_num=10, max_batch=4096, **flags):
+    # partials rather than lambdas, so the CPU trials can be sent to a spawned process
+    make_model = functools.partial(PointNetCls, gene_idx_dim=2, gene_space_num=gene_space_dim, class_num=class_num, gene_num=n_gene, **flags)
+    make_batch = functools.partial(pointnet_batch, n_gene=n_gene, class_num=class_num)
+    return find_batch_size(make_model, make_batch, pointnet_forward, device, budget_bytes=budget_bytes, max_batch=max_batch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PointNetCls cost model and batch-size finder')
+    parser.add_argument('--genes', default=60660, type=int)
+    parser.add_argument('--gene_space_dim', default=3, type=int)
+    parser.add_argument('--classes', default=10, type=int)
+    parser.add_argument('--budget_gb', default=None, type=float, help='Memory budget (default: 90%% of free memory on the device).')
+    parser.add_argument('--device', default=None, type=str)
+    parser.add_argument('--flags', default=None, type=str,
+                        help='Comma separated flags to enable, e.g. snet_flag,tnet_flag; default: every combination.')
+    parser.add_argument('--probe', action='store_true', help='Also run real train steps to find the largest fitting batch.')
+    parser.add_argument('--max_batch', default=4096, type=int)
+    args = parser.parse_args()
+
+    device = torch.device(args.device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    budget = int(args.budget_gb * 2**30) if args.budget_gb else int(0.9 * available_memory(device))
+    if args.flags is not None:
+        enabled = set(args.flags.split(',')) - {''}
+        combos = [tuple(name in enabled for name in FLAG_NAMES)]
+    else:
+        combos = itertools.product([False, True], repeat=len(FLAG_NAMES))
+    print(f"device {device}, budget {budget / 2**30:.2f} GB, {args.genes} genes")
+    print(f"{'flags':45s} {'params':>9s} {'GFLOP/sample':>13s} {'act MB/sample':>14s} {'predicted':>10s} {'probed':>7s}")
+    for combo in combos:
+        flags = dict(zip(FLAG_NAMES, combo))
+        cost = pointnet_cost(args.genes, args.gene_space_dim, args.classes, device, **flags)
+        predicted = predicted_batch_size(cost, budget)
+        probed = ""
+        if args.probe:
+            probed = pointnet_batch_size(args.genes, budget, device, args.gene_space_dim, args.classes,
+                                         max_batch=args.max_batch, **flags)[0]
+        label = ",".join(k for k, v in flags.items() if v) or "-"
+        print(f"{label:45s} {cost['params']:9d} {cost['train_flops_per_sample'] / 1e9:13.3f} "
+              f"{cost['activation_bytes_per_sample'] / 2**20:14.1f} {predicted:10d} {probed!s:>7s}")
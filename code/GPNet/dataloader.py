@@ -1,137 +1,192 @@
 #%%
-import pandas as pd
+# pandas and sklearn are only needed to read and split the training CSV; they are
+# imported in prepare_data so predict/serve, which only need the gene index and the
+# preprocess info, start without them.
 import numpy as np
 from torch.utils.data import Dataset, DataLoader
-from sklearn.model_selection import train_test_split
-from collections import Counter
-import numpy as np
-from torch.utils.data.distributed import DistributedSampler
+import torch
+import json
+from samplers import ResumableRandomSampler, ResumableDistributedSampler, DistributedEvalSampler
+from phase_report import PhaseReport, phase_or_null
+
+def gene_index_2d(n_genes):
+    # lay the gene numbers out on a sqrt(n) x sqrt(n) grid and normalize the coordinates
+    gene_numbers = np.arange(n_genes)
+    gene_numbers_len = np.round(np.sqrt(n_genes)) + 1
+    gene_num_2d = np.zeros((n_genes, 2))
+    gene_num_2d[:, 0] = gene_numbers // gene_numbers_len
+    gene_num_2d[:, 1] = gene_numbers % gene_numbers_len
+    return (gene_num_2d - np.mean(gene_num_2d)) / np.std(gene_num_2d)
+
+def save_preprocess_info(path, gene_names, features_mean, features_std, number_to_label):
+    # everything needed to preprocess a new cohort the way the training data was
+    info = {
+        "gene_names": [str(g) for g in gene_names],
+        "features_mean": float(features_mean),
+        "features_std": float(features_std),
+        "number_to_label": {str(k): str(v) for k, v in number_to_label.items()},
+    }
+    with open(path, 'w') as fp:
+        json.dump(info, fp)
+
+def load_preprocess_info(path):
+    with open(path) as fp:
+        info = json.load(fp)
+    info["number_to_label"] = {int(k): v for k, v in info["number_to_label"].items()}
+    return info
+
+class TumorDataset(Dataset):
+    def __init__(self, features_count, features_gene_idx, labels, indices=None):
+        """
+        Args:
+            features_count: (n_samples, n_genes) expression matrix.
+            features_gene_idx: (n_genes, 2) gene coordinates shared by every sample,
+                or (n_samples, n_genes, 2) per-sample coordinates.
+            labels: Numerical label per sample.
+            indices: Optional rows of features_count/labels that make up this split,
+                so several splits can read from one (possibly shared-memory) array.
+        """
+        self.features_count = features_count
+        self.features_idx = features_gene_idx
+        self.labels = labels
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.labels) if self.indices is None else len(self.indices)
+
+    def __getitem__(self, idx):
+        row = idx if self.indices is None else self.indices[idx]
+        sample_feature1 = self.features_count[row]
+        sample_feature2 = self.features_idx if self.features_idx.ndim == 2 else self.features_idx[row]
+        label = self.labels[row]
+        return sample_feature1, sample_feature2, label
+
+def prepare_data(file_path, preprocess_info_path=None, report=None):
+    """Reads and normalizes the count matrix and splits it into train/val/test rows.
+
+    Returns a dict of plain arrays and mappings (no tensors or loaders), so it can be
+    put in shared memory and reused by several training processes. If a PhaseReport
+    is given, the time and memory of every phase is recorded in it.
+    """
+    import pandas as pd
+    from sklearn.model_selection import train_test_split
 
-def load_data(file_path, batch_size=8, Multi_gpu_flag=False):
     # 1. Read the CSV file with MultiIndex
     print("Loading data...")
     data_dir = file_path
-    df = pd.read_csv(data_dir, header=[0, 1], index_col=0)
-    df.columns = pd.MultiIndex.from_tuples(df.columns)
+    with phase_or_null(report, "read_csv"):
+        df = pd.read_csv(data_dir, header=[0, 1], index_col=0)
+        df.columns = pd.MultiIndex.from_tuples(df.columns)
 
     gene_names = df.index.values
-    gene_name_number_mapping = {gene_names[i]: i for i in range(len(gene_names))}
     gene_number_name_mapping = {i: gene_names[i] for i in range(len(gene_names))}
-    gene_numbers = np.arange(len(gene_names))
 
     # 2. Reshape and Preprocess the Data
     # Flatten the DataFrame
     print("Preprocessing data...")
-    data = []
-    feature_num = {}
-    for col in df.columns:
-        label = col[0]  # First level of the MultiIndex is the class name
-        features = df[col].values
-        data.append((features, label))
-        if label not in feature_num:
-            feature_num[label] = 0
-        else:
-            feature_num[label] += 1
-    # Separate features and labels
-    features, labels = zip(*data)
-    features = np.array(features)
-    # Find NaN values
-    nan_mask = np.isnan(features)
-    # Replace NaN values with 0
-    features[nan_mask] = 0
-    # Create a set of unique labels and sort it to maintain consistency
-    unique_labels = sorted(set(labels))
-
-    # Create a mapping dictionary from label to number
-    label_to_number = {label: num for num, label in enumerate(unique_labels)}
-
-    # Map your labels to numbers
-    numerical_labels = [label_to_number[label] for label in labels]
-
-    # To get the reverse mapping (from number to label), you can use:
-    number_to_label = {num: label for label, num in label_to_number.items()}
-
-    labels = numerical_labels
-    feature_num = {label_to_number[key]: value for key, value in feature_num.items() if key in label_to_number}
-
-    gene_numbers_len = len(gene_numbers)
-    gene_numbers_len = np.round(np.sqrt(gene_numbers_len)) + 1
-    # print(gene_numbers_len)
-    gene_num_2d = np.zeros((len(gene_numbers), 2))
-    for i in range(len(gene_numbers)):
-        gene_num_2d[i, 0] = i // gene_numbers_len
-        gene_num_2d[i, 1] = i % gene_numbers_len
-    # print(gene_num_2d)
-
-    features_mean = np.mean(features)
-    features_std = np.std(features)
-    features_normalized = (features - features_mean) / features_std
-
-    gene_numbers_mean = np.mean(gene_numbers)
-    gene_numbers_std = np.std(gene_numbers)
-    gene_numbers_normalized = (gene_numbers - gene_numbers_mean) / gene_numbers_std 
-
-    gene_num_2d_mean = np.mean(gene_num_2d)
-    gene_num_2d_std = np.std(gene_num_2d)
-    gene_num_2d_normalized = (gene_num_2d - gene_num_2d_mean) / gene_num_2d_std
-
-    # 3. Create a Custom Dataset
-    print("Creating dataset...")
-    class TumorDataset(Dataset):
-        def __init__(self, features_count, features_gene_idx, labels):
-            self.features_count = features_count
-            self.features_idx = features_gene_idx
-            self.labels = labels
-
-        def __len__(self):
-            return len(self.labels)
-
-        def __getitem__(self, idx):
-            sample_feature1 = self.features_count[idx]
-            sample_feature2 = self.features_idx[idx]
-            label = self.labels[idx]
-            return sample_feature1, sample_feature2, label
-
-    # 4. Split Dataset
+    with phase_or_null(report, "column_loop"):
+        data = []
+        feature_num = {}
+        for col in df.columns:
+            label = col[0]  # First level of the MultiIndex is the class name
+            features = df[col].values
+            data.append((features, label))
+            if label not in feature_num:
+                feature_num[label] = 0
+            else:
+                feature_num[label] += 1
+        # Separate features and labels
+        features, labels = zip(*data)
+        features = np.array(features)
+    with phase_or_null(report, "nan_fill"):
+        # Find NaN values
+        nan_mask = np.isnan(features)
+        # Replace NaN values with 0
+        features[nan_mask] = 0
+    with phase_or_null(report, "label_mapping"):
+        # Create a set of unique labels and sort it to maintain consistency
+        unique_labels = sorted(set(labels))
+
+        # Create a mapping dictionary from label to number
+        label_to_number = {label: num for num, label in enumerate(unique_labels)}
+
+        # Map your labels to numbers
+        numerical_labels = [label_to_number[label] for label in labels]
+
+        # To get the reverse mapping (from number to label), you can use:
+        number_to_label = {num: label for label, num in label_to_number.items()}
+
+        labels = np.array(numerical_labels)
+        feature_num = {label_to_number[key]: value for key, value in feature_num.items() if key in label_to_number}
+
+    with phase_or_null(report, "normalize"):
+        features_mean = np.mean(features)
+        features_std = np.std(features)
+        features_normalized = (features - features_mean) / features_std
+    if preprocess_info_path is not None:
+        save_preprocess_info(preprocess_info_path, gene_names, features_mean, features_std, number_to_label)
+
+    # 3. Split Dataset
+    # splitting row indices gives the same partition as splitting the arrays themselves
     print("Splitting dataset...")
-    X_train, X_temp, y_train, y_temp = train_test_split(features_normalized, labels, test_size=0.3, random_state=42, stratify=labels)  # feature normalization
-    X_val, X_test, y_val, y_test = train_test_split(X_temp, y_temp, test_size=0.5, random_state=42, stratify=y_temp)
-
-    # Ensuring the test set has equal number of samples for each class
-    class_counts = Counter(y_test)
-    min_class_count = min(class_counts.values())
-    indices = {label: np.where(y_test == label)[0][:min_class_count] for label in class_counts}
-    balanced_indices = np.concatenate(list(indices.values()))
-    X_test_balanced = [X_test[i] for i in balanced_indices]
-    y_test_balanced = [y_test[i] for i in balanced_indices]
-
-    gene_numbers_norm_tile_train = np.tile(gene_numbers_normalized, (X_train.shape[0], 1))
-    gene_numbers_norm_tile_val = np.tile(gene_numbers_normalized, (X_val.shape[0], 1))
-    gene_numbers_norm_tile_test = np.tile(gene_numbers_normalized, (len(X_test), 1))
-
-    gene_num_2d_norm_tile_train = np.tile(gene_num_2d_normalized, (X_train.shape[0], 1, 1))
-    gene_num_2d_norm_tile_val = np.tile(gene_num_2d_normalized, (X_val.shape[0], 1, 1))
-    gene_num_2d_norm_tile_test = np.tile(gene_num_2d_normalized, (len(X_test), 1, 1))
-    # Create PyTorch Datasets
-    train_dataset = TumorDataset(X_train, gene_num_2d_norm_tile_train, y_train)
-    val_dataset = TumorDataset(X_val, gene_num_2d_norm_tile_val, y_val)
-    test_dataset = TumorDataset(X_test, gene_num_2d_norm_tile_test, y_test)
-
-    # 5. Create DataLoaders
+    with phase_or_null(report, "split"):
+        train_idx, temp_idx = train_test_split(np.arange(len(labels)), test_size=0.3, random_state=42, stratify=labels)
+        val_idx, test_idx = train_test_split(temp_idx, test_size=0.5, random_state=42, stratify=labels[temp_idx])
+
+    with phase_or_null(report, "gene_index"):
+        gene_idx = gene_index_2d(len(gene_names))
+
+    return {
+        "features": features_normalized,
+        "labels": labels,
+        "gene_idx": gene_idx,
+        "train_idx": train_idx,
+        "val_idx": val_idx,
+        "test_idx": test_idx,
+        "gene_number_name_mapping": gene_number_name_mapping,
+        "number_to_label": number_to_label,
+        "feature_num": feature_num,
+    }
+
+def make_loaders(data, batch_size=8, Multi_gpu_flag=False, num_workers=None, report=None):
+    # every sample shares one (n_genes, 2) coordinate array instead of a tiled copy
+    print("Creating dataset...")
+    with phase_or_null(report, "datasets"):
+        train_dataset = TumorDataset(data["features"], data["gene_idx"], data["labels"], data["train_idx"])
+        val_dataset = TumorDataset(data["features"], data["gene_idx"], data["labels"], data["val_idx"])
+        test_dataset = TumorDataset(data["features"], data["gene_idx"], data["labels"], data["test_idx"])
+
     print("Creating dataloaders...")
-    if Multi_gpu_flag:
-        train_sampler = DistributedSampler(dataset = train_dataset, shuffle=True)
-        val_sampler = DistributedSampler(dataset = val_dataset, shuffle=True)
-        test_sampler = DistributedSampler(dataset = test_dataset, shuffle=True)
-        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=False, sampler=train_sampler, num_workers=32, pin_memory=True)
-        val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, sampler=None, num_workers=32, pin_memory=True)
-        test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, sampler=None, num_workers=32, pin_memory=True)
-    else:
-        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-        val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
-        test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
-
-    return gene_number_name_mapping, number_to_label,feature_num, train_loader, val_loader, test_loader
+    # the train order depends only on (seed, epoch) so training can resume mid-epoch,
+    # and the loader draws worker seeds from its own generator instead of the global RNG
+    with phase_or_null(report, "dataloaders"):
+        if Multi_gpu_flag:
+            num_workers = 32 if num_workers is None else num_workers
+            train_sampler = ResumableDistributedSampler(dataset = train_dataset, shuffle=True, seed=42)
+            train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=False, sampler=train_sampler, num_workers=num_workers, pin_memory=torch.cuda.is_available(), generator=torch.Generator())
+            # each rank evaluates a disjoint part of val/test; the confusion matrices are summed across ranks
+            val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, sampler=DistributedEvalSampler(val_dataset), num_workers=num_workers, pin_memory=torch.cuda.is_available())
+            test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, sampler=DistributedEvalSampler(test_dataset), num_workers=num_workers, pin_memory=torch.cuda.is_available())
+        else:
+            num_workers = 0 if num_workers is None else num_workers
+            train_sampler = ResumableRandomSampler(train_dataset, seed=42)
+            train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=False, sampler=train_sampler, num_workers=num_workers, generator=torch.Generator())
+            val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+            test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    return train_loader, val_loader, test_loader
+
+def load_data(file_path, batch_size=8, Multi_gpu_flag=False, preprocess_info_path=None, num_workers=None, report=None, report_path=None):
+    """report: a PhaseReport to fill with per-phase time and memory. report_path: write
+    such a report (a new one unless `report` is given) as JSON there and print its table."""
+    if report is None and report_path is not None:
+        report = PhaseReport()
+    data = prepare_data(file_path, preprocess_info_path=preprocess_info_path, report=report)
+    train_loader, val_loader, test_loader = make_loaders(data, batch_size=batch_size, Multi_gpu_flag=Multi_gpu_flag, num_workers=num_workers, report=report)
+    if report_path is not None:
+        report.close()
+        print(report.summary())
+        report.to_json(report_path)
+    return data["gene_number_name_mapping"], data["number_to_label"], data["feature_num"], train_loader, val_loader, test_loader
 
 if __name__ == '__main__':
     # Check the data loader.
@@ -1,324 +1,296 @@
 #%%
-from dataloader import load_data
-from models import *
-import torch.optim as optim
-import torch.nn.functional as F
-import torch
-from sklearn.metrics import confusion_matrix
-from hook_register import *
-from utils import find_expressed_genes
-# data_dir = f"/isilon/datalake/cialab/original/cialab/image_database/d00154/Tumor_gene_counts/training_data_6_tumors.csv"
-# batch_size = 8
-# max_epoch = 250
-# feature_transform = False
-# eval_interval = 1
-# atention_pooling_flag = False
-# outf = "/isilon/datalake/cialab/scratch/cialab/Hao/work_record/Project1_GM/codes/Point_cloud_gene_expression/saved_models"
-# gene_space_dim = 3
-#%%
-data_dir = f"/isilon/datalake/cialab/original/cialab/image_database/d00154/Tumor_gene_counts/All_countings/training_data_17_tumors_31_classes.csv"
-batch_size = 4
-max_epoch = 50
-feature_transform = False
-eval_interval = 2
-atention_pooling_flag = True
-outf = "/isilon/datalake/cialab/scratch/cialab/Hao/work_record/Project1_GM/codes/Point_cloud_gene_expression/17_tumors_31_classes_saved_models"
-gene_space_dim = 3
-# LOSS_SELECT = 'CE' # 'CE' or 'NLL'
-# WEIGHT_LOSS_FLAG = True
-# MULTI_GPU_FLAG = True
-# pre_trained = True
-lr=0.001
-
-gene_number_name_mapping, number_to_label,feature_num, train_loader, val_loader, test_loader = load_data(file_path=data_dir, batch_size=batch_size)
-
-class_num = len(number_to_label.keys())
-#%%
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
-
-
-
-# best_val_acc = 0
-# best_val_idx = 0
-# confusion_matrix_all_best = []
-# for model_idx in range(50):
-model = PointNetCls(gene_idx_dim = 2, 
-                gene_space_num = gene_space_dim, 
-                class_num=class_num, 
-                feature_transform=feature_transform, 
-                atention_pooling_flag = atention_pooling_flag)
-if device == torch.device("cpu"):
-    model_state_dict = torch.load(outf+f"/cls_model_geneSpaceD_3_transfeat_False_attenpool_True_pretrain_best.pth", map_location=torch.device('cpu'))
-else:
-    model_state_dict = torch.load(outf+f"/cls_model_geneSpaceD_3_transfeat_False_attenpool_True_pretrain_best.pth")
-
-# model.load_state_dict(model_state_dict)
-from collections import OrderedDict
-new_state_dict = OrderedDict()
-for k, v in model_state_dict.items():
-    name = k[7:]  # remove `module.` prefix
-    new_state_dict[name] = v
-model.load_state_dict(new_state_dict)
-model.to(device)
-#%%
+# Evaluation of a trained GPNet model and analysis of its gene token space.
+#
+#   eval:    test accuracy and confusion matrix, then the attention score of every
+#            gene aggregated per class over the train loader (attention_scores.py),
+#            and the top genes per class
+#   cluster: Leiden clusters of the learned gene token space (GSNet output) of the
+#            expressed genes, a t-SNE plot and one gene list per cluster
+#   closest: the genes closest to reference genes in the token space (gene_index.py)
+#   capture: stream layer outputs over a whole split to .npy files (hook_register.ActivationCapture)
+#
+# Only torch and numpy are imported at module level; scipy, leidenalg, igraph,
+# matplotlib, sklearn and tqdm are imported by the step that needs them.
+#
+#   python eval_best_model.py eval --state_dict <best.pth>
+#   python eval_best_model.py cluster --state_dict <best.pth>
+import argparse
+import os
+from collections import defaultdict
 
-total_correct = 0
-total_testset = 0
-confusion_matrix_all = np.zeros((class_num, class_num))
+import numpy as np
+import torch
 
-for i,data in enumerate(test_loader, 0):
-    features1_count, features2_gene_idx, labels = data
-    features1_count, features2_gene_idx = transpose_input(features1_count, features2_gene_idx)
-    features1_count, features2_gene_idx, labels = features1_count.to(device), features2_gene_idx.to(device), labels.to(device)
-    with torch.no_grad():
-        model = model.eval()
-        pred, _, _ = model(features1_count,features2_gene_idx)
-        pred_choice = pred.data.max(1)[1]
-        correct = torch.sum(pred_choice == labels)
-        total_correct += correct.item()
-        total_testset += features1_count.shape[0]
-
-        pred_labels_np = pred_choice.cpu().numpy()
-        labels_np = labels.cpu().numpy()
-        for idx_batch in range(labels_np.shape[0]):
-            label_i = labels_np[idx_batch]
-            pred_i = pred_labels_np[idx_batch]
-            confusion_matrix_all[label_i,pred_i] += 1
-    # print("accuracy {}".format(correct.item()/float(batch_size)))
-print("final accuracy {}".format(total_correct / float(total_testset)))
-print(confusion_matrix_all)
-
-# # Move the model to CPU and delete it
-# model.to('cpu')
-# del model
-# torch.cuda.empty_cache()  # Clear CUDA cache
-result_dir = '/isilon/datalake/cialab/scratch/cialab/Hao/work_record/Project1_GM/codes/Point_cloud_gene_expression/results'
-np.save(result_dir+f"/confusion_matrix.npy", confusion_matrix_all)
-
-
-
-# %%
-# hook register
-activation={}
-layer_name_list = ['gstn', ['feat','atention_pooling']]
-Hook_register(model, layer_name_list, activation)
-for i,data in enumerate(test_loader, 0):
+from dataloader import load_data
+from attention_scores import aggregate_attention
+from gene_clusters import cluster_genes, resolution_sweep
+from gene_graph import radius_edges
+from gene_index import GeneIndex
+from hook_register import REDUCTIONS, ActivationCapture, Hook_register
+from metrics import ConfusionMatrixMeter
+from models import PointNetCls, transpose_input
+from utils import find_expressed_genes, strip_ddp_prefix
+
+DATA_DIR = "/isilon/datalake/cialab/original/cialab/image_database/d00154/Tumor_gene_counts/All_countings/training_data_17_tumors_31_classes.csv"
+OUTF = "/isilon/datalake/cialab/scratch/cialab/Hao/work_record/Project1_GM/codes/Point_cloud_gene_expression/17_tumors_31_classes_saved_models"
+STATE_DICT = OUTF + "/cls_model_geneSpaceD_3_transfeat_False_attenpool_True_pretrain_best.pth"
+RESULT_DIR = "/isilon/datalake/cialab/scratch/cialab/Hao/work_record/Project1_GM/codes/Point_cloud_gene_expression/results"
+
+
+def load_model(state_dict_path, class_num, device, gene_space_dim=3, feature_transform=False, atention_pooling_flag=True):
+    model = PointNetCls(gene_idx_dim = 2,
+                        gene_space_num = gene_space_dim,
+                        class_num=class_num,
+                        feature_transform=feature_transform,
+                        atention_pooling_flag = atention_pooling_flag)
+    model_state_dict = torch.load(state_dict_path, map_location=torch.device('cpu'))
+    model.load_state_dict(strip_ddp_prefix(model_state_dict))
+    return model.to(device).eval()
+
+
+def model_inputs(data, device):
     features1_count, features2_gene_idx, labels = data
     features1_count, features2_gene_idx = transpose_input(features1_count, features2_gene_idx)
-    features1_count, features2_gene_idx, labels = features1_count.to(device), features2_gene_idx.to(device), labels.to(device)
-    model = model.eval()
-    pred, _, _ = model(features1_count,features2_gene_idx)
-    break
-print(activation)
-#%% deal with the gene token space first.
-gene_token_space = activation['gstn'].cpu().numpy()[0,:,:]
-gene_token_space = gene_token_space.T
-np.save(result_dir+f"/gene_token_space.npy", gene_token_space)
-
-# 1. get rid of the zero gene tokens
-file_path = f"/isilon/datalake/cialab/original/cialab/image_database/d00154/Tumor_gene_counts/All_countings/training_data_17_tumors_31_classes.csv"
-expressed_genes = find_expressed_genes(file_path)
-gene_token_space = gene_token_space[expressed_genes,:]
-gene_list = []
-for gene_idx in range(len(expressed_genes)):
-    if expressed_genes[gene_idx]:
-        gene_list.append(gene_number_name_mapping[gene_idx])
+    return features1_count.to(device), features2_gene_idx.to(device), labels.to(device)
 
-#%%
-# 2. cluster the gene token space (unsupervised Leiden clustering).
-from scipy.spatial.distance import pdist, squareform
-distance_matrix = squareform(pdist(gene_token_space))
-
-import networkx as nx
-
-threshold_distance = 0.2  # Set a threshold for edge creation
-G = nx.Graph()
-# First, add all points as nodes
-for i in range(len(gene_token_space)):
-    G.add_node(i)
-
-for i in range(len(gene_token_space)):
-    for j in range(i + 1, len(gene_token_space)):
-        if distance_matrix[i, j] < threshold_distance:
-            G.add_edge(i, j)
-
-import leidenalg
-import igraph as ig
-
-# # Convert networkx graph to igraph
-# igraph_G = ig.Graph.from_networkx(G)
-
-# # Apply Leiden algorithm
-# partition = leidenalg.find_partition(igraph_G, leidenalg.ModularityVertexPartition)
-
-# # Get cluster labels
-# clusters = partition.membership
-
-def apply_leiden_to_subgraph(graph, nodes, partition_type=leidenalg.ModularityVertexPartition, max_size=2000):
-    subgraph = graph.subgraph(nodes)
-    partition = leidenalg.find_partition(subgraph, partition_type)
-    return [[nodes[node] for node in cluster] for cluster in partition]
-
-# Function to ensure all clusters are within the max size limit
-def ensure_max_cluster_size(graph, initial_partition, max_cluster_size=2000):
-    final_clusters = []
-    for cluster in initial_partition:
-        if len(cluster) > max_cluster_size:
-            # If the cluster is too large, reapply Leiden to this cluster
-            sub_clusters = apply_leiden_to_subgraph(graph, cluster)
-            final_clusters.extend(sub_clusters)
-        else:
-            final_clusters.append(cluster)
-    return final_clusters
-
-# Convert networkx graph to igraph
-igraph_G = ig.Graph.from_networkx(G)
-
-# Apply Leiden algorithm
-initial_partition = leidenalg.find_partition(igraph_G, leidenalg.ModularityVertexPartition)
-initial_clusters = [cluster for cluster in initial_partition]
-
-# Ensure max cluster size
-final_clusters = ensure_max_cluster_size(igraph_G, initial_clusters, max_cluster_size=2000)
-clusters = [0]*len(gene_token_space)
-for cluster_idx in range(len(final_clusters)):
-    for gene_idx in final_clusters[cluster_idx]:
-        clusters[gene_idx] = cluster_idx
-# %% plot the gene token space
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from sklearn.manifold import TSNE
-from sklearn.decomposition import PCA
-
-
-
-tsne = TSNE(n_components=2,init='pca',random_state=0)
-
-gene_token_space_2d = tsne.fit_transform(gene_token_space)
-
-fig = plt.figure()
-# ax = fig.add_subplot(111, projection='3d')
-ax = fig.add_subplot(111)
-scatter = ax.scatter(gene_token_space_2d[:,0],
-                      gene_token_space_2d[:,1],
-                        c=clusters,
-                        cmap='Spectral',
-                          marker='o',
-                          s=0.5,)
-# # Choose a different colormap, adjust marker size and transparency
-# scatter = ax.scatter(gene_token_space[:, 0],  # X coordinates
-#                      gene_token_space[:, 1],  # Y coordinates
-#                      gene_token_space[:, 2],  # Z coordinates
-#                      c=clusters,              # Color by cluster label
-#                      cmap='Spectral',         # Different colormap
-#                      marker='o',              # Marker style
-#                      alpha=0.6,               # Transparency
-# )                   
-# Create a colorbar and legend
-cbar = plt.colorbar(scatter, ax=ax)
-cbar.set_label('Cluster Labels')
-
-# Improve labeling and add title
-ax.set_xlabel('TSNE X')
-ax.set_ylabel('TSNE Y')
-# ax.set_zlabel('Z Axis')
-ax.set_title('3D Scatter Plot with Improved Colors')
-
-# based on "gene_list, clusters" build gene cluster dictionary
-from collections import defaultdict
 
-# Assuming gene_list and clusters are defined
-# Example: gene_list = ['gene_name0', 'gene_name1', ...]
-#          clusters = ['cluster_label0', 'cluster_label1', ...]
-#%%
-# Group genes by cluster
-clustered_genes = defaultdict(list)
-for gene, cluster in zip(gene_list, clusters):
-    clustered_genes[cluster].append(gene)
-
-# Write to text files
-for cluster, genes in clustered_genes.items():
-    if len(genes) > 10:  # Check if the cluster has more than 10 genes
-        with open(f"./results/clusters/{cluster}.txt", "w") as file:
-            for gene in genes:
-                file.write(gene + "\n")
-# %%
-import tqdm
-gene_score = activation['feat.atention_pooling'].cpu().numpy()[0,:,:]
-gene_score_sum = np.zeros((gene_score.shape[0],class_num))
-gene_score_class_count = np.zeros(class_num)
-confusion_matrix_all_test_here = np.zeros((class_num, class_num))
-
-for i,data in tqdm.tqdm(enumerate(train_loader, 0)):
-    features1_count, features2_gene_idx, labels = data
-    features1_count, features2_gene_idx = transpose_input(features1_count, features2_gene_idx)
-    features1_count, features2_gene_idx, labels = features1_count.to(device), features2_gene_idx.to(device), labels.to(device)
-    model = model.eval()
-    pred, _, _ = model(features1_count,features2_gene_idx)
-    pred_choice = pred.data.max(1)[1]
-    correct = (pred_choice == labels)
-
-    gene_score = activation['feat.atention_pooling'].cpu().numpy()
-    pred_labels_np = pred_choice.cpu().numpy()
-    labels_np = labels.cpu().numpy()
-
-    for idx_batch in range(labels_np.shape[0]):
-        label_i = labels_np[idx_batch]
-        pred_i = pred_labels_np[idx_batch]
-        # if correct[idx_batch]:
-        gene_score_sum[:,label_i] += gene_score[idx_batch,:,0]
-        gene_score_class_count[label_i] += 1
-        confusion_matrix_all_test_here[label_i,pred_i] += 1
-
-np.save(result_dir+f"/gene_score_sum.npy", gene_score_sum)
-np.save(result_dir+f"/gene_score_class_count.npy", gene_score_class_count)
-print(confusion_matrix_all_test_here)
-np.save(result_dir+f"/confusion_matrix_all_test_here.npy", confusion_matrix_all_test_here)
-# %%
-gene_score_sum = np.load(result_dir+"/gene_score_sum.npy")
-gene_score_class_count = np.load(result_dir+"/gene_score_class_count.npy")
-
-gene_score_mean = gene_score_sum / gene_score_class_count
-
-# Find the indices of the top 20 largest numbers in each column
-top_20_indices = np.argsort(-gene_score_mean, axis=0)[:20]
-important_genes_all_class = []
-with open(f"./results/important_genes.txt", "w") as file:
-    for i in range(class_num):
-        print(f"Top 20 genes for class {i}:")
-        file.write(f"Top 20 genes for class {i}:\n")
-        impartant_gene = []
-        for j in range(20):
-            print(gene_number_name_mapping[top_20_indices[j, i]], end=" ")
-            file.write(gene_number_name_mapping[top_20_indices[j, i]]+" ")
-            impartant_gene.append(gene_number_name_mapping[top_20_indices[j, i]])
-        file.write(f"\n")
-        important_genes_all_class.append(impartant_gene)
-        print()
-
-# %%
-gene_token_space = activation['gstn'].cpu().numpy()[0,:,:]
-gene_token_space = gene_token_space.T
-
-distance_matrix = squareform(pdist(gene_token_space))
-# Assuming distance_matrix is already defined and gene_token_space is a numpy array
-# For example, distance_matrix = squareform(pdist(gene_token_space))
-
-gene_index = 12054  # The index of your reference gene
-
-# Get the distances from gene 12054 to all other genes
-distances_to_gene = distance_matrix[gene_index]
-
-# Set the distance to itself as infinity to ignore it
-distances_to_gene[gene_index] = np.inf
-
-# Get the indices of the top 5 smallest distances
-top_20_closest_indices = np.argsort(distances_to_gene)[:20]
-
-print("Top 5 genes closest to gene 12054:", top_20_closest_indices)
-top_20_closet_genes = []
-for idx in top_20_closest_indices:
-    top_20_closet_genes.append(gene_number_name_mapping[idx])
-    print(gene_number_name_mapping[idx], end=" ")
-# %%
+def evaluate(model, loader, class_num, device):
+    test_meter = ConfusionMatrixMeter(class_num, device)
+    with torch.no_grad():
+        for data in loader:
+            features1_count, features2_gene_idx, labels = model_inputs(data, device)
+            pred, _, _, _ = model(features1_count, features2_gene_idx)
+            test_meter.update(torch.argmax(pred, dim=1), labels)
+    confusion_matrix_all = test_meter.compute()
+    print("final accuracy {}".format(test_meter.accuracy(confusion_matrix_all)))
+    print(confusion_matrix_all)
+    return confusion_matrix_all
+
+
+def gene_token_space(model, loader, device):
+    """(n_genes, gene_space_dim) GSNet output; the gene index is the same for every sample."""
+    handles = []
+    activation = Hook_register(model, ['gstn'], {}, handles)
+    features1_count, features2_gene_idx, _ = model_inputs(next(iter(loader)), device)
+    with torch.no_grad():
+        model(features1_count, features2_gene_idx)
+    for handle in handles:
+        handle.remove()
+    return activation['gstn'].cpu().numpy()[0, :, :].T
+
+
+def expressed_gene_space(gene_space, file_path, gene_number_name_mapping):
+    # drop the genes that are barely expressed in the cohort
+    expressed_genes = np.asarray(find_expressed_genes(file_path))
+    gene_list = [gene_number_name_mapping[gene_idx] for gene_idx in np.flatnonzero(expressed_genes)]
+    return gene_space[expressed_genes, :], gene_list
+
+
+def plot_tsne(points, clusters, path=None):
+    import matplotlib.pyplot as plt
+    from sklearn.manifold import TSNE
+
+    tsne = TSNE(n_components=2,init='pca',random_state=0)
+    points_2d = tsne.fit_transform(points)
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    scatter = ax.scatter(points_2d[:,0],
+                         points_2d[:,1],
+                         c=clusters,
+                         cmap='Spectral',
+                         marker='o',
+                         s=0.5,)
+    # Create a colorbar and legend
+    cbar = plt.colorbar(scatter, ax=ax)
+    cbar.set_label('Cluster Labels')
+
+    # Improve labeling and add title
+    ax.set_xlabel('TSNE X')
+    ax.set_ylabel('TSNE Y')
+    ax.set_title('3D Scatter Plot with Improved Colors')
+    if path is not None:
+        fig.savefig(path, dpi=300)
+    return fig
+
+
+def write_clusters(gene_list, clusters, out_dir, min_genes=10):
+    # Group genes by cluster
+    clustered_genes = defaultdict(list)
+    for gene, cluster in zip(gene_list, clusters):
+        clustered_genes[cluster].append(gene)
+
+    # Write to text files
+    os.makedirs(out_dir, exist_ok=True)
+    for cluster, genes in clustered_genes.items():
+        if len(genes) > min_genes:
+            with open(f"{out_dir}/{cluster}.txt", "w") as file:
+                for gene in genes:
+                    file.write(gene + "\n")
+    return clustered_genes
+
+
+def top_genes(top_indices, gene_number_name_mapping, path=None):
+    # top_indices: (class_num, k) gene numbers, highest mean attention first
+    k = top_indices.shape[1]
+    important_genes_all_class = [[gene_number_name_mapping[j] for j in row] for row in top_indices]
+    if path is not None:
+        with open(path, "w") as file:
+            for i, genes in enumerate(important_genes_all_class):
+                file.write(f"Top {k} genes for class {i}:\n")
+                file.write(" ".join(genes) + " \n")
+    for i, genes in enumerate(important_genes_all_class):
+        print(f"Top {k} genes for class {i}:")
+        print(" ".join(genes))
+    return important_genes_all_class
+
+
+def setup(args):
+    device = torch.device(args.device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    gene_number_name_mapping, number_to_label, feature_num, train_loader, val_loader, test_loader = load_data(file_path=args.data_dir, batch_size=args.batch_size)
+    class_num = len(number_to_label.keys())
+    model = load_model(args.state_dict, class_num, device, gene_space_dim=args.gene_space_dim,
+                       feature_transform=args.feature_transform, atention_pooling_flag=not args.no_attention)
+    os.makedirs(args.result_dir, exist_ok=True)
+    return device, model, class_num, gene_number_name_mapping, train_loader, test_loader
+
+
+def run_eval(args):
+    device, model, class_num, gene_number_name_mapping, train_loader, test_loader = setup(args)
+    confusion_matrix_all = evaluate(model, test_loader, class_num, device)
+    np.save(args.result_dir+f"/confusion_matrix.npy", confusion_matrix_all)
+    if args.no_attention:
+        return
+    import tqdm
+    aggregator, confusion_matrix_all_test_here = aggregate_attention(model, tqdm.tqdm(train_loader), class_num, device,
+                                                                     second_moment=args.score_std)
+    # same layout as before: (n_genes, class_num) sums and the samples per class
+    np.save(args.result_dir+f"/gene_score_sum.npy", aggregator.sums.T.cpu().numpy())
+    np.save(args.result_dir+f"/gene_score_class_count.npy", aggregator.counts.cpu().numpy().astype(np.float64))
+    if args.score_std:
+        np.save(args.result_dir+f"/gene_score_std.npy", aggregator.std().T.cpu().numpy())
+    print(confusion_matrix_all_test_here)
+    np.save(args.result_dir+f"/confusion_matrix_all_test_here.npy", confusion_matrix_all_test_here)
+    top_indices, _ = aggregator.top_k(args.top_k)
+    top_genes(top_indices.cpu().numpy(), gene_number_name_mapping, path=args.important_genes)
+
+
+def run_cluster(args):
+    device, model, class_num, gene_number_name_mapping, train_loader, test_loader = setup(args)
+    gene_space = gene_token_space(model, test_loader, device)
+    np.save(args.result_dir+f"/gene_token_space.npy", gene_space)
+    gene_space, gene_list = expressed_gene_space(gene_space, args.data_dir, gene_number_name_mapping)
+    edges = radius_edges(gene_space, args.threshold_distance)
+    print(f"{len(gene_space)} genes, {len(edges)} edges below distance {args.threshold_distance}")
+    if args.resolutions:
+        rows = resolution_sweep(len(gene_space), edges, args.resolutions, max_cluster_size=args.max_cluster_size,
+                                max_rounds=args.max_rounds, workers=args.workers)
+        for row in rows:
+            np.save(args.result_dir+f"/gene_clusters_resolution_{row['resolution']}.npy", row["labels"])
+        clusters = rows[0]["labels"]
+    else:
+        clusters = cluster_genes(len(gene_space), edges, max_cluster_size=args.max_cluster_size,
+                                 max_rounds=args.max_rounds, workers=args.workers)
+    if args.plot:
+        plot_tsne(gene_space, clusters, path=args.result_dir+"/gene_token_space_tsne.png")
+    write_clusters(gene_list, clusters, args.cluster_dir)
+
+
+def run_closest(args):
+    if args.index and os.path.exists(args.index):
+        # a saved index answers without the data or the model
+        index = GeneIndex.load(args.index)
+    else:
+        device, model, class_num, gene_number_name_mapping, train_loader, test_loader = setup(args)
+        index = GeneIndex.from_model(model, gene_number_name_mapping)
+        if args.index:
+            index.save(args.index)
+    genes = [int(g) if g.isdigit() else g for g in args.genes]
+    indices, distances = index.query(genes, k=args.top_k, eps=args.eps)
+    for gene, row in zip(genes, indices):
+        print(f"Top {args.top_k} genes closest to gene {gene}:", row)
+        print(" ".join(index.gene_names[row]))
+
+
+def run_capture(args):
+    device, model, class_num, gene_number_name_mapping, train_loader, test_loader = setup(args)
+    loader = {'train': train_loader, 'test': test_loader}[args.split]
+    layers = [layer.split('.') if '.' in layer else layer for layer in args.layers]
+    with ActivationCapture(model, layers, args.capture_dir, reduce=args.reduce, dim=args.dim, k=args.top_k,
+                           class_num=class_num, max_buffer_mb=args.max_buffer_mb) as capture:
+        manifest = capture.run(loader, device)
+    for key, array in manifest["arrays"].items():
+        print(f"{key}: {array['shape']} -> {args.capture_dir}/{array['file']}")
+
+
+def add_common_args(p):
+    p.add_argument('--data_dir', default=DATA_DIR, type=str)
+    p.add_argument('--state_dict', default=STATE_DICT, type=str)
+    p.add_argument('--result_dir', default=RESULT_DIR, type=str)
+    p.add_argument('--batch_size', default=4, type=int)
+    p.add_argument('--gene_space_dim', default=3, type=int)
+    p.add_argument('--feature_transform', action='store_true')
+    p.add_argument('--no_attention', action='store_true', help='The model was trained without attention pooling.')
+    p.add_argument('--device', default=None, type=str)
+    return p
+
+
+def add_eval_args(p):
+    add_common_args(p)
+    p.add_argument('--top_k', default=20, type=int, help='Genes listed per class.')
+    p.add_argument('--important_genes', default='./results/important_genes.txt', type=str)
+    p.add_argument('--score_std', action='store_true', help='Also save the per-class standard deviation of the attention scores.')
+    return p
+
+
+def add_cluster_args(p):
+    add_common_args(p)
+    p.add_argument('--threshold_distance', default=0.2, type=float, help='Genes closer than this are connected.')
+    p.add_argument('--max_cluster_size', default=2000, type=int, help='Larger clusters are split again.')
+    p.add_argument('--max_rounds', default=1, type=int, help='Times oversized clusters are split again.')
+    p.add_argument('--workers', default=None, type=int, help='Processes splitting oversized clusters (default: all cores).')
+    p.add_argument('--resolutions', nargs='*', type=float, default=None,
+                   help='Cluster at each of these resolutions and save every labelling; the gene lists use the first one.')
+    p.add_argument('--cluster_dir', default='./results/clusters', type=str)
+    p.add_argument('--plot', action='store_true', help='Also save a t-SNE plot of the clusters.')
+    return p
+
+
+def add_closest_args(p):
+    add_common_args(p)
+    p.add_argument('--genes', nargs='+', default=['12054'], help='Reference gene names or numbers.')
+    p.add_argument('--top_k', default=20, type=int)
+    p.add_argument('--eps', default=0.0, type=float, help='> 0 for an approximate search.')
+    p.add_argument('--index', default=None, type=str, help='Load the nearest-gene index from here, or save it here if missing.')
+    return p
+
+
+def add_capture_args(p):
+    add_common_args(p)
+    p.add_argument('--layers', nargs='+', default=['gstn', 'feat.atention_pooling'], help='Layers to capture, e.g. feat.atention_pooling.')
+    p.add_argument('--split', default='test', choices=['train', 'test'])
+    p.add_argument('--reduce', default='none', choices=REDUCTIONS)
+    p.add_argument('--dim', default=None, type=int,
+                   help='Axis of each sample\'s layer output that mean/topk reduce, batch axis not counted (default: its longest axis, the genes).')
+    p.add_argument('--top_k', default=20, type=int)
+    p.add_argument('--max_buffer_mb', default=256, type=float, help='Host memory for captured outputs before they are written out.')
+    p.add_argument('--capture_dir', default='./results/activations', type=str)
+    return p
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Evaluate a trained GPNet model and analyse its gene token space')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_eval_args(subparsers.add_parser('eval'))
+    add_cluster_args(subparsers.add_parser('cluster'))
+    add_closest_args(subparsers.add_parser('closest'))
+    add_capture_args(subparsers.add_parser('capture'))
+    return parser
+
+
+COMMANDS = {'eval': run_eval, 'cluster': run_cluster, 'closest': run_closest, 'capture': run_capture}
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    COMMANDS[args.command](args)
@@ -0,0 +1,205 @@
+#%%
+# ONNX export and onnxruntime scoring for PointNetCls.
+#
+# usage:
+#   python export_onnx.py export --state_dict <best.pth> --onnx cls.onnx --class_num 10 --snet --tnet --feature_transform
+#   python export_onnx.py score --onnx cls.onnx --data_dir <csv> --threads 8
+#   python export_onnx.py parity --gene_num 512
+import argparse
+import itertools
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from models import PointNetCls
+from utils import strip_ddp_prefix
+
+INPUT_NAMES = ['x_feature', 'x_gene_idx']
+OUTPUT_NAMES = ['logits']
+FLAG_NAMES = ['snet_flag', 'tnet_flag', 'feature_transform', 'atention_pooling_flag', 'encoder_flag']
+
+
+class LogitsOnly(nn.Module):
+    # PointNetCls also returns the transforms used by the regularizers, which are
+    # not needed for inference
+    def __init__(self, model):
+        super(LogitsOnly, self).__init__()
+        self.model = model
+
+    def forward(self, x_feature, x_gene_idx):
+        return self.model(x_feature, x_gene_idx)[0]
+
+
+def example_inputs(batch_size, gene_num, gene_idx_dim=2):
+    x_feature = torch.rand(batch_size, 1, gene_num)
+    x_gene_idx = torch.rand(batch_size, gene_idx_dim, gene_num)
+    return x_feature, x_gene_idx
+
+
+def export_pointnet_onnx(model, onnx_path, gene_num, opset_version=17):
+    """Exports a PointNetCls to ONNX with a dynamic batch axis.
+
+    Args:
+        model: PointNetCls, any flag combination.
+        onnx_path: Output file.
+        gene_num: Number of genes (points) the model was built with.
+    """
+    model = model.cpu().eval()
+    wrapper = LogitsOnly(model).eval()
+    # batch of 2 so BatchNorm/view shapes are not specialised to a single sample
+    inputs = example_inputs(2, gene_num)
+    dynamic_axes = {name: {0: 'batch'} for name in INPUT_NAMES + OUTPUT_NAMES}
+    with torch.no_grad():
+        torch.onnx.export(wrapper, inputs, onnx_path,
+                          input_names=INPUT_NAMES,
+                          output_names=OUTPUT_NAMES,
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset_version,
+                          do_constant_folding=True)
+    return onnx_path
+
+
+class OnnxScorer:
+    def __init__(self, onnx_path, num_threads=1, inter_op_threads=1):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+    def predict_logits(self, x_feature, x_gene_idx):
+        # inputs are (B, 1, N) and (B, 2, N), as produced by transpose_input
+        feeds = {
+            'x_feature': np.ascontiguousarray(x_feature, dtype=np.float32),
+            'x_gene_idx': np.ascontiguousarray(x_gene_idx, dtype=np.float32),
+        }
+        return self.session.run(OUTPUT_NAMES, feeds)[0]
+
+
+def check_parity(model, onnx_path, gene_num, batch_sizes=(1, 5), num_threads=1, rtol=1e-3, atol=1e-4):
+    # different batch sizes than the one used for tracing check the dynamic axis
+    model = model.cpu().eval()
+    scorer = OnnxScorer(onnx_path, num_threads=num_threads)
+    max_diff = 0.0
+    for batch_size in batch_sizes:
+        x_feature, x_gene_idx = example_inputs(batch_size, gene_num)
+        with torch.inference_mode():
+            expected = model(x_feature, x_gene_idx)[0].numpy()
+        actual = scorer.predict_logits(x_feature.numpy(), x_gene_idx.numpy())
+        if actual.shape != expected.shape:
+            raise AssertionError(f"batch {batch_size}: onnx shape {actual.shape} != torch shape {expected.shape}")
+        np.testing.assert_allclose(actual, expected, rtol=rtol, atol=atol)
+        max_diff = max(max_diff, float(np.abs(actual - expected).max()))
+    return max_diff
+
+
+def build_model(args):
+    return PointNetCls(gene_idx_dim = 2,
+                       gene_space_num = args.gene_space_dim,
+                       class_num = args.class_num,
+                       snet_flag = args.snet,
+                       tnet_flag = args.tnet,
+                       feature_transform = args.feature_transform,
+                       atention_pooling_flag = args.attention,
+                       encoder_flag = not args.no_encoder,
+                       gene_num = args.gene_num)
+
+
+def run_export(args):
+    model = build_model(args)
+    if args.state_dict:
+        model_state_dict = torch.load(args.state_dict, map_location=torch.device('cpu'))
+        model.load_state_dict(strip_ddp_prefix(model_state_dict))
+    export_pointnet_onnx(model, args.onnx, args.gene_num, opset_version=args.opset)
+    print(f"exported to {args.onnx}")
+    max_diff = check_parity(model, args.onnx, args.gene_num, num_threads=args.threads)
+    print(f"parity check passed, max abs diff {max_diff:.2e}")
+
+
+def run_score(args):
+    from dataloader import load_data
+    from models import transpose_input
+    _, _, _, _, _, test_loader = load_data(file_path=args.data_dir, batch_size=args.batch_size)
+    scorer = OnnxScorer(args.onnx, num_threads=args.threads)
+    total_correct = 0
+    total_testset = 0
+    all_logits = []
+    start = time.perf_counter()
+    for features1_count, features2_gene_idx, labels in test_loader:
+        features1_count, features2_gene_idx = transpose_input(features1_count, features2_gene_idx)
+        logits = scorer.predict_logits(features1_count.numpy(), features2_gene_idx.numpy())
+        total_correct += int((logits.argmax(axis=1) == labels.numpy()).sum())
+        total_testset += labels.shape[0]
+        all_logits.append(logits)
+    elapsed = time.perf_counter() - start
+    print(f"accuracy {total_correct / float(total_testset)}")
+    print(f"scored {total_testset} samples in {elapsed:.2f}s ({total_testset / elapsed:.1f} samples/s, {args.threads} threads)")
+    if args.out:
+        np.save(args.out, np.concatenate(all_logits))
+
+
+def run_parity(args):
+    # exports every flag combination at a small gene count and compares against torch
+    torch.manual_seed(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for flags in itertools.product([False, True], repeat=len(FLAG_NAMES)):
+            config = dict(zip(FLAG_NAMES, flags))
+            model = PointNetCls(gene_idx_dim = 2, gene_space_num = args.gene_space_dim,
+                                class_num = args.class_num, gene_num = args.gene_num, **config)
+            onnx_path = os.path.join(tmp_dir, 'model.onnx')
+            export_pointnet_onnx(model, onnx_path, args.gene_num, opset_version=args.opset)
+            max_diff = check_parity(model, onnx_path, args.gene_num, num_threads=args.threads)
+            print(f"{config} max abs diff {max_diff:.2e}")
+
+
+def add_model_args(p):
+    p.add_argument('--class_num', default=10, type=int)
+    p.add_argument('--gene_num', default=60660, type=int)
+    p.add_argument('--gene_space_dim', default=3, type=int)
+    p.add_argument('--opset', default=17, type=int)
+    p.add_argument('--threads', default=1, type=int, help='onnxruntime intra-op threads')
+    return p
+
+
+def add_export_args(p):
+    add_model_args(p)
+    p.add_argument('--state_dict', default=None, type=str)
+    p.add_argument('--onnx', required=True, type=str)
+    p.add_argument('--snet', action='store_true')
+    p.add_argument('--tnet', action='store_true')
+    p.add_argument('--feature_transform', action='store_true')
+    p.add_argument('--attention', action='store_true')
+    p.add_argument('--no_encoder', action='store_true')
+    return p
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='PointNetCls ONNX export and scoring')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    add_export_args(subparsers.add_parser('export'))
+
+    p_score = subparsers.add_parser('score')
+    p_score.add_argument('--onnx', required=True, type=str)
+    p_score.add_argument('--data_dir', required=True, type=str)
+    p_score.add_argument('--batch_size', default=60, type=int)
+    p_score.add_argument('--threads', default=1, type=int, help='onnxruntime intra-op threads')
+    p_score.add_argument('--out', default=None, type=str, help='npy file for the logits')
+
+    p_parity = subparsers.add_parser('parity')
+    add_model_args(p_parity)
+    p_parity.set_defaults(gene_num=512)
+    return parser
+
+
+COMMANDS = {'export': run_export, 'score': run_score, 'parity': run_parity}
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    COMMANDS[args.command](args)
@@ -0,0 +1,148 @@
+#%%
+# Leiden clustering of the gene radius graph (see gene_graph.py).
+#
+# The igraph graph is built straight from the (E, 2) edge array; no networkx
+# graph is built or converted. Clusters larger than max_cluster_size are
+# clustered again on their own induced subgraph. Those re-runs are independent,
+# so they go to a process pool, each worker getting only the edges of its
+# cluster. With max_rounds > 1 this repeats on whatever is still too large.
+# resolution_sweep() runs the whole thing for several resolutions.
+#
+# resolution=None uses ModularityVertexPartition, as before; a number uses
+# RBConfigurationVertexPartition (modularity with a resolution parameter).
+#
+#   python gene_clusters.py --edges edges.npy --n_nodes 60660 --resolutions 0.5 1 2
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def igraph_from_edges(n_nodes, edges):
+    import igraph as ig
+    return ig.Graph(n=n_nodes, edges=np.asarray(edges, dtype=np.int64).tolist(), directed=False)
+
+
+def leiden_membership(graph, resolution=None, seed=0):
+    import leidenalg
+    if resolution is None:
+        partition = leidenalg.find_partition(graph, leidenalg.ModularityVertexPartition, seed=seed)
+    else:
+        partition = leidenalg.find_partition(graph, leidenalg.RBConfigurationVertexPartition,
+                                             resolution_parameter=resolution, seed=seed)
+    # leidenalg numbers the clusters by decreasing size
+    return np.asarray(partition.membership, dtype=np.int64)
+
+
+def _refine_cluster(job):
+    # runs in a pool worker: Leiden on one cluster, given in local node numbers
+    n_nodes, local_edges, resolution, seed = job
+    return leiden_membership(igraph_from_edges(n_nodes, local_edges), resolution, seed)
+
+
+def split_oversized(labels, edges, max_cluster_size, resolution=None, seed=0, workers=None, frozen=()):
+    """Re-clusters every cluster above max_cluster_size on its own subgraph.
+
+    Sub-clusters take the place of the cluster they came from, so the numbering
+    follows the original cluster order. Returns (labels, ids of the clusters that
+    were too large but did not split any further).
+    """
+    sizes = np.bincount(labels)
+    big = np.setdiff1d(np.flatnonzero(sizes > max_cluster_size), np.asarray(frozen, dtype=np.int64))
+    if len(big) == 0:
+        return labels, list(frozen)
+
+    # intra-cluster edges of the big clusters, grouped by cluster
+    edge_labels = labels[edges[:, 0]]
+    keep = (edge_labels == labels[edges[:, 1]]) & np.isin(edge_labels, big)
+    cluster_edges, edge_labels = edges[keep], edge_labels[keep]
+    order = np.argsort(edge_labels, kind='stable')
+    cluster_edges, edge_labels = cluster_edges[order], edge_labels[order]
+    starts = np.searchsorted(edge_labels, big, side='left')
+    ends = np.searchsorted(edge_labels, big, side='right')
+
+    node_order = np.argsort(labels, kind='stable')
+    node_starts = np.concatenate([[0], np.cumsum(sizes)])
+    members, jobs = [], []
+    for cluster, lo, hi in zip(big, starts, ends):
+        nodes = node_order[node_starts[cluster]:node_starts[cluster + 1]]  # sorted node ids
+        members.append(nodes)
+        jobs.append((len(nodes), np.searchsorted(nodes, cluster_edges[lo:hi]), resolution, seed))
+
+    workers = min(workers or os.cpu_count(), len(jobs))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_refine_cluster, jobs))
+    else:
+        results = [_refine_cluster(job) for job in jobs]
+
+    # every old cluster becomes 1 or n_sub new ones, numbered in place
+    n_new = np.ones(len(sizes), dtype=np.int64)
+    for cluster, sub in zip(big, results):
+        n_new[cluster] = sub.max() + 1
+    base = np.concatenate([[0], np.cumsum(n_new)[:-1]])
+    new_labels = base[labels]
+    unsplit = []
+    for cluster, nodes, sub in zip(big, members, results):
+        new_labels[nodes] = base[cluster] + sub
+        if n_new[cluster] == 1:
+            unsplit.append(base[cluster])
+    # ids of earlier unsplittable clusters shift with the renumbering
+    unsplit += [base[c] for c in frozen]
+    return new_labels, unsplit
+
+
+def cluster_genes(n_nodes, edges, max_cluster_size=2000, resolution=None, seed=0, max_rounds=1, workers=None, graph=None):
+    """Cluster label per node. max_rounds=1 re-clusters oversized clusters once, as
+    ensure_max_cluster_size did; more rounds keep splitting what is still too large."""
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    graph = graph if graph is not None else igraph_from_edges(n_nodes, edges)
+    labels = leiden_membership(graph, resolution, seed)
+    frozen = []
+    for _ in range(max_rounds):
+        labels, frozen = split_oversized(labels, edges, max_cluster_size, resolution, seed, workers, frozen)
+        if np.all(np.bincount(labels) <= max_cluster_size):
+            break
+    return labels
+
+
+def resolution_sweep(n_nodes, edges, resolutions, max_cluster_size=2000, seed=0, max_rounds=1, workers=None):
+    """One clustering per resolution; the graph is built once."""
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    graph = igraph_from_edges(n_nodes, edges)
+    rows = []
+    for resolution in resolutions:
+        t0 = time.perf_counter()
+        labels = cluster_genes(n_nodes, edges, max_cluster_size, resolution, seed, max_rounds, workers, graph=graph)
+        sizes = np.bincount(labels)
+        rows.append({
+            "resolution": resolution,
+            "n_clusters": len(sizes),
+            "n_clusters_over_10": int((sizes > 10).sum()),
+            "largest": int(sizes.max()),
+            "modularity": graph.modularity(labels.tolist()),
+            "seconds": time.perf_counter() - t0,
+            "labels": labels,
+        })
+        print(f"resolution {resolution}: {rows[-1]['n_clusters']} clusters ({rows[-1]['n_clusters_over_10']} with more than 10 genes), "
+              f"largest {rows[-1]['largest']}, modularity {rows[-1]['modularity']:.4f}, {rows[-1]['seconds']:.1f}s")
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Leiden clustering of a gene radius graph')
+    parser.add_argument('--edges', required=True, type=str, help='(E, 2) edge list written by gene_graph.py.')
+    parser.add_argument('--n_nodes', required=True, type=int)
+    parser.add_argument('--resolutions', nargs='*', type=float, default=None, help='Default: plain modularity.')
+    parser.add_argument('--max_cluster_size', default=2000, type=int)
+    parser.add_argument('--max_rounds', default=1, type=int)
+    parser.add_argument('--workers', default=None, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--out', default=None, type=str, help='npz file with the labels of every resolution.')
+    args = parser.parse_args()
+    rows = resolution_sweep(args.n_nodes, np.load(args.edges), args.resolutions or [None], args.max_cluster_size,
+                            args.seed, args.max_rounds, args.workers)
+    if args.out:
+        np.savez(args.out, **{f"resolution_{row['resolution']}": row["labels"] for row in rows})
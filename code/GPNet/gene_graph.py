@@ -0,0 +1,71 @@
+#%%
+# Radius graph over the learned gene token space.
+#
+# Genes closer than threshold_distance in the GSNet embedding are connected.
+# A KD-tree radius query finds those pairs directly, so neither the dense
+# N x N distance matrix (~29 GB in float64 for 60k genes) nor the O(N^2) Python
+# loop over all pairs is needed; time and memory grow with N log N plus the
+# number of edges. The result is the same edge set the dense version produced.
+#
+#   python gene_graph.py --check      # compare against the dense version on random points
+import argparse
+import time
+
+import numpy as np
+
+
+def pair_distances(points, edges):
+    # same arithmetic as scipy's pdist, so the threshold cuts the same pairs
+    diff = points[edges[:, 0]] - points[edges[:, 1]]
+    return np.sqrt((diff * diff).sum(axis=1))
+
+
+def radius_edges(points, threshold_distance, leafsize=16):
+    """(E, 2) int64 array of all pairs i < j with distance < threshold_distance, sorted."""
+    from scipy.spatial import cKDTree
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    tree = cKDTree(points, leafsize=leafsize)
+    edges = tree.query_pairs(threshold_distance, output_type='ndarray').astype(np.int64)
+    # query_pairs also returns pairs at exactly the threshold; the edges were strictly closer
+    edges = edges[pair_distances(points, edges) < threshold_distance]
+    return edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+
+
+def dense_edges(points, threshold_distance):
+    # the previous N x N construction, kept to check radius_edges on small inputs
+    from scipy.spatial.distance import pdist, squareform
+    distance_matrix = squareform(pdist(points))
+    i, j = np.nonzero(np.triu(distance_matrix < threshold_distance, k=1))
+    return np.stack([i, j], axis=1).astype(np.int64)
+
+
+def check(n_points=3000, dim=3, threshold_distance=0.2, seed=0):
+    rng = np.random.default_rng(seed)
+    # clustered points, like a trained gene token space
+    centers = rng.normal(size=(20, dim))
+    points = centers[rng.integers(0, len(centers), n_points)] + 0.3 * rng.normal(size=(n_points, dim))
+    t0 = time.perf_counter()
+    edges = radius_edges(points, threshold_distance)
+    t1 = time.perf_counter()
+    expected = dense_edges(points, threshold_distance)
+    t2 = time.perf_counter()
+    assert np.array_equal(edges, expected), "radius_edges differs from the dense construction"
+    print(f"{n_points} points, {len(edges)} edges: kd-tree {1e3 * (t1 - t0):.1f} ms, dense {1e3 * (t2 - t1):.1f} ms, identical")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Radius graph over a gene token space')
+    parser.add_argument('--check', action='store_true', help='Compare against the dense construction on random points.')
+    parser.add_argument('--points', default=None, type=str, help='gene_token_space.npy to build the graph for.')
+    parser.add_argument('--threshold_distance', default=0.2, type=float)
+    parser.add_argument('--out', default=None, type=str, help='npy file for the (E, 2) edge list.')
+    args = parser.parse_args()
+    if args.check:
+        check(threshold_distance=args.threshold_distance)
+    if args.points:
+        points = np.load(args.points)
+        t0 = time.perf_counter()
+        edges = radius_edges(points, args.threshold_distance)
+        print(f"{len(points)} genes, {len(edges)} edges in {time.perf_counter() - t0:.2f}s")
+        if args.out:
+            np.save(args.out, edges)
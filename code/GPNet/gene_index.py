@@ -0,0 +1,144 @@
+#%%
+# Nearest-gene index over the learned gene token space.
+#
+# GSNet maps every gene's 2-D index to a point in the gene token space; genes
+# that the model treats alike end up close together. GeneIndex holds those
+# points in a KD-tree, so the k nearest genes of thousands of query genes come
+# from one batched tree query instead of a full row of the pairwise distance
+# matrix per gene. eps > 0 gives an approximate search: every returned
+# neighbour is within (1 + eps) times the distance of the true k-th neighbour,
+# and the query visits fewer tree nodes.
+#
+# The index is saved as an npz of the points and gene names; the tree is
+# rebuilt on load, which takes a few tens of milliseconds for 60k genes.
+#
+#   index = GeneIndex.from_model(model, gene_number_name_mapping)
+#   index.save("gene_index.npz")
+#   index.neighbours(["TP53", "BRCA1"], k=20)
+import argparse
+import time
+
+import numpy as np
+
+
+def gene_space_from_model(model, n_genes):
+    """(n_genes, gene_space_dim) GSNet output for the gene index used in training."""
+    import torch
+    from dataloader import gene_index_2d
+    device = next(model.parameters()).device
+    gene_idx = torch.from_numpy(gene_index_2d(n_genes).T.astype(np.float32)).unsqueeze(0).to(device)
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        points = model.gstn(gene_idx)[0].T.cpu().numpy()
+    model.train(was_training)
+    return points
+
+
+class GeneIndex:
+    def __init__(self, points, gene_names=None, leafsize=16):
+        """
+        Args:
+            points: (n_genes, d) gene token space, row i is gene number i.
+            gene_names: Name of every gene number, to query and answer by name.
+        """
+        from scipy.spatial import cKDTree
+        self.points = np.ascontiguousarray(points, dtype=np.float64)
+        self.gene_names = None if gene_names is None else np.asarray(gene_names, dtype=str)
+        self.name_to_number = None if gene_names is None else {name: i for i, name in enumerate(self.gene_names)}
+        self.tree = cKDTree(self.points, leafsize=leafsize)
+
+    @classmethod
+    def from_model(cls, model, gene_number_name_mapping):
+        n_genes = len(gene_number_name_mapping)
+        gene_names = [gene_number_name_mapping[i] for i in range(n_genes)]
+        return cls(gene_space_from_model(model, n_genes), gene_names)
+
+    def save(self, path):
+        arrays = {"points": self.points}
+        if self.gene_names is not None:
+            arrays["gene_names"] = self.gene_names
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["points"], f["gene_names"] if "gene_names" in f else None)
+
+    def gene_numbers(self, genes):
+        # gene numbers pass through, names are looked up
+        numbers = []
+        for gene in np.atleast_1d(genes):
+            if isinstance(gene, (str, np.str_)):
+                if self.name_to_number is None:
+                    raise ValueError("this index has no gene names")
+                if gene not in self.name_to_number:
+                    raise KeyError(f"unknown gene {gene}")
+                numbers.append(self.name_to_number[gene])
+            else:
+                numbers.append(int(gene))
+        return np.asarray(numbers, dtype=np.int64)
+
+    def query(self, genes, k=20, eps=0.0, workers=1):
+        """k nearest other genes of every query gene: (indices, distances), both (n_queries, k)."""
+        numbers = self.gene_numbers(genes)
+        distances, indices = self.tree.query(self.points[numbers], k=k + 1, eps=eps, workers=workers)
+        distances, indices = distances.reshape(len(numbers), k + 1), indices.reshape(len(numbers), k + 1)
+        # drop the query gene itself; with ties or eps > 0 it is not always the first hit
+        keep = indices != numbers[:, None]
+        keep[keep.all(axis=1), -1] = False
+        return indices[keep].reshape(-1, k), distances[keep].reshape(-1, k)
+
+    def query_points(self, points, k=20, eps=0.0, workers=1):
+        """k nearest genes of arbitrary points in the gene token space."""
+        distances, indices = self.tree.query(np.atleast_2d(points), k=k, eps=eps, workers=workers)
+        return indices.reshape(-1, k), distances.reshape(-1, k)
+
+    def neighbours(self, genes, k=20, eps=0.0, workers=1):
+        """Names of the k nearest genes of every query gene."""
+        if self.gene_names is None:
+            raise ValueError("this index has no gene names")
+        indices, _ = self.query(genes, k=k, eps=eps, workers=workers)
+        return [list(self.gene_names[row]) for row in indices]
+
+
+def check(n_genes=60660, dim=3, k=20, n_queries=2000, seed=0):
+    # compares against the full-row argsort of the old code and times batched queries
+    rng = np.random.default_rng(seed)
+    points = rng.normal(size=(n_genes, dim))
+    t0 = time.perf_counter()
+    index = GeneIndex(points)
+    build = time.perf_counter() - t0
+    queries = rng.choice(n_genes, size=n_queries, replace=False)
+    t0 = time.perf_counter()
+    indices, _ = index.query(queries, k=k)
+    exact = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    approx_indices, _ = index.query(queries, k=k, eps=0.5)
+    approx = time.perf_counter() - t0
+    for q, row in zip(queries[:50], indices[:50]):
+        distances = np.sqrt(((points - points[q]) ** 2).sum(axis=1))
+        distances[q] = np.inf
+        assert set(row) == set(np.argsort(distances)[:k]), "kd-tree neighbours differ from brute force"
+    recall = np.mean([len(set(a) & set(e)) / k for a, e in zip(approx_indices, indices)])
+    print(f"{n_genes} genes: build {1e3 * build:.1f} ms, {n_queries} queries exact {1e3 * exact:.1f} ms, "
+          f"eps=0.5 {1e3 * approx:.1f} ms (recall {recall:.3f}), exact results match brute force")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Nearest-gene index over the gene token space')
+    parser.add_argument('--check', action='store_true', help='Compare against brute force on random points and time queries.')
+    parser.add_argument('--index', default=None, type=str, help='Index written by GeneIndex.save.')
+    parser.add_argument('--genes', nargs='*', default=[], help='Gene names or numbers to query.')
+    parser.add_argument('--k', default=20, type=int)
+    parser.add_argument('--eps', default=0.0, type=float, help='> 0 for an approximate search.')
+    args = parser.parse_args()
+    if args.check:
+        check(k=args.k)
+    if args.index and args.genes:
+        index = GeneIndex.load(args.index)
+        genes = [int(g) if g.isdigit() else g for g in args.genes]
+        indices, distances = index.query(genes, k=args.k, eps=args.eps)
+        for gene, row, dist in zip(genes, indices, distances):
+            names = index.gene_names[row] if index.gene_names is not None else row
+            print(f"{gene}: " + " ".join(f"{n}({d:.3f})" for n, d in zip(names, dist)))
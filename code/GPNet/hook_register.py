@@ -1,28 +1,325 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
 import torch.nn as nn
 
-def Hook_register(model, layer_name_list, activation):
+def get_layer(model, layer_path):
+    # 'gstn' or a path like ['feat', 'atention_pooling']
+    if isinstance(layer_path, str):
+        return model._modules.get(layer_path)
+    elif isinstance(layer_path, list):
+        for layer in layer_path:
+            model = model._modules.get(layer)
+        return model
+    else:
+        raise ValueError("Invalid layer path")
+
+def layer_id(layer_path):
+    return '.'.join(layer_path) if isinstance(layer_path, list) else layer_path
+
+def Hook_register(model, layer_name_list, activation, handles=None):
+    # keeps the output of the last batch of every layer; pass a list as `handles`
+    # to get the hook handles back, so the hooks can be removed again
     def get_activation(name):
         def hook(model, input, output):
             activation[name] = output.detach()
         return hook
-    def get_layer(model, layer_path):
-        if isinstance(layer_path, str):
-            return model._modules.get(layer_path)
-        elif isinstance(layer_path, list):
-            for layer in layer_path:
-                model = model._modules.get(layer)
-            return model
-        else:
-            raise ValueError("Invalid layer path")
     for layer_name in layer_name_list:
         target_layer = get_layer(model, layer_name)
         if target_layer is not None:
-            layer_id = '.'.join(layer_name) if isinstance(layer_name, list) else layer_name
-            target_layer.register_forward_hook(get_activation(layer_id))
+            handle = target_layer.register_forward_hook(get_activation(layer_id(layer_name)))
+            if handles is not None:
+                handles.append(handle)
         else:
             print(f"Layer {layer_name} not found in the model")
     return activation
 
 def run_with_hook(model, features1_count, features2_gene_idx):
     pred, _, _ = model(features1_count, features2_gene_idx)
-    return pred
\ No newline at end of file
+    return pred
+
+
+REDUCTIONS = ['none', 'mean', 'topk', 'class']
+
+class ActivationCapture:
+    """Streams layer outputs over a whole loader to .npy memmaps on disk.
+
+    Unlike Hook_register, which keeps only the last batch on the device, every
+    sample's (optionally reduced) output is copied to a host buffer and written
+    out whenever the buffer reaches max_buffer_mb, so host memory stays under
+    max_buffer_mb plus one batch for any cohort size. Reductions, over axis `dim`
+    of each sample's output (the batch axis is not counted; dim=None takes the
+    longest axis, which is the gene axis of both gstn and atention_pooling):
+        none:  the full output, (n_samples, *output_shape)
+        mean:  mean over `dim`
+        topk:  the k largest values over `dim` and their indices (two files)
+        class: per-class sums over the samples, accumulated on the device and
+               written once at close (needs the labels, see run())
+    run() or leaving a `with` block calls close(), which writes the rest of the
+    buffer and the manifest; remove() only drops the hooks. With a custom loop,
+    call set_labels() before each forward pass when reduce='class'.
+
+        with ActivationCapture(model, ['gstn', ['feat', 'atention_pooling']], out_dir, n_samples,
+                               reduce='class', class_num=class_num) as capture:
+            for data in loader:
+                capture.set_labels(data[-1].to(device))
+                pointnet_forward(model, data, device)
+        # out_dir/gstn.class_sum.npy, out_dir/feat.atention_pooling.class_sum.npy,
+        # out_dir/class_count.npy, out_dir/manifest.json
+    """
+    def __init__(self, model, layer_name_list, out_dir, n_samples=None, reduce='none', dim=None, k=20,
+                 class_num=None, max_buffer_mb=256, dtype=np.float32):
+        if reduce not in REDUCTIONS:
+            raise ValueError(f"reduce must be one of {REDUCTIONS}")
+        if reduce == 'class' and class_num is None:
+            raise ValueError("reduce='class' needs class_num")
+        os.makedirs(out_dir, exist_ok=True)
+        self.model = model
+        self.out_dir = out_dir
+        self.n_samples = n_samples
+        self.reduce = reduce
+        self.dim = dim
+        self.k = k
+        self.class_num = class_num
+        self.max_buffer_bytes = int(max_buffer_mb * 2**20)
+        self.dtype = dtype
+        self.buffers = {}
+        self.buffered_bytes = 0
+        self.stores = {}
+        self.offsets = {}
+        self.class_sums = {}
+        self.class_counts = None
+        self.labels = None
+        self.axes = {}
+        self.handles = []
+        for layer_name in layer_name_list:
+            target_layer = get_layer(model, layer_name)
+            if target_layer is None:
+                raise ValueError(f"Layer {layer_name} not found in the model")
+            self.handles.append(target_layer.register_forward_hook(self._hook(layer_id(layer_name))))
+
+    def _hook(self, name):
+        def hook(module, input, output):
+            output = output[0] if isinstance(output, tuple) else output
+            self._capture(name, output.detach())
+        return hook
+
+    def _axis(self, name, output):
+        # axis of the batched output that `dim` of one sample's output refers to
+        if name not in self.axes:
+            sample_shape = tuple(output.shape[1:])
+            if self.dim is None:
+                axis = int(np.argmax(sample_shape))
+            elif -len(sample_shape) <= self.dim < len(sample_shape):
+                axis = self.dim % len(sample_shape)
+            else:
+                raise ValueError(f"dim={self.dim} is out of range for {name}, whose samples have shape {sample_shape}")
+            if self.reduce == 'topk' and self.k > sample_shape[axis]:
+                raise ValueError(f"k={self.k} is larger than axis {axis} of {name}, whose samples have shape {sample_shape}")
+            self.axes[name] = axis
+        return self.axes[name] + 1
+
+    def _capture(self, name, output):
+        if self.reduce == 'none':
+            self._append(name, output)
+        elif self.reduce == 'mean':
+            self._append(name, output.float().mean(dim=self._axis(name, output)))
+        elif self.reduce == 'topk':
+            values, indices = output.topk(self.k, dim=self._axis(name, output))
+            self._append(f"{name}.values", values)
+            self._append(f"{name}.indices", indices)
+        else:
+            if self.labels is None:
+                raise RuntimeError("reduce='class' needs set_labels() before every forward pass")
+            if name not in self.class_sums:
+                self.class_sums[name] = torch.zeros((self.class_num,) + tuple(output.shape[1:]), dtype=torch.float64, device=output.device)
+            self.class_sums[name].index_add_(0, self.labels.to(output.device), output.to(torch.float64))
+
+    def set_labels(self, labels):
+        # the true labels of the batch that is about to run through the model
+        self.labels = labels
+        if self.reduce == 'class':
+            counts = torch.bincount(labels, minlength=self.class_num)
+            self.class_counts = counts if self.class_counts is None else self.class_counts + counts
+
+    def _append(self, key, tensor):
+        array = tensor.cpu().numpy()
+        if array.dtype.kind == 'f':
+            array = array.astype(self.dtype, copy=False)
+        self.buffers.setdefault(key, []).append(array)
+        self.buffered_bytes += array.nbytes
+        if self.buffered_bytes >= self.max_buffer_bytes:
+            self.flush()
+
+    def _store(self, key, sample_shape, dtype):
+        if key not in self.stores:
+            if self.n_samples is None:
+                raise ValueError("n_samples is needed to size the on-disk store")
+            path = os.path.join(self.out_dir, f"{key}.npy")
+            self.stores[key] = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(self.n_samples,) + sample_shape)
+            self.offsets[key] = 0
+        return self.stores[key]
+
+    def flush(self):
+        for key, arrays in self.buffers.items():
+            if not arrays:
+                continue
+            block = np.concatenate(arrays)
+            store = self._store(key, block.shape[1:], block.dtype)
+            start = self.offsets[key]
+            if start + len(block) > len(store):
+                raise ValueError(f"more than n_samples={len(store)} samples captured for {key}")
+            store[start:start + len(block)] = block
+            self.offsets[key] = start + len(block)
+            arrays.clear()
+        self.buffered_bytes = 0
+
+    def run(self, loader, device, forward_fn=None):
+        """Runs the model over the loader under inference_mode; returns the manifest."""
+        if forward_fn is None:
+            from trainer import pointnet_forward
+            forward_fn = pointnet_forward
+        if self.n_samples is None:
+            self.n_samples = len(loader.sampler)
+        self.model.eval()
+        try:
+            with torch.inference_mode():
+                for data in loader:
+                    labels = data[-1].to(device)
+                    self.set_labels(labels)
+                    self._append("labels", labels)
+                    forward_fn(self.model, data, device)
+        except BaseException:
+            self.remove()
+            raise
+        return self.close()
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def close(self):
+        """Removes the hooks, writes what is buffered and the manifest; returns the manifest."""
+        self.remove()
+        self.flush()
+        for store in self.stores.values():
+            store.flush()
+        manifest = {"reduce": self.reduce, "dim": self.dim, "arrays": {}}
+        if self.reduce in ('mean', 'topk'):
+            manifest["axes"] = self.axes
+        if self.reduce == 'topk':
+            manifest["k"] = self.k
+        for key, store in self.stores.items():
+            manifest["arrays"][key] = {"file": f"{key}.npy", "shape": list(store.shape), "n_written": self.offsets[key]}
+        for name, sums in self.class_sums.items():
+            np.save(os.path.join(self.out_dir, f"{name}.class_sum.npy"), sums.cpu().numpy())
+            manifest["arrays"][f"{name}.class_sum"] = {"file": f"{name}.class_sum.npy", "shape": list(sums.shape)}
+        if self.class_counts is not None:
+            np.save(os.path.join(self.out_dir, "class_count.npy"), self.class_counts.cpu().numpy())
+            manifest["arrays"]["class_count"] = {"file": "class_count.npy", "shape": [self.class_num]}
+        with open(os.path.join(self.out_dir, "manifest.json"), 'w') as fp:
+            json.dump(manifest, fp, indent=1)
+        return manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # a clean exit finishes the capture; after an error only the hooks go
+        if exc_type is None:
+            if self.handles:
+                self.close()
+        else:
+            self.remove()
+
+
+class _CheckAttention(nn.Module):
+    # (B, n_genes, 1), like attmil
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv1d(3, 1, 1)
+
+    def forward(self, x):
+        return self.conv(x).transpose(1, 2)
+
+
+class _CheckModel(nn.Module):
+    # the output shapes of gstn, (B, 3, n_genes), and atention_pooling, (B, n_genes, 1)
+    def __init__(self):
+        super().__init__()
+        self.gstn = nn.Conv1d(2, 3, 1)
+        self.pool = nn.Sequential()
+        self.pool.add_module('attention', _CheckAttention())
+
+    def forward(self, x):
+        return self.pool.attention(self.gstn(x))
+
+
+def check(n_samples=37, n_genes=50, class_num=3, batch_size=8, k=5, seed=0):
+    import tempfile
+    from torch.utils.data import DataLoader, TensorDataset
+    torch.manual_seed(seed)
+    model = _CheckModel().eval()
+    x = torch.randn(n_samples, 2, n_genes)
+    labels = torch.randint(0, class_num, (n_samples,))
+    loader = DataLoader(TensorDataset(x, labels), batch_size=batch_size)
+    forward_fn = lambda model, data, device: model(data[0].to(device))
+    with torch.no_grad():
+        gstn = model.gstn(x)
+        attention = model(x)
+    expected = {'gstn': gstn, 'pool.attention': attention}
+    layers = ['gstn', ['pool', 'attention']]
+    with tempfile.TemporaryDirectory() as out_dir:
+        # tiny buffer, so the memmaps are written in several blocks
+        ActivationCapture(model, layers, out_dir, reduce='none', max_buffer_mb=0.01).run(loader, 'cpu', forward_fn)
+        for name, full in expected.items():
+            assert np.allclose(np.load(os.path.join(out_dir, f"{name}.npy")), full.numpy(), atol=1e-6), f"none: {name}"
+        assert np.array_equal(np.load(os.path.join(out_dir, "labels.npy")), labels.numpy())
+
+        # default axis: the gene axis of both layers
+        manifest = ActivationCapture(model, layers, out_dir, reduce='mean').run(loader, 'cpu', forward_fn)
+        assert manifest["axes"] == {'gstn': 1, 'pool.attention': 0}
+        assert np.allclose(np.load(os.path.join(out_dir, "gstn.npy")), gstn.mean(dim=2).numpy(), atol=1e-6)
+        assert np.allclose(np.load(os.path.join(out_dir, "pool.attention.npy")), attention.mean(dim=1).numpy(), atol=1e-6)
+        # dim counts within a sample, dim=0 is not the batch
+        ActivationCapture(model, ['gstn'], out_dir, reduce='mean', dim=0).run(loader, 'cpu', forward_fn)
+        assert np.allclose(np.load(os.path.join(out_dir, "gstn.npy")), gstn.mean(dim=1).numpy(), atol=1e-6)
+
+        ActivationCapture(model, layers, out_dir, reduce='topk', k=k).run(loader, 'cpu', forward_fn)
+        for name, full, axis in [('gstn', gstn, 2), ('pool.attention', attention, 1)]:
+            values, indices = full.topk(k, dim=axis)
+            assert np.allclose(np.load(os.path.join(out_dir, f"{name}.values.npy")), values.numpy(), atol=1e-6), f"topk: {name}"
+            assert np.array_equal(np.load(os.path.join(out_dir, f"{name}.indices.npy")), indices.numpy()), f"topk: {name}"
+        try:
+            ActivationCapture(model, layers, out_dir, reduce='topk', dim=-1, k=k).run(loader, 'cpu', forward_fn)
+            raise AssertionError("topk over an axis shorter than k did not fail")
+        except ValueError:
+            pass
+
+        # a custom loop in a with block, finished by leaving it
+        with ActivationCapture(model, layers, out_dir, n_samples, reduce='class', class_num=class_num) as capture:
+            with torch.no_grad():
+                for data in loader:
+                    capture.set_labels(data[1])
+                    forward_fn(model, data, 'cpu')
+        assert not capture.handles
+        counts = np.bincount(labels.numpy(), minlength=class_num)
+        assert np.array_equal(np.load(os.path.join(out_dir, "class_count.npy")), counts)
+        for name, full in expected.items():
+            sums = torch.zeros((class_num,) + tuple(full.shape[1:]), dtype=torch.float64).index_add_(0, labels, full.double())
+            # float32 outputs of batches of 8 against one batch of all samples
+            assert np.allclose(np.load(os.path.join(out_dir, f"{name}.class_sum.npy")), sums.numpy(), atol=1e-5), f"class: {name}"
+        assert os.path.exists(os.path.join(out_dir, "manifest.json"))
+    print(f"none, mean, topk and class captures match the direct computation on {n_samples} samples")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Streaming activation capture')
+    parser.add_argument('--check', action='store_true', help='Compare every reduction against the direct computation on a small model.')
+    args = parser.parse_args()
+    if args.check:
+        check()
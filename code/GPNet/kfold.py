@@ -0,0 +1,133 @@
+#%%
+# Stratified k-fold cross-validation of one PointNetCls configuration.
+#
+# The folds are drawn once in the parent, the normalized matrix is put in
+# shared memory, and the folds are trained concurrently by the same worker
+# pool as sweep.py; a task only carries its fold's row indices. Each fold
+# holds out one stratified part as test set and a stratified slice of the
+# rest as validation set. The per-fold test confusion matrices are combined
+# into mean/std metrics.
+#
+#   python kfold.py --data_dir counts.csv --k 5 --workers 5 --threads 4
+import argparse
+import json
+import os
+import time
+from concurrent.futures import as_completed
+
+import numpy as np
+from sklearn.model_selection import StratifiedKFold, train_test_split
+
+from dataloader import prepare_data
+from metrics import compute_metrics
+from shared_data import share_data
+from sweep import FLAG_NAMES, _worker, add_training_args, default_devices, resolve_workers, settings_from_args, start_pool, train_config
+
+
+def make_folds(labels, k=5, val_size=0.15, seed=42):
+    """Returns a list of (train_idx, val_idx, test_idx), one per fold."""
+    labels = np.asarray(labels)
+    skf = StratifiedKFold(n_splits=k, shuffle=True, random_state=seed)
+    folds = []
+    for rest_idx, test_idx in skf.split(np.zeros(len(labels)), labels):
+        train_idx, val_idx = train_test_split(rest_idx, test_size=val_size, random_state=seed, stratify=labels[rest_idx])
+        folds.append((train_idx, val_idx, test_idx))
+    return folds
+
+
+def run_fold(config, settings, fold, train_idx, val_idx, test_idx):
+    # runs inside a pool worker; the split indices replace the default 70/15/15 split
+    data = dict(_worker['data'], train_idx=train_idx, val_idx=val_idx, test_idx=test_idx)
+    config = dict(config, name=f"fold{fold}_{config['name']}")
+    row, confusion_matrix_test = train_config(data, config, settings, _worker['device'])
+    print(f"done fold {fold} on {_worker['device']} {row['wall_clock_s']:.1f}s test accuracy {row['test_acc']:.4f}")
+    return fold, row, confusion_matrix_test
+
+
+def fold_metrics(cm):
+    metrics = compute_metrics(cm)
+    metrics["Accuracy"] = float(np.trace(cm) / max(np.sum(cm), 1.0))
+    return metrics
+
+
+def aggregate_folds(confusion_matrices):
+    """Mean and std over folds of every metric in compute_metrics, plus accuracy."""
+    per_fold = [fold_metrics(cm) for cm in confusion_matrices]
+    summary = {"mean": {}, "std": {}}
+    for key in per_fold[0]:
+        values = np.array([m[key] for m in per_fold], dtype=np.float64)
+        # per-class metrics keep one mean/std per class
+        summary["mean"][key] = values.mean(axis=0).tolist()
+        summary["std"][key] = values.std(axis=0).tolist()
+    summary["per_fold"] = per_fold
+    summary["confusion_matrix_sum"] = np.sum(confusion_matrices, axis=0).tolist()
+    return summary
+
+
+def run_kfold(data, config, settings, k, devices, workers, threads, val_size=0.15):
+    folds = make_folds(data["labels"], k=k, val_size=val_size, seed=settings["seed"])
+    shared = share_data(data)
+    results = [None] * k
+    t_start = time.perf_counter()
+    try:
+        with start_pool(shared.spec, devices, workers, threads) as pool:
+            futures = [pool.submit(run_fold, config, settings, i, *fold) for i, fold in enumerate(folds)]
+            for future in as_completed(futures):
+                fold, row, confusion_matrix_test = future.result()
+                results[fold] = (row, confusion_matrix_test)
+    finally:
+        shared.close()
+    wall_clock = time.perf_counter() - t_start
+    print(f"{k} folds took {wall_clock:.1f}s on {workers} workers")
+
+    confusion_matrices = np.stack([cm for _, cm in results])
+    summary = aggregate_folds(confusion_matrices)
+    summary["runs"] = [row for row, _ in results]
+    summary["wall_clock_s"] = wall_clock
+    return summary, confusion_matrices
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Parallel stratified k-fold cross-validation')
+    parser.add_argument('--data_dir', required=True, type=str, help='Training count matrix (MultiIndex CSV).')
+    parser.add_argument('--k', default=5, type=int, help='Number of folds.')
+    parser.add_argument('--val_size', default=0.15, type=float, help='Fraction of the training folds held out for validation.')
+    parser.add_argument('--out', default='kfold_results.json', type=str, help='Aggregated metrics; per-fold confusion matrices go next to it as .npy.')
+    parser.add_argument('--outf', default=None, type=str, help='Folder for the best model of each fold (not saved if omitted).')
+    # defaults follow main.py
+    parser.add_argument('--snet_flag', default=1, type=int, choices=[0, 1])
+    parser.add_argument('--tnet_flag', default=1, type=int, choices=[0, 1])
+    parser.add_argument('--feature_transform', default=1, type=int, choices=[0, 1])
+    parser.add_argument('--atention_pooling_flag', default=0, type=int, choices=[0, 1])
+    parser.add_argument('--encoder_flag', default=1, type=int, choices=[0, 1])
+    parser.add_argument('--gene_space_dim', default=3, type=int)
+    add_training_args(parser)
+    return parser
+
+
+def main(args):
+    devices = args.devices or default_devices()
+    # on CPU the thread budget decides how many folds run at once
+    workers, threads = resolve_workers(devices, args.workers, args.threads)
+    workers = min(workers, args.k)
+    if args.outf:
+        os.makedirs(args.outf, exist_ok=True)
+
+    config = {name: bool(getattr(args, name)) for name in FLAG_NAMES}
+    config['gene_space_dim'] = args.gene_space_dim
+    config['name'] = "_".join(f"{name}_{config[name]}" for name in FLAG_NAMES + ['gene_space_dim'])
+    print(f"{args.k} folds, {workers} workers on {devices}, {threads} threads each")
+    data = prepare_data(args.data_dir)
+    settings = settings_from_args(args)
+    summary, confusion_matrices = run_kfold(data, config, settings, args.k, devices, workers, threads, val_size=args.val_size)
+
+    for key in ["Accuracy", "Micro F1 Score", "Macro Precision", "Macro Recall", "Macro F1 Score"]:
+        print(f"{key}: {summary['mean'][key]:.4f} +- {summary['std'][key]:.4f}")
+    with open(args.out, 'w') as fp:
+        json.dump(summary, fp)
+    np.save(os.path.splitext(args.out)[0] + "_confusion_matrices.npy", confusion_matrices)
+    return summary
+
+
+if __name__ == "__main__":
+    main(build_parser().parse_args())
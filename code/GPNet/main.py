@@ -1,13 +1,20 @@
 #%%
 from dataloader import load_data
 from models import *
+from checkpoint import AsyncCheckpointWriter, capture_rng_state, restore_rng_state
+from metrics import compute_metrics
+from utils import strip_ddp_prefix, memory_per_rank
+from comm_hooks import COMM_HOOKS, register_comm_hook
+from profiling import make_profiler
+from metrics_logger import MetricsLogger
+from trainer import Trainer, make_criterion, normalized_class_weights, pointnet_forward, pointnet_regularizers
 import torch.optim as optim
 import torch.nn.functional as F
 import torch
-from sklearn.metrics import confusion_matrix
 import torch.distributed as dist
 from torch.utils.data.distributed import DistributedSampler
 from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.optim import ZeroRedundancyOptimizer
 import os
 import argparse
 from torch.distributed import all_reduce, ReduceOp
@@ -34,9 +41,12 @@ from torch.distributed import all_reduce, ReduceOp
 
 #%% fuctions for ddp
 
-def distributed_init():
+def distributed_init(backend=None):
+    # nccl needs one GPU per process; gloo runs the same code on CPU processes
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
     torch.distributed.init_process_group(
-                                        backend='nccl',
+                                        backend=backend,
                                         init_method="env://",
                                         world_size=int(os.environ['WORLD_SIZE']),
                                         rank=int(os.environ["RANK"])
@@ -45,6 +55,11 @@ def distributed_init():
     torch.distributed.barrier()
 
 
+def launched_distributed():
+    # torchrun sets WORLD_SIZE; a single process runs without a process group
+    return int(os.environ.get('WORLD_SIZE', 1)) > 1
+
+
 def distributed_params():
     return int(os.environ['LOCAL_RANK'])
 
@@ -77,7 +92,7 @@ def set_device(local_rank_param, multi_gpu = True):
         
     return device
 
-def main():
+def main(argv):
     
     # data_dir = f"/isilon/datalake/cialab/original/cialab/image_database/d00154/Tumor_gene_counts/All_countings/training_data_17_tumors_31_classes.csv"
     data_dir = f"/isilon/datalake/cialab/original/cialab/image_database/d00154/Tumor_gene_counts/training_data_6_tumors.csv"
@@ -93,37 +108,45 @@ def main():
     gene_space_dim = 3
     LOSS_SELECT = 'CE' # 'CE' or 'NLL'
     WEIGHT_LOSS_FLAG = True
-    MULTI_GPU_FLAG = False
+    MULTI_GPU_FLAG = launched_distributed() # set by the launcher, see run_distributed.sh
     pre_trained = False
     lr=0.005
+    keep_last_ckpt = 5 # periodic checkpoints kept on disk, None keeps all of them
+    log_interval = 50 # steps between printed train losses
+    # command line overrides, mainly for small local runs
+    data_dir = argv.data_dir or data_dir
+    outf = argv.outf or outf
+    batch_size = argv.batch_size or batch_size
+    max_epoch = argv.max_epoch or max_epoch
+    os.makedirs(outf, exist_ok=True)
+    if argv.resume is None and int(os.environ.get('TORCHELASTIC_RESTART_COUNT', 0)) > 0:
+        # restarted by torchrun after a worker failure: continue from the last training state
+        argv.resume = 'auto'
 
     if MULTI_GPU_FLAG:
         ## initializing multi-node setting
-        distributed_init()
+        distributed_init(argv.backend)
         local_rank = distributed_params() # local_rank = gpu in some cases
         ## Setting device
         device = set_device(local_rank_param = local_rank, multi_gpu = True)
-        torch.cuda.set_device(device) # set the cuda device, this line doesn't included in Usman's code. But appears in MONAI tutorial
+        if device.type == 'cuda':
+            torch.cuda.set_device(device) # set the cuda device, this line doesn't included in Usman's code. But appears in MONAI tutorial
         print(
-                "Training in distributed mode with multiple processes, 1 GPU per process. Process %d, total %d."
-                % (torch.distributed.get_rank(), torch.distributed.get_world_size())
+                "Training in distributed mode with multiple processes (%s backend). Process %d, total %d."
+                % (torch.distributed.get_backend(), torch.distributed.get_rank(), torch.distributed.get_world_size())
             )
     else:
         device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
-    gene_number_name_mapping, number_to_label,feature_num, train_loader, val_loader, test_loader = load_data(file_path=data_dir, batch_size=batch_size, Multi_gpu_flag=MULTI_GPU_FLAG)
+    gene_number_name_mapping, number_to_label,feature_num, train_loader, val_loader, test_loader = load_data(file_path=data_dir, batch_size=batch_size, Multi_gpu_flag=MULTI_GPU_FLAG,
+                                                                                                     preprocess_info_path=f"{outf}/preprocess_info.json" if not MULTI_GPU_FLAG or torch.distributed.get_rank() == 0 else None,
+                                                                                                     num_workers=argv.num_workers,
+                                                                                                     report_path=argv.load_report if not MULTI_GPU_FLAG or torch.distributed.get_rank() == 0 else None)
 
     class_num = len(number_to_label.keys())
     print("class_num:", class_num)
-    samples_per_class = [feature_num[i] for i in range(len(feature_num))]
-    # Calculate class weights
-    total_samples = sum(samples_per_class)
-    class_weights = [total_samples / samples_per_class[i] for i in range(len(samples_per_class))]
-
-    # Normalize weights so that their sum equals the number of classes
-    weight_sum = sum(class_weights)
-    normalized_weights = torch.tensor([w / weight_sum * len(feature_num) for w in class_weights])
+    normalized_weights = normalized_class_weights(feature_num)
     print("Normalized Class Weights:", normalized_weights)
     #%%
     
@@ -134,7 +157,8 @@ def main():
                         tnet_flag = tnet_flag, 
                         feature_transform=feature_transform, 
                         atention_pooling_flag = atention_pooling_flag,
-                        encoder_flag = encoder_flag)
+                        encoder_flag = encoder_flag,
+                        gene_num = len(gene_number_name_mapping))
     if pre_trained:
         model_state_dict = torch.load("./saved_models"+f"/cls_model_geneSpaceD_3_transfeat_False_attenpool_False_best.pth")
         # Load the state dict of the pretrained model into a temporary variable
@@ -144,95 +168,136 @@ def main():
         pretrained_dict_temp.pop('fc3.bias', None)
 
         model.load_state_dict(pretrained_dict_temp, strict=False)
-    optimizer = optim.Adam(model.parameters(), lr=lr, betas=(0.9, 0.999))
-    scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=2, gamma=0.9)
     model.to(device)
     if MULTI_GPU_FLAG:
-        model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
-        model = DDP(model, device_ids=[local_rank], output_device=local_rank)
-
-    def get_loss_criterion(LOSS_SELECT, WEIGHT_LOSS_FLAG, normalized_weights):
-        if LOSS_SELECT == 'CE':
-            if WEIGHT_LOSS_FLAG:
-                criterion = nn.CrossEntropyLoss(weight=normalized_weights)
-            else:
-                criterion = nn.CrossEntropyLoss()
-        elif LOSS_SELECT == 'NLL':
-            if WEIGHT_LOSS_FLAG:
-                criterion = nn.NLLLoss(weight=normalized_weights)
-            else:
-                criterion = nn.NLLLoss()
+        freeze_unused_parameters(model)
+        if device.type == 'cuda':
+            # SyncBatchNorm is CUDA only; CPU processes keep per-process batch statistics
+            model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+            model = DDP(model, device_ids=[local_rank], output_device=local_rank)
         else:
-            raise ValueError("Invalid LOSS_SELECT value.")
-        return criterion
+            model = DDP(model)
+        # gradient compression for slow interconnects, see comm_hooks.py
+        register_comm_hook(model, argv.comm_hook, powersgd_rank=argv.powersgd_rank, start_iter=argv.powersgd_start_iter)
+    if MULTI_GPU_FLAG and argv.zero:
+        # each rank keeps the Adam moments of its own parameter shard and broadcasts the updated shard
+        optimizer = ZeroRedundancyOptimizer(model.parameters(), optimizer_class=optim.Adam, lr=lr, betas=(0.9, 0.999))
+    else:
+        optimizer = optim.Adam(model.parameters(), lr=lr, betas=(0.9, 0.999))
+    scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=2, gamma=0.9)
+
     #%% train
+    # checkpoints are written off the training thread, by rank 0 only
+    rank = torch.distributed.get_rank() if MULTI_GPU_FLAG else 0
+    world_size = torch.distributed.get_world_size() if MULTI_GPU_FLAG else 1
+    is_main_process = rank == 0
+    # the training state holds the unwrapped weights so it can be resumed with a different number of processes
+    raw_model = model.module if MULTI_GPU_FLAG else model
+    checkpoint_writer = AsyncCheckpointWriter(keep_last=keep_last_ckpt)
+    best_suffix = "pretrain_best" if MULTI_GPU_FLAG else "best"
+    train_sampler = train_loader.sampler
+    # resumable state: weights, Adam moments, StepLR, counters and sampler position
+    # on rank 0, plus the RNG state and partial train counts of every rank in its own file
+    state_suffix = f"geneSpaceD_{gene_space_dim}_transfeat_{feature_transform}_attenpool_{atention_pooling_flag}"
+    train_state_path = f"{outf}/train_state_{state_suffix}.pth"
+    rng_state_path = f"{outf}/train_state_rng_{state_suffix}_rank{rank}.pth"
+
+    def save_training_state(epoch, step, confusion_matrix_all):
+        # `step` batches of `epoch` are done; a finished epoch is saved as (epoch + 1, 0)
+        checkpoint_writer.save({"epoch": epoch, "step": step, "rng": capture_rng_state(),
+                                "confusion_matrix": confusion_matrix_all}, rng_state_path, periodic=False)
+        if isinstance(optimizer, ZeroRedundancyOptimizer):
+            # collective: gathers the optimizer shards on rank 0, so every rank has to call it
+            optimizer.consolidate_state_dict(to=0)
+        if is_main_process:
+            checkpoint_writer.save({
+                "epoch": epoch,
+                "step": step,
+                "best_acc": best_acc,
+                "world_size": world_size,
+                "model": raw_model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scheduler": scheduler.state_dict(),
+                "sampler": train_sampler.state_dict(),
+            }, train_state_path, periodic=False)
+
     best_acc = 0
-    for epoch in range(max_epoch):
-        scheduler.step()
-        confusion_matrix_all = np.zeros((class_num, class_num))
-        for i , data in enumerate(train_loader, 0):
-            features1_count, features2_gene_idx, labels = data
-            features1_count, features2_gene_idx = transpose_input(features1_count, features2_gene_idx)
-            features1_count, features2_gene_idx, labels = features1_count.to(device), features2_gene_idx.to(device), labels.to(device)
-            optimizer.zero_grad()
-            model = model.train()
-            pred, trans, trans_feat, norm_n = model(features1_count, features2_gene_idx)
-            normalized_weights = normalized_weights.to(device)
-            criterion = get_loss_criterion(LOSS_SELECT, WEIGHT_LOSS_FLAG, normalized_weights)
-            if LOSS_SELECT == 'NLL':
-                pred = F.log_softmax(pred, dim=1)
-            loss = criterion(pred, labels)
-            # loss = F.nll_loss(F.log_softmax(pred, dim=1), labels)
-            if feature_transform:
-                loss += feature_transform_regularizer(trans_feat) * 0.001
-            if snet_flag:
-                loss += snet_regularizer(norm_n) * 0.0001
-            loss.backward()
-            optimizer.step()
-            pred_labels = torch.argmax(pred, dim=1)
-            correct = torch.sum(pred_labels == labels)/float(batch_size)
-            if MULTI_GPU_FLAG:
-                if torch.distributed.get_rank() == 0:
-                    print(f"[{epoch}: {i}/({len(train_loader)})] train loss: {loss.item()} accuracy: {correct.item()}")
-            else:
-                print(f"[{epoch}: {i}/{len(train_loader)}] train loss: {loss.item()} accuracy: {correct.item()}")
-            pred_labels_np = pred_labels.cpu().numpy()
-            labels_np = labels.cpu().numpy()
-            for idx_batch in range(labels_np.shape[0]):
-                label_i = labels_np[idx_batch]
-                pred_i = pred_labels_np[idx_batch]
-                confusion_matrix_all[label_i,pred_i] += 1
+    start_epoch, start_step = 0, 0
+    resume_mid_epoch = False
+    resume_confusion_matrix = None
+    resume_path = train_state_path if argv.resume == 'auto' else argv.resume
+    if resume_path and os.path.exists(resume_path):
+        train_state = torch.load(resume_path, map_location='cpu', weights_only=False)
+        raw_model.load_state_dict(strip_ddp_prefix(train_state["model"]))
+        optimizer.load_state_dict(train_state["optimizer"])
+        scheduler.load_state_dict(train_state["scheduler"])
+        train_sampler.load_state_dict(train_state["sampler"])
+        best_acc = train_state["best_acc"]
+        start_epoch, start_step = train_state["epoch"], train_state["step"]
+        resume_mid_epoch = start_step > 0
+        if train_state.get("world_size", 1) == world_size:
+            rng_state = torch.load(rng_state_path, map_location='cpu', weights_only=False)
+            if (rng_state["epoch"], rng_state["step"]) != (train_state["epoch"], train_state["step"]):
+                raise RuntimeError(f"{rng_state_path} does not match {resume_path}, the run was interrupted while saving")
+            restore_rng_state(rng_state["rng"])
+            resume_confusion_matrix = rng_state["confusion_matrix"]
+        else:
+            # the sampler shards and per-rank RNG streams depend on the world size,
+            # so an epoch that was interrupted is redone from its first step
+            print(f"world size changed from {train_state.get('world_size', 1)} to {world_size}, restarting epoch {start_epoch}")
+            start_step = 0
+        print(f"resuming from {resume_path} at epoch {start_epoch} step {start_step}")
+    elif argv.resume and argv.resume != 'auto':
+        raise FileNotFoundError(resume_path)
+
+    criterion = make_criterion(LOSS_SELECT, WEIGHT_LOSS_FLAG, normalized_weights.to(device))
+    metrics_logger = MetricsLogger(argv.metrics_log or f"{outf}/metrics.jsonl",
+                                   flush_interval=argv.flush_interval or log_interval,
+                                   tensorboard_dir=argv.tensorboard_dir,
+                                   enabled=is_main_process)
+    trainer = Trainer(model, optimizer, criterion, device, class_num,
+                      forward_fn = pointnet_forward,
+                      regularizers = pointnet_regularizers(feature_transform, snet_flag),
+                      log_interval = log_interval,
+                      is_main_process = is_main_process,
+                      metrics_logger = metrics_logger)
+
+    def step_callback(i):
+        if argv.ckpt_interval > 0 and (i + 1) % argv.ckpt_interval == 0 and i + 1 < len(train_loader):
+            save_training_state(epoch, i + 1, trainer.train_meter.compute())
+
+    if argv.profile:
+        # one window of train (and, if it reaches that far, eval) steps; traces per rank
+        trainer.profiler = make_profiler(argv.profile_dir or f"{outf}/profile",
+                                         wait=argv.profile_wait, warmup=argv.profile_warmup, active=argv.profile_active,
+                                         tag=f"rank{rank}")
+        trainer.profiler.start()
+
+    for epoch in range(start_epoch, max_epoch):
+        train_sampler.set_epoch(epoch)
+        if epoch == start_epoch and resume_mid_epoch:
+            # the scheduler was already stepped for this epoch before the checkpoint
+            if start_step > 0:
+                train_sampler.set_start_index(start_step * batch_size)
+                trainer.train_meter.load(resume_confusion_matrix)
+            first_step = start_step
+        else:
+            scheduler.step()
+            first_step = 0
+        confusion_matrix_all = trainer.train_epoch(train_loader, epoch, first_step=first_step, step_callback=step_callback)
+        trainer.print_timing(epoch)
+        if epoch == start_epoch:
+            # the optimizer state exists after the first step
+            print(f"[rank {rank}] memory (MB): {memory_per_rank(raw_model, optimizer)}")
+        print(f"[{epoch}] train accuracy: {trainer.train_meter.accuracy(confusion_matrix_all)}")
         print(confusion_matrix_all)
         
+        is_best = False
         if epoch % eval_interval == 0:
-            confusion_matrix_all = np.zeros((class_num, class_num))
-            correct_all = 0
-            total_valset = 0
-            for i, data in enumerate(val_loader, 0):
-                features1_count, features2_gene_idx, labels = data
-                features1_count, features2_gene_idx = transpose_input(features1_count, features2_gene_idx)
-                features1_count, features2_gene_idx, labels = features1_count.to(device), features2_gene_idx.to(device), labels.to(device)
-                model = model.eval()
-                pred, _, _,_ = model(features1_count, features2_gene_idx)
-                pred_labels = pred.data.max(1)[1]
-                correct = torch.sum(pred_labels == labels)
-                correct_all += correct.item()
-                total_valset += features1_count.shape[0]
-                # print("debug_total_valset{}_correct_all{}".format(total_valset, correct_all))
-                print(f"[{epoch}: {i}/{len(val_loader)}] val accuracy: {correct.item()/float(batch_size)}")
-                pred_labels_np = pred_labels.cpu().numpy()
-                labels_np = labels.cpu().numpy()
-                for idx_batch in range(labels_np.shape[0]):
-                    label_i = labels_np[idx_batch]
-                    pred_i = pred_labels_np[idx_batch]
-                    confusion_matrix_all[label_i,pred_i] += 1
-            # if MULTI_GPU_FLAG:
-            #     all_reduce(correct_all, op=ReduceOp.SUM)
-            #     correct_all = correct_all.cpu().numpy()/len(val_loader)
-            
-            # else:
-            #     correct_all = correct_all.cpu().numpy()/len(val_loader)
-            correct_all = correct_all/float(total_valset)
+            # each rank evaluates its shard; the matrices are summed once, so all ranks agree on the best model
+            confusion_matrix_all = trainer.evaluate(val_loader, model=raw_model, all_reduce=MULTI_GPU_FLAG)
+            correct_all = trainer.eval_meter.accuracy(confusion_matrix_all)
+            metrics_logger.log_event("val", step=epoch, accuracy=correct_all)
             print("final accuracy {}".format(correct_all))
             print("best accuracy {}".format(best_acc))
             
@@ -241,11 +306,7 @@ def main():
             if correct_all > best_acc:
 
                 best_acc = correct_all
-                if MULTI_GPU_FLAG:
-                    if torch.distributed.get_rank() == 0:
-                        torch.save(model.state_dict(), f"{outf}/cls_model_geneSpaceD_{gene_space_dim}_transfeat_{feature_transform}_attenpool_{atention_pooling_flag}_pretrain_best.pth")
-                else:
-                    torch.save(model.state_dict(), f"{outf}/cls_model_geneSpaceD_{gene_space_dim}_transfeat_{feature_transform}_attenpool_{atention_pooling_flag}_best.pth")
+                is_best = True
 
                 # total_correct = 0
                 # total_testset = 0
@@ -271,64 +332,25 @@ def main():
                 # print("test accuracy {}".format(test_acc))
                 # print(confusion_matrix_all_test)
             # print("so far best model test accuracy {}".format(test_acc))
-        torch.save(model.state_dict(), f"{outf}/cls_model_geneSpaceD_{gene_space_dim}_transfeat_{feature_transform}_attenpool_{atention_pooling_flag}_{epoch}.pth")
-
-    total_correct = 0
-    total_testset = 0
-    confusion_matrix_all_test = np.zeros((class_num, class_num))
-    for i,data in enumerate(test_loader, 0):
-        features1_count, features2_gene_idx, labels = data
-        features1_count, features2_gene_idx = transpose_input(features1_count, features2_gene_idx)
-        features1_count, features2_gene_idx, labels = features1_count.to(device), features2_gene_idx.to(device), labels.to(device)
-        model = model.eval()
-        pred, _, _, _ = model(features1_count,features2_gene_idx)
-        pred_choice = pred.data.max(1)[1]
-        correct = torch.sum(pred_choice == labels)
-        total_correct += correct.item()
-        total_testset += features1_count.size()[0]
-
-        pred_labels_np = pred_choice.cpu().numpy()
-        labels_np = labels.cpu().numpy()
-        for idx_batch in range(labels_np.shape[0]):
-            label_i = labels_np[idx_batch]
-            pred_i = pred_labels_np[idx_batch]
-            confusion_matrix_all_test[label_i,pred_i] += 1
-
-    print("final accuracy {}".format(total_correct / float(total_testset)))
+        if is_main_process:
+            # the best model is a link to this epoch's file, not a second write
+            checkpoint_writer.save(model.state_dict(),
+                                   f"{outf}/cls_model_geneSpaceD_{gene_space_dim}_transfeat_{feature_transform}_attenpool_{atention_pooling_flag}_{epoch}.pth",
+                                   best_path=f"{outf}/cls_model_geneSpaceD_{gene_space_dim}_transfeat_{feature_transform}_attenpool_{atention_pooling_flag}_{best_suffix}.pth" if is_best else None)
+        save_training_state(epoch + 1, 0, np.zeros((class_num, class_num)))
+    checkpoint_writer.close()
+
+    confusion_matrix_all_test = trainer.evaluate(test_loader, model=raw_model, all_reduce=MULTI_GPU_FLAG)
+    metrics_logger.log_event("test", accuracy=trainer.eval_meter.accuracy(confusion_matrix_all_test))
+    metrics_logger.close()
+    if trainer.profiler is not None:
+        trainer.profiler.stop()
+    if not is_main_process:
+        torch.distributed.destroy_process_group()
+        return
+
+    print("final accuracy {}".format(trainer.eval_meter.accuracy(confusion_matrix_all_test)))
     print(confusion_matrix_all_test)
-    def compute_metrics(cm):
-        # Initialize variables
-        TP = np.diag(cm)
-        FP = np.sum(cm, axis=0) - TP
-        FN = np.sum(cm, axis=1) - TP
-        TN = np.sum(cm) - (FP + FN + TP)
-
-        # Precision, Recall and F1 Score for each class
-        precision = TP / (TP + FP+1e-6)
-        recall = TP / (TP + FN+1e-6)
-        f1_score = 2 * (precision * recall) / (precision + recall+1e-6)
-
-        # Micro averaging (considering all classes together)
-        micro_precision = np.sum(TP) / (np.sum(TP) + np.sum(FP)+1e-6)
-        micro_recall = np.sum(TP) / (np.sum(TP) + np.sum(FN)+1e-6)
-        micro_f1_score = 2 * (micro_precision * micro_recall) / (micro_precision + micro_recall+1e-6)
-
-        # Macro averaging (taking the average across classes)
-        macro_precision = np.mean(precision)
-        macro_recall = np.mean(recall)
-        macro_f1_score = np.mean(f1_score)
-
-        return {
-            "Micro Precision": micro_precision,
-            "Micro Recall": micro_recall,
-            "Micro F1 Score": micro_f1_score,
-            "Macro Precision": macro_precision,
-            "Macro Recall": macro_recall,
-            "Macro F1 Score": macro_f1_score,
-            "Per Class Precision": precision.tolist(),
-            "Per Class Recall": recall.tolist(),
-            "Per Class F1 Score": f1_score.tolist()
-        }
     metrics = compute_metrics(confusion_matrix_all_test)
     # Print the metrics
     for k, v in metrics.items():
@@ -339,17 +361,69 @@ def main():
         json.dump(metrics, fp)
     # save confusion matrix use np.save
     np.save(f"confusion_matrix_cnn.npy", confusion_matrix_all_test)
+    if MULTI_GPU_FLAG:
+        torch.distributed.destroy_process_group()
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description='Model Training')
+def build_parser(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser(
+            description='Model Training')
 
     parser.add_argument('--local-rank',
                         required=False,
                         default=0,
                         type=int,
                         help='Needed to identify the node and save separate weights.')
+    parser.add_argument('--resume',
+                        required=False,
+                        default=None,
+                        type=str,
+                        help="Training state to resume from, or 'auto' for the latest one in the output folder.")
+    parser.add_argument('--ckpt_interval',
+                        required=False,
+                        default=0,
+                        type=int,
+                        help='Also save the training state every N steps within an epoch (0: only at epoch end).')
+    parser.add_argument('--backend',
+                        required=False,
+                        default=None,
+                        choices=['nccl', 'gloo'],
+                        help='Process group backend (default: nccl with CUDA, gloo otherwise).')
+    parser.add_argument('--num_workers',
+                        required=False,
+                        default=None,
+                        type=int,
+                        help='DataLoader workers per process (default: 32 distributed, 0 otherwise).')
+    parser.add_argument('--zero',
+                        action='store_true',
+                        help='Shard the Adam state across ranks (ZeroRedundancyOptimizer); distributed runs only.')
+    parser.add_argument('--comm_hook',
+                        required=False,
+                        default='none',
+                        choices=COMM_HOOKS,
+                        help='DDP gradient compression: fp16/bf16 casting or PowerSGD low-rank with error feedback.')
+    parser.add_argument('--powersgd_rank', required=False, default=1, type=int, help='PowerSGD approximation rank.')
+    parser.add_argument('--powersgd_start_iter', required=False, default=10, type=int, help='Steps of plain all-reduce before PowerSGD starts.')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Profile a window of steps and write a Chrome trace and operator tables.')
+    parser.add_argument('--profile_dir', required=False, default=None, type=str, help='Output folder of the profiler (default: {outf}/profile).')
+    parser.add_argument('--profile_wait', required=False, default=5, type=int, help='Steps skipped before profiling.')
+    parser.add_argument('--profile_warmup', required=False, default=2, type=int, help='Warm-up steps, traced but discarded.')
+    parser.add_argument('--profile_active', required=False, default=10, type=int, help='Steps recorded.')
+    parser.add_argument('--metrics_log', required=False, default=None, type=str, help='Structured JSONL log (default: {outf}/metrics.jsonl).')
+    parser.add_argument('--flush_interval', required=False, default=None, type=int, help='Steps buffered per metrics log record (default: log_interval).')
+    parser.add_argument('--tensorboard_dir', required=False, default=None, type=str, help='Also write TensorBoard event files to this folder.')
+    parser.add_argument('--load_report', required=False, default=None, type=str,
+                        help='Write wall time, allocated bytes and peak RSS of every load_data phase to this JSON file.')
+    parser.add_argument('--data_dir', required=False, default=None, type=str, help='Override the training CSV.')
+    parser.add_argument('--outf', required=False, default=None, type=str, help='Override the output folder.')
+    parser.add_argument('--batch_size', required=False, default=None, type=int, help='Override the per-process batch size.')
+    parser.add_argument('--max_epoch', required=False, default=None, type=int, help='Override the number of epochs.')
+
+    return parser
 
 
-    argv = parser.parse_args()
-    main()
\ No newline at end of file
+if __name__ == "__main__":
+    argv = build_parser().parse_args()
+    main(argv)
\ No newline at end of file
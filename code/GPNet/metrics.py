@@ -0,0 +1,76 @@
+#%%
+# On-device confusion-matrix accumulation.
+#
+# update() adds a batch with one bincount on the device the predictions live
+# on, so nothing is copied to the host or synchronised per step. The matrix is
+# only brought back (and optionally all-reduced across DDP ranks) when the
+# epoch's numbers are actually needed.
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+class ConfusionMatrixMeter:
+    def __init__(self, class_num, device):
+        self.class_num = class_num
+        self.matrix = torch.zeros(class_num * class_num, dtype=torch.long, device=device)
+
+    def reset(self):
+        self.matrix.zero_()
+
+    @torch.no_grad()
+    def update(self, pred_labels, labels):
+        # rows are true labels, columns predictions, as in the numpy loops this replaces
+        idx = labels.view(-1).long() * self.class_num + pred_labels.view(-1).long()
+        self.matrix += torch.bincount(idx, minlength=self.class_num * self.class_num)
+
+    def all_reduce(self):
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.matrix, op=dist.ReduceOp.SUM)
+
+    def compute(self):
+        # the only host sync: returns a float64 (class_num, class_num) numpy matrix
+        return self.matrix.view(self.class_num, self.class_num).cpu().numpy().astype(np.float64)
+
+    def load(self, cm):
+        self.matrix.copy_(torch.as_tensor(np.asarray(cm), dtype=torch.long).view(-1))
+
+    def accuracy(self, cm=None):
+        cm = self.compute() if cm is None else cm
+        return np.trace(cm) / max(np.sum(cm), 1.0)
+
+
+def compute_metrics(cm):
+    cm = cm.compute() if isinstance(cm, ConfusionMatrixMeter) else np.asarray(cm, dtype=np.float64)
+    # Initialize variables
+    TP = np.diag(cm)
+    FP = np.sum(cm, axis=0) - TP
+    FN = np.sum(cm, axis=1) - TP
+    TN = np.sum(cm) - (FP + FN + TP)
+
+    # Precision, Recall and F1 Score for each class
+    precision = TP / (TP + FP+1e-6)
+    recall = TP / (TP + FN+1e-6)
+    f1_score = 2 * (precision * recall) / (precision + recall+1e-6)
+
+    # Micro averaging (considering all classes together)
+    micro_precision = np.sum(TP) / (np.sum(TP) + np.sum(FP)+1e-6)
+    micro_recall = np.sum(TP) / (np.sum(TP) + np.sum(FN)+1e-6)
+    micro_f1_score = 2 * (micro_precision * micro_recall) / (micro_precision + micro_recall+1e-6)
+
+    # Macro averaging (taking the average across classes)
+    macro_precision = np.mean(precision)
+    macro_recall = np.mean(recall)
+    macro_f1_score = np.mean(f1_score)
+
+    return {
+        "Micro Precision": micro_precision,
+        "Micro Recall": micro_recall,
+        "Micro F1 Score": micro_f1_score,
+        "Macro Precision": macro_precision,
+        "Macro Recall": macro_recall,
+        "Macro F1 Score": macro_f1_score,
+        "Per Class Precision": precision.tolist(),
+        "Per Class Recall": recall.tolist(),
+        "Per Class F1 Score": f1_score.tolist()
+    }
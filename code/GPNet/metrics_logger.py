@@ -0,0 +1,143 @@
+#%%
+# Structured, rate-limited training log.
+#
+# log_step() only appends the step's scalars (still on the device) to a
+# buffer, so logging does not force a host sync. Every `flush_interval` steps
+# the buffer is handed to a background thread, which copies the values to the
+# host, reduces them and writes one JSON line (and optionally TensorBoard
+# scalars) with the mean/last values, samples/s, step latency percentiles and
+# memory high-water marks. A short summary of each flush is printed instead of
+# one line per step.
+import json
+import queue
+import resource
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+def memory_high_water():
+    memory = {"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}  # KB on Linux
+    if torch.cuda.is_available():
+        memory["max_memory_allocated_mb"] = torch.cuda.max_memory_allocated() / 2**20
+        memory["max_memory_reserved_mb"] = torch.cuda.max_memory_reserved() / 2**20
+    return memory
+
+
+def to_python(value):
+    if torch.is_tensor(value):
+        return value.item() if value.numel() == 1 else value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class MetricsLogger:
+    def __init__(self, path, flush_interval=50, tensorboard_dir=None, enabled=True, verbose=True):
+        """
+        Args:
+            path: JSONL file, appended to (so a resumed run continues the same log).
+            flush_interval: Steps buffered before they are reduced and written.
+            tensorboard_dir: Also write TensorBoard event files there (needs tensorboard installed).
+            enabled: False makes every call a no-op, e.g. on non-zero DDP ranks.
+            verbose: Print one summary line per flush.
+        """
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.verbose = verbose
+        if not enabled:
+            return
+        self.buffer = []
+        self.last_time = time.perf_counter()
+        self.fp = open(path, 'a')
+        self.tb_writer = None
+        if tensorboard_dir is not None:
+            from torch.utils.tensorboard import SummaryWriter
+            self.tb_writer = SummaryWriter(tensorboard_dir)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def log_step(self, step, epoch=None, batch_size=None, **scalars):
+        # scalars may be device tensors; they are only read in the background thread
+        if not self.enabled:
+            return
+        scalars = {k: v.detach() if torch.is_tensor(v) else v for k, v in scalars.items()}
+        self.buffer.append((step, epoch, time.perf_counter(), batch_size, scalars))
+        if len(self.buffer) >= self.flush_interval:
+            self.flush()
+
+    def log_event(self, kind, step=None, **values):
+        # one-off records such as validation accuracy or an epoch timing summary
+        if not self.enabled:
+            return
+        self.queue.put(("event", kind, step, values))
+
+    def mark(self):
+        # start of a run of consecutive steps, e.g. an epoch: whatever ran since the last
+        # step (validation, checkpointing) is not counted as the next step's latency
+        if not self.enabled:
+            return
+        self.flush()
+        self.last_time = time.perf_counter()
+
+    def flush(self):
+        if not self.enabled or not self.buffer:
+            return
+        buffer, self.buffer = self.buffer, []
+        self.queue.put(("steps", buffer, self.last_time, memory_high_water()))
+        self.last_time = buffer[-1][2]
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.fp.close()
+        if self.tb_writer is not None:
+            self.tb_writer.close()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if item[0] == "steps":
+                record = self._reduce_steps(*item[1:])
+            else:
+                _, kind, step, values = item
+                record = {"type": kind, "step": step, **{k: to_python(v) for k, v in values.items()}}
+            self._write(record)
+
+    def _reduce_steps(self, buffer, start_time, memory):
+        steps, epochs, times, batch_sizes, scalars = zip(*buffer)
+        # host-side wall time between consecutive log calls
+        latency_ms = np.diff(np.array((start_time,) + times)) * 1e3
+        elapsed = times[-1] - start_time
+        record = {"type": "train", "step": steps[-1], "epoch": epochs[-1], "n_steps": len(buffer)}
+        for name in scalars[0]:
+            values = torch.stack([torch.as_tensor(s[name]).float().cpu() for s in scalars]).numpy()
+            record[name] = float(values.mean())
+            record[f"{name}_last"] = float(values[-1])
+        if batch_sizes[0] is not None and elapsed > 0:
+            record["samples_per_s"] = float(sum(batch_sizes) / elapsed)
+        for q in (50, 90, 99):
+            record[f"step_ms_p{q}"] = float(np.percentile(latency_ms, q))
+        record.update(memory)
+        return record
+
+    def _write(self, record):
+        record["time"] = time.time()
+        self.fp.write(json.dumps(record) + "\n")
+        self.fp.flush()
+        step = record.get("step")
+        if self.tb_writer is not None and step is not None:
+            for k, v in record.items():
+                if k not in ("type", "step", "epoch", "time") and isinstance(v, (int, float)):
+                    self.tb_writer.add_scalar(f"{record['type']}/{k}", v, step)
+        if self.verbose:
+            shown = {k: v for k, v in record.items() if k not in ("type", "time") and not isinstance(v, list)}
+            print(f"[{record['type']}] " + " ".join(f"{k}={v:.4g}" if isinstance(v, float) else f"{k}={v}" for k, v in shown.items()))
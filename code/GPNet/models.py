@@ -5,6 +5,7 @@ import torch.nn.parallel
 import torch.utils.data
 from torch.autograd import Variable
 import torch.nn.functional as F
+from profiling import annotate
 
 class GSNet(nn.Module):
     def __init__(self, k=2, out_k=3) -> None:
@@ -45,7 +46,6 @@ class SNet(nn.Module):
         self.k = k
     
     def forward(self, x):
-        batchsize = x.size()[0]
         x = F.relu(self.bn1(self.conv1(x)))
         # x = F.relu(self.bn2(self.conv2(x)))
         # x = F.relu(self.bn3(self.conv3(x)))
@@ -62,9 +62,8 @@ class SNet(nn.Module):
         iden = np.eye(self.k)
         # Set the first element to 0
         iden[0, 0] = 0
-        iden_tensor = Variable(torch.from_numpy(iden.flatten().astype(np.float32))).view(1,self.k*self.k).repeat(batchsize,1)
-        if x.is_cuda:
-            iden_tensor = iden_tensor.cuda()
+        # broadcast over the batch instead of repeat() so the batch axis stays dynamic when exported
+        iden_tensor = torch.from_numpy(iden.flatten().astype(np.float32)).view(1,self.k*self.k).to(x.device)
         x = x + iden_tensor
         x = x.view(-1, self.k, self.k)
         return x, y
@@ -90,7 +89,6 @@ class STNkd(nn.Module):
         self.k = k
 
     def forward(self, x):
-        batchsize = x.size()[0]
         x = F.relu(self.bn1(self.conv1(x)))
         # x = F.relu(self.bn2(self.conv2(x)))
         # x = F.relu(self.bn3(self.conv3(x)))
@@ -101,9 +99,7 @@ class STNkd(nn.Module):
         # x = F.relu(self.bn5(self.fc2(x)))
         x = self.fc3(x)
 
-        iden = Variable(torch.from_numpy(np.eye(self.k).flatten().astype(np.float32))).view(1,self.k*self.k).repeat(batchsize,1)
-        if x.is_cuda:
-            iden = iden.cuda()
+        iden = torch.from_numpy(np.eye(self.k).flatten().astype(np.float32)).view(1,self.k*self.k).to(x.device)
         x = x + iden
         x = x.view(-1, self.k, self.k)
         return x
@@ -201,7 +197,8 @@ class PointNetfeat(nn.Module):
         n_pts = x.size()[2]
         x_res = x[:, 0, :]
         if self.snet_flag:
-            n_trans, norm_n = self.snet(x)
+            with annotate("SNet"):
+                n_trans, norm_n = self.snet(x)
             x = x.transpose(2, 1)
             x = torch.bmm(x, n_trans)
             x = x.transpose(2, 1)
@@ -211,7 +208,8 @@ class PointNetfeat(nn.Module):
 
         if self.tnet_flag:
             x_t_rest = x
-            trans = self.stn(x)
+            with annotate("STNkd"):
+                trans = self.stn(x)
             x = x.transpose(2, 1)
             x = torch.bmm(x, trans)
             x = 0.01*x.transpose(2, 1) + x_t_rest
@@ -221,7 +219,8 @@ class PointNetfeat(nn.Module):
 
         if self.feature_transform:
             x_f_rest = x
-            trans_feat = self.fstn(x)
+            with annotate("STNkd_feature"):
+                trans_feat = self.fstn(x)
             x = x.transpose(2,1)
             x = torch.bmm(x, trans_feat)
             x = 0.0001*x.transpose(2,1) + x_f_rest
@@ -234,16 +233,18 @@ class PointNetfeat(nn.Module):
 
 
         if self.atention_pooling_flag:
-            A = self.atention_pooling(x)
-            x = torch.bmm(x, A)
+            with annotate("attmil"):
+                A = self.atention_pooling(x)
+                x = torch.bmm(x, A)
         elif self.encoder_flag:
-            x = F.relu(self.bn_end(self.conv_end(x)))
-            x = x.view(-1, self.n_gene)
-            x = x #+ x_res
-            x = F.relu(self.encoder1(x))
-            x = F.relu(self.encoder2(x))
-            # x = self.dropout(x)
-            x = self.fc1(x)
+            with annotate("encoder"):
+                x = F.relu(self.bn_end(self.conv_end(x)))
+                x = x.view(-1, self.n_gene)
+                x = x #+ x_res
+                x = F.relu(self.encoder1(x))
+                x = F.relu(self.encoder2(x))
+                # x = self.dropout(x)
+                x = self.fc1(x)
         else:
             x = torch.max(x, 2, keepdim=True)[0] ######## think about how to change it to attention pooling
         x = x.view(-1, 32)
@@ -259,12 +260,13 @@ class PointNetCls(nn.Module):
                  tnet_flag = False, 
                  feature_transform=False, 
                  atention_pooling_flag = False,
-                 encoder_flag = True):
+                 encoder_flag = True,
+                 gene_num = 60660):
         
         super(PointNetCls, self).__init__()
-        self.gstn = GSNet(k=gene_idx_dim)
+        self.gstn = GSNet(k=gene_idx_dim, out_k=gene_space_num)
         self.feature_transform = feature_transform
-        self.feat = PointNetfeat(input_dim = gene_space_num+1, global_feat=True, 
+        self.feat = PointNetfeat(input_dim = gene_space_num+1, input_gene_num = gene_num, global_feat=True, 
                                  snet_flag = snet_flag,
                                  tnet_flag = tnet_flag,
                                  feature_transform=feature_transform, 
@@ -279,7 +281,8 @@ class PointNetCls(nn.Module):
         self.relu = nn.ReLU()
 
     def forward(self, x_feature, x_gene_idx):
-        x_gene_idx = self.gstn(x_gene_idx)
+        with annotate("GSNet"):
+            x_gene_idx = self.gstn(x_gene_idx)
         x = torch.cat([x_feature, x_gene_idx], 1)
         x, trans, trans_feat, norm_n = self.feat(x)
         x = x.view(-1, 32)
@@ -329,6 +332,33 @@ def feature_transform_regularizer(trans):
 def snet_regularizer(norm_n):
     return torch.mean(torch.norm(norm_n-1, dim=1))
 
+def freeze_unused_parameters(model):
+    # PointNetCls keeps layers that forward() never reaches: GSNet's conv2/bn2, and the
+    # encoder branch when attention pooling or max pooling is used. DDP expects a gradient
+    # for every parameter that requires one, so those stop requiring it; the state_dict
+    # keys stay the same.
+    unused = [model.gstn.conv2, model.gstn.bn2]
+    if model.feat.atention_pooling_flag or not model.feat.encoder_flag:
+        unused += [model.feat.conv_end, model.feat.bn_end, model.feat.encoder1, model.feat.encoder2, model.feat.fc1]
+    for module in unused:
+        module.requires_grad_(False)
+    return model
+
+def pointnet_config_from_state_dict(state_dict, encoder_flag = True):
+    # recover the PointNetCls constructor arguments from a saved state_dict.
+    # encoder_flag can't be inferred: the encoder layers exist either way.
+    keys = [k[7:] if k.startswith('module.') else k for k in state_dict.keys()]
+    weights = dict(zip(keys, state_dict.values()))
+    return dict(gene_idx_dim = weights['gstn.conv1.weight'].shape[1],
+                gene_space_num = weights['gstn.conv3.weight'].shape[0],
+                class_num = weights['fc3.weight'].shape[0],
+                snet_flag = any(k.startswith('feat.snet.') for k in keys),
+                tnet_flag = any(k.startswith('feat.stn.') for k in keys),
+                feature_transform = any(k.startswith('feat.fstn.') for k in keys),
+                atention_pooling_flag = any(k.startswith('feat.atention_pooling.') for k in keys),
+                encoder_flag = encoder_flag,
+                gene_num = weights['feat.encoder1.weight'].shape[1])
+
 class SimpleFNN(nn.Module):
     def __init__(self, input_size, output_size):
         super(SimpleFNN, self).__init__()
@@ -361,7 +391,7 @@ class SimpleFNN(nn.Module):
     
 #%%
 if __name__ == '__main__':
-    device = torch.device("cuda:0")
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     
     # test GSNet
     sim_data_gene_idx = Variable(torch.rand(8, 60660, 2))
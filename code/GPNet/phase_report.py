@@ -0,0 +1,125 @@
+#%%
+# Wall time and memory per phase of a long-running step such as load_data.
+#
+#   report = PhaseReport()
+#   with report.phase("read_csv"):
+#       df = pd.read_csv(...)
+#   report.close()
+#   print(report.summary()); report.to_json("load_report.json")
+#
+# Per phase it records the wall time, the bytes allocated by Python and numpy
+# (tracemalloc; net and peak within the phase) and the process RSS at start,
+# end and its peak during the phase. The RSS peak comes from a background
+# thread sampling /proc/self/statm, since getrusage only gives the peak over
+# the whole process lifetime.
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # no /proc (macOS): the lifetime peak is the best available, reported in bytes there
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class PhaseReport:
+    def __init__(self, trace_allocations=True, sample_interval=0.005):
+        """
+        Args:
+            trace_allocations: Track allocated bytes with tracemalloc. It slows down
+                allocation-heavy code (e.g. the CSV parse) somewhat; wall times are
+                closer to an untraced run without it.
+            sample_interval: Seconds between RSS samples.
+        """
+        self.phases = []
+        self.open_phases = []
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        self.started_tracing = trace_allocations and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        self.trace_allocations = trace_allocations
+        self.stop_event = threading.Event()
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+        self.sampler.start()
+
+    def _sample(self):
+        while not self.stop_event.wait(self.sample_interval):
+            rss = current_rss()
+            with self.lock:
+                for record in self.open_phases:
+                    record["peak_rss_bytes"] = max(record["peak_rss_bytes"], rss)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # phases may nest; each one gets its own numbers
+        rss = current_rss()
+        record = {"name": name, "rss_start_bytes": rss, "peak_rss_bytes": rss}
+        if self.trace_allocations:
+            traced_start = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        with self.lock:
+            record["depth"] = len(self.open_phases)
+            self.open_phases.append(record)
+        t0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_s"] = time.perf_counter() - t0
+            rss = current_rss()
+            with self.lock:
+                self.open_phases.remove(record)
+                record["rss_end_bytes"] = rss
+                record["peak_rss_bytes"] = max(record["peak_rss_bytes"], rss)
+                for outer in self.open_phases:
+                    outer["peak_rss_bytes"] = max(outer["peak_rss_bytes"], record["peak_rss_bytes"])
+            if self.trace_allocations:
+                traced, traced_peak = tracemalloc.get_traced_memory()
+                record["allocated_bytes"] = traced - traced_start
+                # with nested phases an inner phase resets the peak, so this is a lower bound for the outer one
+                record["peak_allocated_bytes"] = max(traced_peak - traced_start, 0)
+            self.phases.append(record)
+
+    def close(self):
+        self.stop_event.set()
+        self.sampler.join()
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def to_dict(self):
+        return {
+            "phases": self.phases,
+            # nested phases are part of their outer phase, so only the top level adds up
+            "total_wall_s": sum(p["wall_s"] for p in self.phases if p["depth"] == 0),
+            "peak_rss_bytes": max((p["peak_rss_bytes"] for p in self.phases), default=0),
+        }
+
+    def to_json(self, path):
+        with open(path, 'w') as fp:
+            json.dump(self.to_dict(), fp, indent=1)
+
+    def summary(self):
+        lines = [f"{'phase':24s} {'wall s':>9s} {'alloc MB':>10s} {'peak alloc MB':>14s} {'peak RSS MB':>12s}"]
+        for p in self.phases:
+            alloc = f"{p['allocated_bytes'] / 2**20:10.1f}" if "allocated_bytes" in p else f"{'-':>10s}"
+            peak_alloc = f"{p['peak_allocated_bytes'] / 2**20:14.1f}" if "peak_allocated_bytes" in p else f"{'-':>14s}"
+            name = "  " * p["depth"] + p["name"]
+            lines.append(f"{name:24s} {p['wall_s']:9.3f} {alloc} {peak_alloc} {p['peak_rss_bytes'] / 2**20:12.1f}")
+        return "\n".join(lines)
+
+
+def phase_or_null(report, name):
+    # lets instrumented code run unchanged when no report is requested
+    return report.phase(name) if report is not None else contextlib.nullcontext()
@@ -0,0 +1,198 @@
+#%%
+# Streaming batch prediction for new cohorts.
+#
+# The expression file is read in sample chunks, aligned to the training gene
+# order, normalized with the training statistics and scored in batches. Results
+# are appended chunk by chunk to a parquet file, so memory use is bounded by
+# --chunk_size rather than by the cohort size.
+#
+# usage:
+#   python predict.py --state_dict <best.pth> --preprocess_info <outf>/preprocess_info.json \
+#       --input new_cohort.csv --output predictions.parquet --attention
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from dataloader import gene_index_2d, load_preprocess_info
+from hook_register import Hook_register
+from models import PointNetCls, pointnet_config_from_state_dict
+from utils import strip_ddp_prefix
+
+
+def read_header(path, header_rows):
+    import pandas as pd
+    header = list(range(header_rows)) if header_rows > 1 else 0
+    columns = pd.read_csv(path, header=header, index_col=0, nrows=0).columns
+    return list(columns)
+
+
+def sample_ids_from_columns(columns):
+    # the training layout has (class, sample) columns; keep the sample part as id
+    # and the class part, if present, as the source label
+    if len(columns) and isinstance(columns[0], tuple):
+        return [str(c[-1]) for c in columns], [str(c[0]) for c in columns]
+    return [str(c) for c in columns], None
+
+
+def iter_sample_chunks(path, gene_names, chunk_size, header_rows=2, samples_in_rows=False, tmp_dir=None):
+    """Yields (sample_ids, source_labels, features) with at most chunk_size samples.
+
+    features is float32 (n, len(gene_names)) in training gene order; genes missing
+    from the file are 0 and genes unknown to the model are dropped, matching the
+    NaN -> 0 fill used in training.
+    """
+    # pandas (and pyarrow, which pandas 3 pulls in) only once a file is read
+    import pandas as pd
+    gene_to_col = {g: i for i, g in enumerate(gene_names)}
+    n_genes = len(gene_names)
+
+    if samples_in_rows:
+        # samples x genes: pandas can stream sample chunks directly
+        for chunk in pd.read_csv(path, index_col=0, chunksize=chunk_size):
+            cols = [gene_to_col.get(str(g), -1) for g in chunk.columns]
+            keep = np.array([c >= 0 for c in cols], dtype=bool)
+            features = np.zeros((len(chunk), n_genes), dtype=np.float32)
+            features[:, np.array(cols)[keep]] = chunk.values[:, keep].astype(np.float32)
+            yield [str(i) for i in chunk.index], None, np.nan_to_num(features, nan=0.0)
+        return
+
+    # genes x samples (the training layout): one streaming pass over gene rows
+    # transposes into an on-disk memmap, which is then read back in sample chunks
+    columns = read_header(path, header_rows)
+    sample_ids, source_labels = sample_ids_from_columns(columns)
+    n_samples = len(sample_ids)
+    # same number of cells per chunk as a chunk of chunk_size samples
+    gene_rows_per_chunk = max(1, chunk_size * n_genes // max(n_samples, 1))
+    header = list(range(header_rows)) if header_rows > 1 else 0
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        features_all = np.memmap(os.path.join(tmp, 'features.dat'), dtype=np.float32, mode='w+', shape=(n_samples, n_genes))
+        for chunk in pd.read_csv(path, header=header, index_col=0, chunksize=gene_rows_per_chunk):
+            rows = np.array([gene_to_col.get(str(g), -1) for g in chunk.index])
+            keep = rows >= 0
+            values = np.nan_to_num(chunk.values[keep].astype(np.float32), nan=0.0)
+            features_all[:, rows[keep]] = values.T
+        features_all.flush()
+        for start in range(0, n_samples, chunk_size):
+            end = min(start + chunk_size, n_samples)
+            yield (sample_ids[start:end],
+                   source_labels[start:end] if source_labels is not None else None,
+                   np.array(features_all[start:end]))
+        del features_all
+
+
+class ParquetChunkWriter:
+    def __init__(self, path, class_names, n_genes=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.class_names = class_names
+        self.n_genes = n_genes
+        fields = [pa.field('sample_id', pa.string()),
+                  pa.field('source_label', pa.string()),
+                  pa.field('pred_label', pa.string()),
+                  pa.field('pred_label_id', pa.int32())]
+        fields += [pa.field(f'prob_{name}', pa.float32()) for name in class_names]
+        if n_genes is not None:
+            fields.append(pa.field('attention', pa.list_(pa.float32(), n_genes)))
+        self.schema = pa.schema(fields)
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, sample_ids, source_labels, pred_ids, probs, attention=None):
+        pa = self.pa
+        columns = [pa.array(sample_ids, pa.string()),
+                   pa.array(source_labels if source_labels is not None else [None] * len(sample_ids), pa.string()),
+                   pa.array([self.class_names[i] for i in pred_ids], pa.string()),
+                   pa.array(pred_ids.astype(np.int32), pa.int32())]
+        columns += [pa.array(probs[:, i].astype(np.float32), pa.float32()) for i in range(probs.shape[1])]
+        if self.n_genes is not None:
+            flat = pa.array(attention.astype(np.float32).reshape(-1), pa.float32())
+            columns.append(pa.FixedSizeListArray.from_arrays(flat, self.n_genes))
+        self.writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def load_model(state_dict_path, device, encoder_flag=True):
+    model_state_dict = strip_ddp_prefix(torch.load(state_dict_path, map_location=torch.device('cpu')))
+    config = pointnet_config_from_state_dict(model_state_dict, encoder_flag=encoder_flag)
+    model = PointNetCls(**config)
+    model.load_state_dict(model_state_dict)
+    return model.to(device).eval(), config
+
+
+def predict_chunk(model, features, gene_idx, batch_size, activation=None):
+    # features: normalized float32 (n, n_genes); gene_idx: (1, 2, n_genes) on device
+    device = gene_idx.device
+    probs_all, attention_all = [], []
+    for start in range(0, features.shape[0], batch_size):
+        x_feature = torch.from_numpy(features[start:start + batch_size]).to(device).unsqueeze(1)
+        x_gene_idx = gene_idx.expand(x_feature.shape[0], -1, -1)
+        pred = model(x_feature, x_gene_idx)[0]
+        probs_all.append(F.softmax(pred, dim=1).cpu())
+        if activation is not None:
+            attention_all.append(activation['feat.atention_pooling'][:, :, 0].cpu())
+    probs = torch.cat(probs_all).numpy()
+    attention = torch.cat(attention_all).numpy() if activation is not None else None
+    return probs, attention
+
+
+def main(args):
+    device = torch.device(args.device if args.device else ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    info = load_preprocess_info(args.preprocess_info)
+    gene_names = info["gene_names"]
+    class_names = [info["number_to_label"][i] for i in range(len(info["number_to_label"]))]
+    model, config = load_model(args.state_dict, device, encoder_flag=not args.no_encoder)
+    if config['gene_num'] != len(gene_names):
+        raise ValueError(f"model expects {config['gene_num']} genes, preprocess info has {len(gene_names)}")
+
+    activation = None
+    if args.attention:
+        if not config['atention_pooling_flag']:
+            raise ValueError("--attention needs a model trained with attention pooling")
+        activation = Hook_register(model, [['feat', 'atention_pooling']], {})
+
+    gene_idx = torch.from_numpy(gene_index_2d(len(gene_names)).T.astype(np.float32)).unsqueeze(0).to(device)
+    writer = ParquetChunkWriter(args.output, class_names, n_genes=len(gene_names) if args.attention else None)
+    n_done = 0
+    start = time.perf_counter()
+    try:
+        with torch.inference_mode():
+            for sample_ids, source_labels, features in iter_sample_chunks(args.input, gene_names, args.chunk_size,
+                                                                          header_rows=args.header_rows,
+                                                                          samples_in_rows=args.samples_in_rows,
+                                                                          tmp_dir=args.tmp_dir):
+                features = (features - info["features_mean"]) / info["features_std"]
+                probs, attention = predict_chunk(model, features.astype(np.float32), gene_idx, args.batch_size, activation)
+                writer.write(sample_ids, source_labels, probs.argmax(axis=1), probs, attention)
+                n_done += len(sample_ids)
+                print(f"{n_done} samples scored ({n_done / (time.perf_counter() - start):.1f} samples/s)")
+    finally:
+        writer.close()
+
+
+def build_parser(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser(description='Batch prediction for new cohorts')
+    parser.add_argument('--state_dict', required=True, type=str)
+    parser.add_argument('--preprocess_info', required=True, type=str, help='preprocess_info.json written by main.py')
+    parser.add_argument('--input', required=True, type=str, help='expression csv')
+    parser.add_argument('--output', required=True, type=str, help='parquet file for the predictions')
+    parser.add_argument('--chunk_size', default=256, type=int, help='samples held in memory at once')
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--header_rows', default=2, type=int, help='2 for (class, sample) headers as in training, 1 for sample ids only')
+    parser.add_argument('--samples_in_rows', action='store_true', help='input is samples x genes instead of genes x samples')
+    parser.add_argument('--attention', action='store_true', help='also write per-gene attention scores')
+    parser.add_argument('--no_encoder', action='store_true')
+    parser.add_argument('--device', default=None, type=str)
+    parser.add_argument('--tmp_dir', default=None, type=str, help='where to put the transposed memmap')
+    return parser
+
+
+if __name__ == '__main__':
+    main(build_parser().parse_args())
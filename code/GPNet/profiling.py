@@ -0,0 +1,59 @@
+#%%
+# PyTorch profiler integration.
+#
+# annotate() marks a region (data loading, GSNet, SNet/STNkd, attmil, encoder,
+# loss, ...) so it shows up as a named block in the trace and in the operator
+# tables; outside a profiling window it costs next to nothing.
+# make_profiler() returns a step-scheduled profiler: it skips `wait` steps,
+# warms up for `warmup` steps and records `active` steps, then writes a Chrome
+# trace (open in chrome://tracing or Perfetto) and operator summary tables.
+import contextlib
+import os
+
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function, schedule
+
+
+def annotate(name):
+    # record_function ops would end up in a traced graph (e.g. ONNX export), so skip them there
+    if torch.jit.is_tracing() or torch.jit.is_scripting():
+        return contextlib.nullcontext()
+    return record_function(name)
+
+
+def write_tables(prof, path, row_limit=30):
+    """Operator summaries: by self time, by call stack, by input shape and by memory."""
+    sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+    sections = [
+        ("operators by self time", prof.key_averages().table(sort_by=sort_by, row_limit=row_limit)),
+        ("operators grouped by call stack", prof.key_averages(group_by_stack_n=5).table(sort_by=sort_by, row_limit=row_limit)),
+        ("operators grouped by input shape", prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=row_limit)),
+        ("operators by self memory", prof.key_averages().table(sort_by="self_cpu_memory_usage", row_limit=row_limit)),
+    ]
+    with open(path, 'w') as fp:
+        for title, table in sections:
+            fp.write(f"== {title} ==\n{table}\n\n")
+    return sections[0][1]
+
+
+def make_profiler(out_dir, wait=5, warmup=2, active=10, repeat=1, tag="", row_limit=30):
+    """Profiler over one window of steps; call .start(), .step() after every step and .stop()."""
+    os.makedirs(out_dir, exist_ok=True)
+    prefix = f"{tag}_" if tag else ""
+
+    def on_trace_ready(prof):
+        trace_path = os.path.join(out_dir, f"{prefix}trace_step{prof.step_num}.json")
+        table_path = os.path.join(out_dir, f"{prefix}ops_step{prof.step_num}.txt")
+        prof.export_chrome_trace(trace_path)
+        print(write_tables(prof, table_path, row_limit=row_limit))
+        print(f"profiler trace written to {trace_path}, tables to {table_path}")
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    return profile(activities=activities,
+                   schedule=schedule(wait=wait, warmup=warmup, active=active, repeat=repeat),
+                   on_trace_ready=on_trace_ready,
+                   record_shapes=True,
+                   profile_memory=True,
+                   with_stack=True)
@@ -0,0 +1,181 @@
+#%%
+# Dynamic INT8 quantization of the four model families for CPU inference.
+#
+# The large nn.Linear layers (PointNetfeat.encoder1, SimpleFNN.fc1,
+# SparseAutoencoder.encoder1/decoder2, CustomCNN.fc1) are converted to INT8
+# weights with activations quantized on the fly. Conv layers stay fp32.
+#
+# usage:
+#   python quantize.py --family gpnet --state_dict <best.pth> --data_dir <csv> --snet --tnet --feature_transform
+#   python quantize.py --family ssae --state_dict <best.pth> --data_dir <csv> --save ssae_int8.pth
+import argparse
+import importlib.util
+import io
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from models import PointNetCls, SimpleFNN, transpose_input
+from utils import strip_ddp_prefix
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAMILIES = ['gpnet', 'fnn', 'ssae', 'cnn']
+
+
+def load_module_from_path(name, path):
+    # the baselines live in sibling folders and share module names (model.py),
+    # so they are loaded by path instead of through sys.path
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_model(family, class_num, n_gene, args):
+    if family == 'gpnet':
+        return PointNetCls(gene_idx_dim = 2,
+                           gene_space_num = args.gene_space_dim,
+                           class_num = class_num,
+                           snet_flag = args.snet,
+                           tnet_flag = args.tnet,
+                           feature_transform = args.feature_transform,
+                           atention_pooling_flag = args.attention,
+                           encoder_flag = not args.no_encoder)
+    elif family == 'fnn':
+        return SimpleFNN(input_size = n_gene, output_size = class_num)
+    elif family == 'ssae':
+        ssae_model = load_module_from_path('ssae_model', os.path.join(CODE_DIR, 'SSAE', 'model.py'))
+        return ssae_model.SparseAutoencoder(n_input = n_gene, n_output = class_num)
+    elif family == 'cnn':
+        cnn_model = load_module_from_path('cnn_model', os.path.join(CODE_DIR, 'CNN_for_gene_expression', 'model.py'))
+        return cnn_model.CustomCNN(class_num = class_num)
+    else:
+        raise ValueError(f"Invalid family {family}.")
+
+
+def load_test_loader(family, data_dir, batch_size):
+    if family == 'cnn':
+        cnn_data = load_module_from_path('cnn_dataloader', os.path.join(CODE_DIR, 'CNN_for_gene_expression', 'dataloader_heatmap.py'))
+        loaded = cnn_data.load_data(file_path=data_dir, batch_size=batch_size)
+    else:
+        from dataloader import load_data
+        loaded = load_data(file_path=data_dir, batch_size=batch_size)
+    gene_number_name_mapping, number_to_label, feature_num, train_loader, val_loader, test_loader = loaded
+    return len(gene_number_name_mapping), len(number_to_label), test_loader
+
+
+def forward_logits(family, model, data):
+    # every family returns class logits; the remaining batch items are labels
+    if family == 'gpnet':
+        features1_count, features2_gene_idx, labels = data
+        features1_count, features2_gene_idx = transpose_input(features1_count, features2_gene_idx)
+        pred = model(features1_count, features2_gene_idx)[0]
+    elif family == 'cnn':
+        features1_count, labels = data
+        pred = model(features1_count.float())
+    else:
+        features1_count, features2_gene_idx, labels = data
+        pred = model(features1_count.float())
+        if family == 'ssae':
+            pred = pred[2]
+    return pred, labels
+
+
+def quantize_model(model):
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1e6
+
+
+def evaluate_accuracy(family, model, test_loader):
+    total_correct = 0
+    total_testset = 0
+    with torch.inference_mode():
+        for data in test_loader:
+            pred, labels = forward_logits(family, model, data)
+            total_correct += (pred.argmax(dim=1) == labels).sum().item()
+            total_testset += labels.shape[0]
+    return total_correct / float(total_testset)
+
+
+def benchmark_latency(family, model, data, n_warmup=3, n_iter=20):
+    batch_size = data[-1].shape[0]
+    times = []
+    with torch.inference_mode():
+        for i in range(n_warmup + n_iter):
+            start = time.perf_counter()
+            forward_logits(family, model, data)
+            if i >= n_warmup:
+                times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return {
+        "latency_ms_p50": float(np.percentile(times, 50) * 1e3),
+        "latency_ms_mean": float(times.mean() * 1e3),
+        "throughput_samples_per_s": float(batch_size / times.mean()),
+    }
+
+
+def compare_fp32_int8(family, model, test_loader, n_iter=20):
+    model.eval()
+    qmodel = quantize_model(model)
+    first_batch = next(iter(test_loader))
+    results = {}
+    for name, m in [('fp32', model), ('int8', qmodel)]:
+        results[name] = {
+            "accuracy": evaluate_accuracy(family, m, test_loader),
+            "size_mb": model_size_mb(m),
+            **benchmark_latency(family, m, first_batch, n_iter=n_iter),
+        }
+    results['speedup'] = results['fp32']['latency_ms_mean'] / results['int8']['latency_ms_mean']
+    results['accuracy_drop'] = results['fp32']['accuracy'] - results['int8']['accuracy']
+    return qmodel, results
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    n_gene, class_num, test_loader = load_test_loader(args.family, args.data_dir, args.batch_size)
+    model = build_model(args.family, class_num, n_gene, args)
+    model_state_dict = torch.load(args.state_dict, map_location=torch.device('cpu'))
+    model.load_state_dict(strip_ddp_prefix(model_state_dict))
+
+    qmodel, results = compare_fp32_int8(args.family, model, test_loader, n_iter=args.n_iter)
+    for name in ['fp32', 'int8']:
+        r = results[name]
+        print(f"{name}: accuracy {r['accuracy']:.4f} size {r['size_mb']:.1f}MB "
+              f"latency p50 {r['latency_ms_p50']:.2f}ms throughput {r['throughput_samples_per_s']:.1f} samples/s")
+    print(f"speedup {results['speedup']:.2f}x accuracy drop {results['accuracy_drop']:.4f}")
+
+    if args.save:
+        torch.save(qmodel.state_dict(), args.save)
+    if args.out:
+        with open(args.out, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Dynamic INT8 quantization')
+    parser.add_argument('--family', required=True, choices=FAMILIES)
+    parser.add_argument('--state_dict', required=True, type=str, help='fp32 state_dict saved by main.py')
+    parser.add_argument('--data_dir', required=True, type=str, help='training csv, used to rebuild the test split')
+    parser.add_argument('--batch_size', default=60, type=int)
+    parser.add_argument('--threads', default=os.cpu_count(), type=int)
+    parser.add_argument('--n_iter', default=20, type=int, help='timed iterations for latency')
+    parser.add_argument('--save', default=None, type=str, help='where to save the quantized state_dict')
+    parser.add_argument('--out', default=None, type=str, help='json file for the comparison report')
+    # PointNetCls flags, only used with --family gpnet
+    parser.add_argument('--gene_space_dim', default=3, type=int)
+    parser.add_argument('--snet', action='store_true')
+    parser.add_argument('--tnet', action='store_true')
+    parser.add_argument('--feature_transform', action='store_true')
+    parser.add_argument('--attention', action='store_true')
+    parser.add_argument('--no_encoder', action='store_true')
+    main(parser.parse_args())
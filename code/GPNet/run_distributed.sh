@@ -1,33 +1,27 @@
 #!/bin/bash
-NNODES=2
-# Local command
-module load cuda-toolkit/11.8.0
-python -m torch.distributed.launch --nproc_per_node=1 --nnodes=$NNODES --node_rank=0 --master_addr="172.21.7.53" --master_port=1234 main.py --local-rank=0 &
+# Elastic launcher for main.py (torchrun, c10d rendezvous).
+#
+# Single box, 4 CPU processes on the gloo backend:
+#   NPROC=4 ./run_distributed.sh --data_dir small.csv --outf /tmp/gpnet --max_epoch 2
+# Several nodes: run the same command on every node, pointing RDZV_HOST at one of them.
+# NNODES can be a range (e.g. 1:4) so the job starts with what is available and
+# re-forms when nodes join or leave. After a worker failure torchrun restarts all
+# processes (up to MAX_RESTARTS times) and main.py resumes from its last training state.
+#
+# The backend follows the hardware (nccl with CUDA, gloo otherwise); pass --backend to override.
+NNODES=${NNODES:-1}
+NPROC=${NPROC:-1}
+RDZV_HOST=${RDZV_HOST:-localhost}
+RDZV_PORT=${RDZV_PORT:-29400}
+RDZV_ID=${RDZV_ID:-gpnet}
+MAX_RESTARTS=${MAX_RESTARTS:-3}
 
-sleep 2s
-
-# Remote command via SSH
-ssh haolu@172.21.7.54 '
-module load cuda-toolkit/11.8.0
-conda activate rank
-cd /isilon/datalake/cialab/scratch/cialab/Hao/work_record/Project1_GM/codes/Point_cloud_gene_expression
-python -m torch.distributed.launch --nproc_per_node=1 --nnodes=$NNODES --node_rank=1 --master_addr="172.21.7.53" --master_port=1234 main.py --local-rank=0 &
-'
-
-# # Remote command via SSH
-# ssh haolu@172.21.7.52 '
-# module load cuda-toolkit/11.8.0
-# conda activate rank
-# cd /isilon/datalake/cialab/scratch/cialab/Hao/work_record/Project1_GM/codes/Point_cloud_gene_expression
-# python -m torch.distributed.launch --nproc_per_node=1 --nnodes=$NNODES --node_rank=2 --master_addr="172.21.7.53" --master_port=1234 main.py --local-rank=0 &
-# '
-# # Remote command via SSH
-# ssh haolu@172.21.7.51 '
-# module load cuda-toolkit/11.8.0
-# conda activate rank
-# cd /isilon/datalake/cialab/scratch/cialab/Hao/work_record/Project1_GM/codes/Point_cloud_gene_expression
-# python -m torch.distributed.launch --nproc_per_node=1 --nnodes=$NNODES --node_rank=3 --master_addr="172.21.7.53" --master_port=1234 main.py --local-rank=0 &
-# '
-
-# Wait for all background processes to finish
-wait
\ No newline at end of file
+cd "$(dirname "$0")"
+torchrun \
+    --nnodes=$NNODES \
+    --nproc_per_node=$NPROC \
+    --max_restarts=$MAX_RESTARTS \
+    --rdzv_backend=c10d \
+    --rdzv_endpoint=$RDZV_HOST:$RDZV_PORT \
+    --rdzv_id=$RDZV_ID \
+    main.py "$@"
@@ -0,0 +1,93 @@
+#%%
+# Samplers that can resume in the middle of an epoch.
+#
+# The shuffle order only depends on (seed, epoch), not on the global RNG, and
+# set_start_index() skips the samples that were already consumed before a
+# checkpoint. The skip applies to the next iteration only.
+# DistributedEvalSampler splits val/test sets across ranks for evaluation.
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+from torch.utils.data.distributed import DistributedSampler
+
+
+class ResumableRandomSampler(Sampler):
+    def __init__(self, data_source, seed=42):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_index(self, start_index):
+        self.start_index = start_index
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch}
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.data_source), generator=g).tolist()
+        indices = indices[self.start_index:]
+        self.start_index = 0
+        return iter(indices)
+
+    def __len__(self):
+        return len(self.data_source) - self.start_index
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    def __init__(self, *args, **kwargs):
+        super(ResumableDistributedSampler, self).__init__(*args, **kwargs)
+        self.start_index = 0
+
+    def set_start_index(self, start_index):
+        # position within this rank's shard
+        self.start_index = start_index
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch}
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+
+    def __iter__(self):
+        indices = list(super(ResumableDistributedSampler, self).__iter__())[self.start_index:]
+        self.start_index = 0
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+
+class DistributedEvalSampler(Sampler):
+    """Shards an evaluation set across ranks without padding.
+
+    DistributedSampler pads the last shard with repeated samples so every rank
+    gets the same count, which double-counts them in the metrics. Here rank r
+    takes samples r, r + world_size, ..., so the shards are disjoint and cover
+    the set exactly once; they differ in length by at most one, so evaluation
+    must not run collectives per batch (use the unwrapped model, not DDP).
+    """
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.num_replicas))
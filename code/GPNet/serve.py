@@ -0,0 +1,312 @@
+#%%
+# Local prediction server with dynamic micro-batching.
+#
+# The checkpoint is loaded once. Concurrent requests are queued and coalesced
+# into micro-batches of up to --max_batch_size samples; a batch is dispatched
+# as soon as it is full or the oldest request has waited --max_wait_ms.
+#
+# usage:
+#   python serve.py --state_dict <best.pth> --preprocess_info <outf>/preprocess_info.json --port 8080
+#   python serve.py --state_dict <best.pth> --preprocess_info <...> --unix_socket /tmp/gpnet.sock
+#   python serve.py --demo --gene_num 2000 --selftest 200      # random CPU model, localhost only
+#
+#   POST /predict  {"features": [...]}         raw counts in training gene order, one sample or a list of samples
+#                  {"genes": {"name": count}}  raw counts by gene name
+#   GET  /stats    latency percentiles, throughput and batch-size counters
+#   GET  /health
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from dataloader import gene_index_2d, load_preprocess_info
+from models import PointNetCls
+
+
+class LatencyStats:
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.n_requests = 0
+        self.n_samples = 0
+        self.n_batches = 0
+        self.start_time = time.perf_counter()
+
+    def record_batch(self, latencies, n_samples):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.batch_sizes.append(n_samples)
+            self.n_requests += len(latencies)
+            self.n_samples += n_samples
+            self.n_batches += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1e3
+            batch_sizes = np.array(self.batch_sizes)
+            uptime = time.perf_counter() - self.start_time
+            return {
+                "requests": self.n_requests,
+                "samples": self.n_samples,
+                "batches": self.n_batches,
+                "uptime_s": uptime,
+                "throughput_samples_per_s": self.n_samples / uptime if uptime > 0 else 0.0,
+                "latency_ms_p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "latency_ms_p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                "mean_batch_size": float(batch_sizes.mean()) if len(batch_sizes) else None,
+            }
+
+
+class MicroBatcher:
+    def __init__(self, model, gene_idx, features_mean, features_std, max_batch_size=32, max_wait_ms=5.0):
+        self.model = model
+        self.gene_idx = gene_idx  # (1, 2, n_genes) on the model device
+        self.features_mean = features_mean
+        self.features_std = features_std
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1e3
+        self.requests = queue.Queue()
+        # a request that did not fit into the previous batch starts the next one
+        self.pending = None
+        self.stats = LatencyStats()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.running = True
+        self.thread.start()
+
+    def submit(self, features):
+        # features: raw counts (n, n_genes); resolves to a (n, class_num) probability array
+        future = Future()
+        self.requests.put((np.atleast_2d(np.asarray(features, dtype=np.float32)), future, time.perf_counter()))
+        return future
+
+    def stop(self):
+        self.running = False
+        self.requests.put(None)
+        self.thread.join()
+
+    def _collect(self):
+        if self.pending is not None:
+            first, self.pending = self.pending, None
+        else:
+            first = self.requests.get()
+        if first is None:
+            return []
+        batch = [first]
+        n_samples = first[0].shape[0]
+        deadline = first[2] + self.max_wait
+        while n_samples < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                # past the deadline, still take what is already queued: under load
+                # every request has waited longer than max_wait by the time it is read
+                item = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.running = False
+                break
+            if n_samples + item[0].shape[0] > self.max_batch_size:
+                self.pending = item
+                break
+            batch.append(item)
+            n_samples += item[0].shape[0]
+        return batch
+
+    def _run(self):
+        device = self.gene_idx.device
+        while self.running:
+            batch = self._collect()
+            if not batch:
+                break
+            try:
+                features = np.concatenate([item[0] for item in batch])
+                features = (features - self.features_mean) / self.features_std
+                with torch.inference_mode():
+                    x_feature = torch.from_numpy(features.astype(np.float32)).to(device).unsqueeze(1)
+                    x_gene_idx = self.gene_idx.expand(x_feature.shape[0], -1, -1)
+                    probs = F.softmax(self.model(x_feature, x_gene_idx)[0], dim=1).cpu().numpy()
+            except Exception as e:
+                for item in batch:
+                    item[1].set_exception(e)
+                continue
+            done = time.perf_counter()
+            start = 0
+            for item in batch:
+                n = item[0].shape[0]
+                item[1].set_result(probs[start:start + n])
+                start += n
+            self.stats.record_batch([done - item[2] for item in batch], features.shape[0])
+
+
+def make_handler(batcher, gene_names, class_names):
+    gene_to_col = {g: i for i, g in enumerate(gene_names)}
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+        def address_string(self):
+            # client_address is an empty string on unix sockets
+            return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, code, body):
+            payload = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send_json(200, batcher.stats.summary())
+            elif self.path == '/health':
+                self._send_json(200, {"status": "ok"})
+            else:
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if 'genes' in request:
+                    if not isinstance(request['genes'], dict):
+                        raise TypeError("'genes' must be an object of gene name to count")
+                    features = np.zeros(len(gene_names), dtype=np.float32)
+                    for gene, count in request['genes'].items():
+                        if gene in gene_to_col:
+                            features[gene_to_col[gene]] = count
+                else:
+                    features = np.atleast_2d(np.asarray(request['features'], dtype=np.float32))
+                    if features.ndim != 2:
+                        raise ValueError(f"features must be one sample or a list of samples, got {features.ndim} dimensions")
+                    if features.shape[1] != len(gene_names):
+                        raise ValueError(f"expected {len(gene_names)} genes, got {features.shape[1]}")
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            try:
+                probs = batcher.submit(features).result()
+            except Exception as e:
+                self._send_json(500, {"error": str(e)})
+                return
+            pred_ids = probs.argmax(axis=1)
+            self._send_json(200, {
+                "pred_label": [class_names[i] for i in pred_ids],
+                "pred_label_id": pred_ids.tolist(),
+                "probabilities": probs.tolist(),
+            })
+
+    return PredictionHandler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(handler, host='127.0.0.1', port=8080, unix_socket=None):
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def run_selftest(port, n_requests, n_genes, concurrency=16):
+    # fire concurrent single-sample requests at the server and print its counters
+    import urllib.request
+    rng = np.random.default_rng(0)
+    bodies = [json.dumps({"features": rng.poisson(5, n_genes).tolist()}).encode() for _ in range(n_requests)]
+
+    def one_request(body):
+        req = urllib.request.Request(f"http://127.0.0.1:{port}/predict", data=body,
+                                     headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req) as resp:
+            return json.loads(resp.read())
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one_request, bodies))
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as resp:
+        stats = json.loads(resp.read())
+    assert len(results) == n_requests
+    print(json.dumps(stats, indent=2))
+    return stats
+
+
+def main(args):
+    device = torch.device(args.device if args.device else ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    if args.demo:
+        # random weights, used for exercising the server without a checkpoint
+        torch.manual_seed(0)
+        model = PointNetCls(class_num=args.class_num, gene_num=args.gene_num,
+                            atention_pooling_flag=False, encoder_flag=True).to(device).eval()
+        gene_names = [f"gene_{i}" for i in range(args.gene_num)]
+        class_names = [f"class_{i}" for i in range(args.class_num)]
+        features_mean, features_std = 0.0, 1.0
+    else:
+        from predict import load_model
+        info = load_preprocess_info(args.preprocess_info)
+        gene_names = info["gene_names"]
+        class_names = [info["number_to_label"][i] for i in range(len(info["number_to_label"]))]
+        features_mean, features_std = info["features_mean"], info["features_std"]
+        model, _ = load_model(args.state_dict, device, encoder_flag=not args.no_encoder)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    gene_idx = torch.from_numpy(gene_index_2d(len(gene_names)).T.astype(np.float32)).unsqueeze(0).to(device)
+    batcher = MicroBatcher(model, gene_idx, features_mean, features_std,
+                           max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    server = make_server(make_handler(batcher, gene_names, class_names),
+                         host=args.host, port=0 if args.selftest else args.port,
+                         unix_socket=None if args.selftest else args.unix_socket)
+    if args.selftest:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        run_selftest(server.server_address[1], args.selftest, len(gene_names))
+        server.shutdown()
+        batcher.stop()
+        return
+
+    print(f"serving on {args.unix_socket or f'{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local prediction server')
+    parser.add_argument('--state_dict', default=None, type=str)
+    parser.add_argument('--preprocess_info', default=None, type=str)
+    parser.add_argument('--no_encoder', action='store_true')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--unix_socket', default=None, type=str)
+    parser.add_argument('--max_batch_size', default=32, type=int)
+    parser.add_argument('--max_wait_ms', default=5.0, type=float, help='latency budget for filling a micro-batch')
+    parser.add_argument('--device', default=None, type=str)
+    parser.add_argument('--threads', default=None, type=int)
+    parser.add_argument('--demo', action='store_true', help='serve a randomly initialised model')
+    parser.add_argument('--gene_num', default=60660, type=int, help='genes for --demo')
+    parser.add_argument('--class_num', default=10, type=int, help='classes for --demo')
+    parser.add_argument('--selftest', default=0, type=int, help='send this many concurrent requests on a random localhost port, print stats and exit')
+    args = parser.parse_args()
+    if not args.demo and (args.state_dict is None or args.preprocess_info is None):
+        parser.error('--state_dict and --preprocess_info are required unless --demo is given')
+    main(args)
@@ -0,0 +1,54 @@
+#%%
+# Sharing the prepared dataset between training processes.
+#
+# share_data() copies the arrays returned by dataloader.prepare_data() into
+# named shared-memory blocks once; every worker then calls attach_data() with
+# the small picklable spec and reads the same pages, so N parallel runs hold one
+# copy of the normalized matrix instead of N.
+from multiprocessing import shared_memory
+
+import numpy as np
+
+SHARED_KEYS = ("features", "labels", "gene_idx", "train_idx", "val_idx", "test_idx")
+
+
+class SharedData:
+    def __init__(self, data):
+        """Owner side: call close() once all workers are done."""
+        self.blocks = []
+        self.spec = {"arrays": {}, "meta": {}}
+        for key, value in data.items():
+            if key not in SHARED_KEYS:
+                # mappings are small and are pickled with the spec
+                self.spec["meta"][key] = value
+                continue
+            value = np.ascontiguousarray(value)
+            shm = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+            np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)[...] = value
+            self.blocks.append(shm)
+            self.spec["arrays"][key] = (shm.name, value.shape, value.dtype.str)
+
+    def close(self):
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+
+def share_data(data):
+    return SharedData(data)
+
+
+def attach_data(spec):
+    """Worker side: returns (data, blocks); keep `blocks` alive while the arrays are used.
+
+    The arrays are views on the shared pages; treat them as read-only.
+    """
+    data = dict(spec["meta"])
+    blocks = []
+    for key, (name, shape, dtype) in spec["arrays"].items():
+        shm = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        data[key] = array
+        blocks.append(shm)
+    return data, blocks
@@ -0,0 +1,243 @@
+#%%
+# Ablation sweep over the PointNetCls flags on one machine.
+#
+# The CSV is read and normalized once, put in shared memory, and every run in
+# the process pool trains from the same pages. Each worker owns one device
+# (a GPU, or the CPU with --threads intra-op threads) for its whole life, and
+# the results of all runs go into one table with wall-clock and throughput.
+#
+#   python sweep.py --data_dir counts.csv --snet_flag 0 1 --atention_pooling_flag 0 1 --gene_space_dim 3 8
+import argparse
+import itertools
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.optim as optim
+
+from dataloader import make_loaders, prepare_data
+from metrics import compute_metrics
+from models import PointNetCls
+from shared_data import attach_data, share_data
+from trainer import Trainer, make_criterion, normalized_class_weights, pointnet_forward, pointnet_regularizers
+
+FLAG_NAMES = ['snet_flag', 'tnet_flag', 'feature_transform', 'atention_pooling_flag', 'encoder_flag']
+
+# per-process state set up by init_worker
+_worker = {}
+
+
+def build_grid(args):
+    names = FLAG_NAMES + ['gene_space_dim']
+    values = [[bool(v) for v in getattr(args, name)] for name in FLAG_NAMES] + [args.gene_space_dim]
+    configs = []
+    for combo in itertools.product(*values):
+        config = dict(zip(names, combo))
+        config['name'] = "_".join(f"{name}_{config[name]}" for name in names)
+        configs.append(config)
+    return configs
+
+
+def default_devices():
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return ['cpu']
+
+
+def init_worker(spec, device_queue, num_threads):
+    data, blocks = attach_data(spec)
+    _worker['data'] = data
+    _worker['blocks'] = blocks
+    _worker['device'] = torch.device(device_queue.get())
+    torch.set_num_threads(num_threads)
+    if _worker['device'].type == 'cuda':
+        torch.cuda.set_device(_worker['device'])
+
+
+def train_config(data, config, settings, device):
+    """Trains one configuration and returns (result row, test confusion matrix)."""
+    torch.manual_seed(settings['seed'])
+    class_num = len(data['number_to_label'])
+    train_loader, val_loader, test_loader = make_loaders(data, batch_size=settings['batch_size'], num_workers=settings['num_workers'])
+
+    model = PointNetCls(gene_idx_dim = 2,
+                        gene_space_num = config['gene_space_dim'],
+                        class_num = class_num,
+                        snet_flag = config['snet_flag'],
+                        tnet_flag = config['tnet_flag'],
+                        feature_transform = config['feature_transform'],
+                        atention_pooling_flag = config['atention_pooling_flag'],
+                        encoder_flag = config['encoder_flag'],
+                        gene_num = data['features'].shape[1])
+    model.to(device)
+    optimizer = optim.Adam(model.parameters(), lr=settings['lr'], betas=(0.9, 0.999))
+    scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=2, gamma=0.9)
+    normalized_weights = normalized_class_weights(data['feature_num']).to(device)
+    criterion = make_criterion(settings['loss'], settings['weight_loss'], normalized_weights)
+    trainer = Trainer(model, optimizer, criterion, device, class_num,
+                      forward_fn = pointnet_forward,
+                      regularizers = pointnet_regularizers(config['feature_transform'], config['snet_flag']),
+                      log_interval = settings['log_interval'],
+                      is_main_process = settings['verbose'])
+
+    best_acc = 0
+    train_time = 0.0
+    train_samples = 0
+    step_ms = []
+    t_start = time.perf_counter()
+    for epoch in range(settings['max_epoch']):
+        scheduler.step()
+        t_epoch = time.perf_counter()
+        trainer.train_epoch(train_loader, epoch)
+        train_time += time.perf_counter() - t_epoch
+        train_samples += len(train_loader.dataset)
+        step_ms.append(trainer.timing_summary()['step_ms'])
+        if epoch % settings['eval_interval'] == 0 or epoch == settings['max_epoch'] - 1:
+            val_acc = trainer.eval_meter.accuracy(trainer.evaluate(val_loader))
+            if val_acc > best_acc:
+                best_acc = val_acc
+                if settings['outf']:
+                    torch.save(model.state_dict(), f"{settings['outf']}/sweep_{config['name']}_best.pth")
+    confusion_matrix_test = trainer.evaluate(test_loader)
+    wall_clock = time.perf_counter() - t_start
+    metrics = compute_metrics(confusion_matrix_test)
+
+    row = {name: config[name] for name in FLAG_NAMES + ['gene_space_dim']}
+    row.update({
+        "device": str(device),
+        "n_params": sum(p.numel() for p in model.parameters()),
+        "wall_clock_s": wall_clock,
+        "train_samples_per_s": train_samples / train_time if train_time > 0 else 0.0,
+        "step_ms": float(np.mean(step_ms)) if step_ms else 0.0,
+        "best_val_acc": best_acc,
+        "test_acc": trainer.eval_meter.accuracy(confusion_matrix_test),
+        "test_macro_f1": metrics["Macro F1 Score"],
+        "error": "",
+    })
+    return row, confusion_matrix_test
+
+
+def run_config(config, settings):
+    # runs inside a pool worker; a failing configuration is reported, not raised
+    device = _worker['device']
+    try:
+        row, _ = train_config(_worker['data'], config, settings, device)
+    except Exception as e:
+        row = {name: config[name] for name in FLAG_NAMES + ['gene_space_dim']}
+        row.update({"device": str(device), "error": f"{type(e).__name__}: {e}"})
+    print(f"done {config['name']} on {device} {row.get('wall_clock_s', float('nan')):.1f}s {row['error']}")
+    return row
+
+
+def start_pool(spec, devices, workers, threads):
+    # spawn, so CUDA can be initialised in the workers
+    ctx = mp.get_context('spawn')
+    device_queue = ctx.Queue()
+    for i in range(workers):
+        # workers are spread round-robin over the devices
+        device_queue.put(devices[i % len(devices)])
+    return ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=init_worker,
+                               initargs=(spec, device_queue, threads))
+
+
+def resolve_workers(devices, workers, threads):
+    # default: one worker per GPU; on CPU as many workers as the thread budget allows
+    n_cpu = os.cpu_count() or 1
+    if workers is None:
+        workers = len(devices) if devices != ['cpu'] else max(1, n_cpu // (threads or 4))
+    if threads is None:
+        threads = max(1, n_cpu // workers)
+    return workers, threads
+
+
+def run_sweep(data, configs, settings, devices, workers, threads):
+    """Trains every configuration across `workers` processes and returns the results table."""
+    shared = share_data(data)
+    rows = []
+    t_start = time.perf_counter()
+    try:
+        with start_pool(shared.spec, devices, workers, threads) as pool:
+            futures = {pool.submit(run_config, config, settings): i for i, config in enumerate(configs)}
+            for future in as_completed(futures):
+                rows.append((futures[future], future.result()))
+                if settings['out']:
+                    # keep partial results if the sweep is interrupted
+                    results_table(rows).to_csv(settings['out'], index=False)
+    finally:
+        shared.close()
+    print(f"sweep of {len(configs)} runs took {time.perf_counter() - t_start:.1f}s on {workers} workers")
+    return results_table(rows)
+
+
+def results_table(rows):
+    return pd.DataFrame([row for _, row in sorted(rows, key=lambda r: r[0])])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Parallel ablation sweep over the PointNetCls flags')
+    parser.add_argument('--data_dir', required=True, type=str, help='Training count matrix (MultiIndex CSV).')
+    parser.add_argument('--out', default='sweep_results.csv', type=str, help='Results table.')
+    parser.add_argument('--outf', default=None, type=str, help='Folder for the best model of each run (not saved if omitted).')
+    for name in FLAG_NAMES:
+        parser.add_argument(f'--{name}', nargs='+', type=int, default=[0, 1], choices=[0, 1], help=f'Values of {name} to sweep.')
+    parser.add_argument('--gene_space_dim', nargs='+', type=int, default=[3], help='Values of gene_space_dim to sweep.')
+    add_training_args(parser)
+    return parser
+
+
+def add_training_args(parser):
+    # pool and per-run training options, shared with kfold.py
+    parser.add_argument('--devices', nargs='+', default=None, help='Devices to spread the workers over (default: all GPUs, else cpu).')
+    parser.add_argument('--workers', default=None, type=int, help='Parallel runs (default: one per GPU, or cpu_count // threads on CPU).')
+    parser.add_argument('--threads', default=None, type=int, help='Intra-op threads per worker.')
+    parser.add_argument('--num_workers', default=0, type=int, help='DataLoader workers per run.')
+    parser.add_argument('--batch_size', default=60, type=int)
+    parser.add_argument('--max_epoch', default=60, type=int)
+    parser.add_argument('--eval_interval', default=2, type=int)
+    parser.add_argument('--lr', default=0.005, type=float)
+    parser.add_argument('--loss', default='CE', choices=['CE', 'NLL'])
+    parser.add_argument('--no_weight_loss', action='store_true', help='Do not weight the loss by class frequency.')
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--verbose', action='store_true', help='Print train losses and step timings of every run.')
+
+
+def settings_from_args(args):
+    return {
+        "batch_size": args.batch_size,
+        "max_epoch": args.max_epoch,
+        "eval_interval": args.eval_interval,
+        "lr": args.lr,
+        "loss": args.loss,
+        "weight_loss": not args.no_weight_loss,
+        "seed": args.seed,
+        "num_workers": args.num_workers,
+        "log_interval": 50,
+        "verbose": args.verbose,
+        "outf": args.outf,
+        "out": args.out,
+    }
+
+
+def main(args):
+    devices = args.devices or default_devices()
+    args.workers, args.threads = resolve_workers(devices, args.workers, args.threads)
+    if args.outf:
+        os.makedirs(args.outf, exist_ok=True)
+
+    configs = build_grid(args)
+    print(f"{len(configs)} configurations, {args.workers} workers on {devices}, {args.threads} threads each")
+    data = prepare_data(args.data_dir)
+    settings = settings_from_args(args)
+    results = run_sweep(data, configs, settings, devices, args.workers, args.threads)
+    results.to_csv(args.out, index=False)
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(results)
+    return results
+
+
+if __name__ == "__main__":
+    main(build_parser().parse_args())
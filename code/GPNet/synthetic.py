@@ -0,0 +1,88 @@
+#%%
+# Synthetic tumor cohorts in the layout of the training CSVs.
+#
+# Genes are rows, samples are columns under a two-level header (class name,
+# sample id), as read by dataloader.load_data. Counts are negative binomial
+# around log-normal gene means with per-sample library sizes; each class
+# up-regulates its own marker genes, lowly expressed genes drop out more often
+# (so about `sparsity` of all entries are zero), and the class sizes fall off
+# geometrically with `imbalance`.
+#
+#   python synthetic.py --out synthetic.csv --genes 2000 --samples 300 --classes 5
+import argparse
+
+import numpy as np
+import pandas as pd
+
+
+def class_sizes(n_samples, n_classes, imbalance=0.5, min_per_class=10):
+    # p_k ~ exp(-imbalance * k); every class keeps enough samples for the stratified splits
+    weights = np.exp(-imbalance * np.arange(n_classes))
+    sizes = np.maximum(np.floor(weights / weights.sum() * n_samples).astype(int), min_per_class)
+    sizes[0] += max(n_samples - sizes.sum(), 0)
+    return sizes
+
+
+def generate_cohort(n_genes=2000, n_samples=300, n_classes=5, sparsity=0.6, imbalance=0.5,
+                    n_markers=20, fold_change=4.0, dispersion=0.5, nan_fraction=0.0, seed=0):
+    """Returns a (genes x samples) count DataFrame with (class, sample id) column MultiIndex."""
+    rng = np.random.default_rng(seed)
+    sizes = class_sizes(n_samples, n_classes, imbalance)
+    labels = np.repeat(np.arange(n_classes), sizes)
+    n_samples = len(labels)
+
+    gene_mean = rng.lognormal(mean=2.0, sigma=2.0, size=n_genes)
+    library_size = rng.lognormal(mean=0.0, sigma=0.3, size=n_samples)
+    class_effect = np.ones((n_classes, n_genes))
+    for k in range(n_classes):
+        class_effect[k, rng.choice(n_genes, size=min(n_markers, n_genes), replace=False)] = fold_change
+    mu = library_size[:, None] * gene_mean[None, :] * class_effect[labels]
+
+    # gamma-Poisson mixture = negative binomial with the given dispersion
+    lam = rng.gamma(shape=1.0 / dispersion, scale=mu * dispersion)
+    counts = rng.poisson(lam).astype(np.float64)
+
+    # dropout: rarer genes are zero more often, sparsity on average
+    expression_rank = np.argsort(np.argsort(gene_mean)) / max(n_genes - 1, 1)
+    dropout = np.clip(2.0 * sparsity * (1.0 - expression_rank), 0.0, 0.99)
+    counts[rng.random(counts.shape) < dropout[None, :]] = 0
+    if nan_fraction > 0:
+        counts[rng.random(counts.shape) < nan_fraction] = np.nan
+
+    columns = pd.MultiIndex.from_arrays([[f"TUMOR{k}" for k in labels], [f"S{j:05d}" for j in range(n_samples)]])
+    index = [f"ENSG{g:011d}" for g in range(n_genes)]
+    return pd.DataFrame(counts.T, index=index, columns=columns)
+
+
+def write_cohort(path, **kwargs):
+    df = generate_cohort(**kwargs)
+    df.to_csv(path)
+    return df
+
+
+def build_parser(parser=None):
+    # cohort options only, so bench.py can reuse them
+    parser = parser or argparse.ArgumentParser(description='Write a synthetic MultiIndex count CSV')
+    parser.add_argument('--genes', default=2000, type=int)
+    parser.add_argument('--samples', default=300, type=int)
+    parser.add_argument('--classes', default=5, type=int)
+    parser.add_argument('--sparsity', default=0.6, type=float, help='Average fraction of zero counts.')
+    parser.add_argument('--imbalance', default=0.5, type=float, help='Class sizes fall off as exp(-imbalance * k).')
+    parser.add_argument('--markers', default=20, type=int, help='Up-regulated marker genes per class.')
+    parser.add_argument('--nan_fraction', default=0.0, type=float, help='Fraction of missing entries.')
+    parser.add_argument('--seed', default=0, type=int)
+    return parser
+
+
+def cohort_kwargs(args):
+    return dict(n_genes=args.genes, n_samples=args.samples, n_classes=args.classes, sparsity=args.sparsity,
+                imbalance=args.imbalance, n_markers=args.markers, nan_fraction=args.nan_fraction, seed=args.seed)
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    parser.add_argument('--out', default='synthetic.csv', type=str)
+    args = parser.parse_args()
+    df = write_cohort(args.out, **cohort_kwargs(args))
+    print(f"wrote {df.shape[0]} genes x {df.shape[1]} samples to {args.out}, "
+          f"{(df.values == 0).mean():.2f} zeros, class sizes {df.columns.get_level_values(0).value_counts().to_dict()}")
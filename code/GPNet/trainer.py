@@ -0,0 +1,250 @@
+#%%
+# Training engine shared by GPNet and the three baselines.
+#
+# A model family plugs in through three callables:
+#   forward_fn(model, data, device) -> (pred, labels, aux)
+#       moves one loader batch to the device and runs the model; aux is a dict
+#       of whatever the loss or regularizers need (transforms, reconstructions).
+#   criterion(pred, labels, aux) -> loss
+#   regularizers: list of (weight, fn) with fn(aux) -> loss term
+#
+# Every train step is split into data-wait, forward (including the loss),
+# backward and optimizer time, so the four models are timed the same way.
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from metrics import ConfusionMatrixMeter
+from profiling import annotate
+from models import feature_transform_regularizer, snet_regularizer, transpose_input
+
+PHASES = ('data', 'forward', 'backward', 'optimizer')
+
+
+def normalized_class_weights(feature_num):
+    samples_per_class = [feature_num[i] for i in range(len(feature_num))]
+    # Calculate class weights
+    total_samples = sum(samples_per_class)
+    class_weights = [total_samples / samples_per_class[i] for i in range(len(samples_per_class))]
+
+    # Normalize weights so that their sum equals the number of classes
+    weight_sum = sum(class_weights)
+    return torch.tensor([w / weight_sum * len(feature_num) for w in class_weights])
+
+
+def make_criterion(LOSS_SELECT, WEIGHT_LOSS_FLAG, normalized_weights):
+    # built once per run instead of once per batch
+    weight = normalized_weights if WEIGHT_LOSS_FLAG else None
+    if LOSS_SELECT == 'CE':
+        loss_fn = nn.CrossEntropyLoss(weight=weight)
+        return lambda pred, labels, aux: loss_fn(pred, labels)
+    elif LOSS_SELECT == 'NLL':
+        loss_fn = nn.NLLLoss(weight=weight)
+        return lambda pred, labels, aux: loss_fn(F.log_softmax(pred, dim=1), labels)
+    else:
+        raise ValueError("Invalid LOSS_SELECT value.")
+
+
+def pointnet_forward(model, data, device):
+    features1_count, features2_gene_idx, labels = data
+    features1_count, features2_gene_idx = transpose_input(features1_count, features2_gene_idx)
+    features1_count, features2_gene_idx, labels = features1_count.to(device), features2_gene_idx.to(device), labels.to(device)
+    pred, trans, trans_feat, norm_n = model(features1_count, features2_gene_idx)
+    return pred, labels, {"trans": trans, "trans_feat": trans_feat, "norm_n": norm_n}
+
+
+def pointnet_regularizers(feature_transform, snet_flag):
+    regularizers = []
+    if feature_transform:
+        regularizers.append((0.001, lambda aux: feature_transform_regularizer(aux["trans_feat"])))
+    if snet_flag:
+        regularizers.append((0.0001, lambda aux: snet_regularizer(aux["norm_n"])))
+    return regularizers
+
+
+def expression_forward(model, data, device):
+    # SimpleFNN / SparseAutoencoder: flat expression vector in, the gene index is unused
+    features1_count, features2_gene_idx, labels = data
+    features1_count, labels = features1_count.float().to(device), labels.to(device)
+    out = model(features1_count)
+    if isinstance(out, tuple):
+        # SparseAutoencoder returns (encoding, decoding, classification)
+        f_encode, f_decode, pred = out
+        return pred, labels, {"input": features1_count, "encode": f_encode, "decode": f_decode}
+    return out, labels, {}
+
+
+def image_forward(model, data, device):
+    # CustomCNN: heatmap images from dataloader_heatmap
+    features1_count, labels = data
+    features1_count, labels = features1_count.float().to(device), labels.to(device)
+    return model(features1_count), labels, {}
+
+
+def annotated_batches(loader):
+    # marks the time spent waiting for each batch as "data_loading" in profiler traces
+    iterator = iter(loader)
+    while True:
+        with annotate("data_loading"):
+            try:
+                data = next(iterator)
+            except StopIteration:
+                return
+        yield data
+
+
+class StepTimer:
+    def __init__(self, device):
+        # CUDA events avoid a device sync per phase; they are resolved once in summary()
+        self.use_events = device.type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        self.data_wait = []
+        self.marks = []
+        self.batch_sizes = []
+
+    def mark(self):
+        if self.use_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def record(self, data_wait, marks, batch_size):
+        self.data_wait.append(data_wait)
+        self.marks.append(marks)
+        self.batch_sizes.append(batch_size)
+
+    def step_times(self):
+        # (n_steps, 4) seconds per phase
+        if not self.marks:
+            return np.zeros((0, len(PHASES)))
+        if self.use_events:
+            torch.cuda.synchronize()
+            compute = [[a.elapsed_time(b) / 1e3 for a, b in zip(m[:-1], m[1:])] for m in self.marks]
+        else:
+            compute = [[b - a for a, b in zip(m[:-1], m[1:])] for m in self.marks]
+        return np.column_stack([np.array(self.data_wait), np.array(compute)])
+
+    def summary(self):
+        times = self.step_times()
+        total = times.sum()
+        summary = {f"{phase}_ms": float(times[:, j].mean() * 1e3) if len(times) else 0.0 for j, phase in enumerate(PHASES)}
+        summary["steps"] = len(times)
+        summary["step_ms"] = float(times.sum(axis=1).mean() * 1e3) if len(times) else 0.0
+        for q in (50, 90, 99):
+            summary[f"step_ms_p{q}"] = float(np.percentile(times.sum(axis=1), q) * 1e3) if len(times) else 0.0
+        summary["samples_per_s"] = float(sum(self.batch_sizes) / total) if total > 0 else 0.0
+        return summary
+
+
+class Trainer:
+    def __init__(self, model, optimizer, criterion, device, class_num, forward_fn,
+                 regularizers=(), log_interval=50, is_main_process=True, metrics_logger=None):
+        self.model = model
+        self.optimizer = optimizer
+        self.criterion = criterion
+        self.device = device
+        self.forward_fn = forward_fn
+        self.regularizers = list(regularizers)
+        self.log_interval = log_interval
+        self.is_main_process = is_main_process
+        # when set (metrics_logger.MetricsLogger), per-step losses go to it instead of being printed
+        self.metrics_logger = metrics_logger
+        self.train_meter = ConfusionMatrixMeter(class_num, device)
+        self.eval_meter = ConfusionMatrixMeter(class_num, device)
+        self.timer = StepTimer(device)
+        # optional torch.profiler.profile (see profiling.make_profiler), stepped after every train and eval batch
+        self.profiler = None
+
+    def compute_loss(self, pred, labels, aux):
+        with annotate("loss"):
+            loss = self.criterion(pred, labels, aux)
+            for weight, regularizer in self.regularizers:
+                loss = loss + regularizer(aux) * weight
+        return loss
+
+    def profiler_step(self):
+        if self.profiler is not None:
+            self.profiler.step()
+
+    def train_epoch(self, loader, epoch, first_step=0, step_callback=None):
+        """Runs one epoch and returns the train confusion matrix (reduced across ranks).
+
+        Args:
+            first_step: Index of the first batch, when resuming inside an epoch.
+            step_callback: Called as step_callback(i) after every optimizer step.
+        """
+        self.model.train()
+        self.timer.reset()
+        if self.metrics_logger is not None:
+            self.metrics_logger.mark()
+        if first_step == 0:
+            self.train_meter.reset()
+        t_data = time.perf_counter()
+        # a resumed loader only yields the remaining batches of the epoch
+        steps_per_epoch = len(loader) + first_step
+        for i, data in enumerate(annotated_batches(loader), first_step):
+            data_wait = time.perf_counter() - t_data
+            m_start = self.timer.mark()
+            self.optimizer.zero_grad()
+            pred, labels, aux = self.forward_fn(self.model, data, self.device)
+            loss = self.compute_loss(pred, labels, aux)
+            m_forward = self.timer.mark()
+            with annotate("backward"):
+                loss.backward()
+            m_backward = self.timer.mark()
+            with annotate("optimizer"):
+                self.optimizer.step()
+            m_optimizer = self.timer.mark()
+            self.timer.record(data_wait, (m_start, m_forward, m_backward, m_optimizer), labels.shape[0])
+            self.train_meter.update(torch.argmax(pred.detach(), dim=1), labels)
+            if self.metrics_logger is not None:
+                self.metrics_logger.log_step(epoch * steps_per_epoch + i, epoch=epoch, batch_size=labels.shape[0], loss=loss.detach())
+            elif i % self.log_interval == 0 and self.is_main_process:
+                print(f"[{epoch}: {i}/{len(loader)}] train loss: {loss.item()}")
+            if step_callback is not None:
+                step_callback(i)
+            self.profiler_step()
+            t_data = time.perf_counter()
+        if self.metrics_logger is not None:
+            self.metrics_logger.flush()
+        self.train_meter.all_reduce()
+        return self.train_meter.compute()
+
+    def evaluate(self, loader, model=None, all_reduce=False):
+        """Returns the confusion matrix over `loader`.
+
+        Args:
+            model: Model to run, e.g. the module inside DDP when the loader is sharded.
+            all_reduce: Sum the matrix over ranks, for loaders with a DistributedEvalSampler.
+        """
+        model = self.model if model is None else model
+        model.eval()
+        self.eval_meter.reset()
+        with torch.no_grad():
+            for data in annotated_batches(loader):
+                pred, labels, aux = self.forward_fn(model, data, self.device)
+                self.eval_meter.update(torch.argmax(pred, dim=1), labels)
+                self.profiler_step()
+        if all_reduce:
+            # the one collective of the evaluation; every rank gets the same matrix
+            self.eval_meter.all_reduce()
+        return self.eval_meter.compute()
+
+    def timing_summary(self):
+        return self.timer.summary()
+
+    def print_timing(self, epoch):
+        if not self.is_main_process:
+            return
+        t = self.timer.summary()
+        if self.metrics_logger is not None:
+            self.metrics_logger.log_event("train_epoch_timing", step=epoch, **t)
+            return
+        print(f"[{epoch}] step {t['step_ms']:.1f}ms (data {t['data_ms']:.1f} forward {t['forward_ms']:.1f} "
+              f"backward {t['backward_ms']:.1f} optimizer {t['optimizer_ms']:.1f}) {t['samples_per_s']:.1f} samples/s")
@@ -1,5 +1,4 @@
 #%%
-import pandas as pd
 import numpy as np
 from collections import Counter
 
@@ -10,6 +9,7 @@ from collections import Counter
 # minimum_expressed_samples=40
 
 def find_expressed_genes(file_path, reads_cutoff=100, minimum_expressed_samples=40):
+    import pandas as pd
     data_dir = file_path
     df = pd.read_csv(data_dir, header=[0, 1], index_col=0)
     df.columns = pd.MultiIndex.from_tuples(df.columns)
@@ -19,3 +19,36 @@ def find_expressed_genes(file_path, reads_cutoff=100, minimum_expressed_samples=
 
 
 # %%
+from collections import OrderedDict
+
+def strip_ddp_prefix(state_dict):
+    # checkpoints saved from a DDP-wrapped model carry a `module.` prefix
+    new_state_dict = OrderedDict()
+    for k, v in state_dict.items():
+        name = k[7:] if k.startswith('module.') else k
+        new_state_dict[name] = v
+    return new_state_dict
+
+
+# %%
+import resource
+import torch
+
+def tensor_bytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors if torch.is_tensor(t))
+
+def memory_per_rank(model, optimizer):
+    """Bytes held by this process for parameters, gradients and optimizer state, in MB.
+
+    With a ZeroRedundancyOptimizer only the local shard of the state is counted,
+    which is what this rank actually keeps in memory.
+    """
+    local_optimizer = getattr(optimizer, 'optim', optimizer)  # the wrapped optimizer of a ZeroRedundancyOptimizer
+    state = [v for s in local_optimizer.state.values() for v in s.values()]
+    return {
+        "params_mb": tensor_bytes(model.parameters()) / 2**20,
+        "grads_mb": tensor_bytes(p.grad for p in model.parameters() if p.grad is not None) / 2**20,
+        "optimizer_state_mb": tensor_bytes(state) / 2**20,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
@@ -11,6 +11,12 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 import os
 import argparse
 from torch.distributed import all_reduce, ReduceOp
+import sys
+# the shared training utilities live next to the GPNet code
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'GPNet'))
+from metrics import compute_metrics
+from trainer import Trainer, normalized_class_weights, expression_forward
+from metrics_logger import MetricsLogger
 import numpy as np
 # def parse_args():
 #     parser = argparse.ArgumentParser(description='Model Training')
@@ -91,6 +97,8 @@ def main():
     WEIGHT_LOSS_FLAG = False
     MULTI_GPU_FLAG = False
     pre_trained = False
+    log_interval = 50 # steps between printed train losses
+    metrics_log = f"{outf}/metrics.jsonl" # structured train/val log, flushed every log_interval steps
     lr=0.01
 
     if MULTI_GPU_FLAG:
@@ -112,14 +120,7 @@ def main():
 
     class_num = len(number_to_label.keys())
     print("class_num:", class_num)
-    samples_per_class = [feature_num[i] for i in range(len(feature_num))]
-    # Calculate class weights
-    total_samples = sum(samples_per_class)
-    class_weights = [total_samples / samples_per_class[i] for i in range(len(samples_per_class))]
-
-    # Normalize weights so that their sum equals the number of classes
-    weight_sum = sum(class_weights)
-    normalized_weights = torch.tensor([w / weight_sum * len(feature_num) for w in class_weights])
+    normalized_weights = normalized_class_weights(feature_num)
     print("Normalized Class Weights:", normalized_weights)
     #%%
     
@@ -132,84 +133,29 @@ def main():
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
         model = DDP(model, device_ids=[local_rank], output_device=local_rank)
 
-    def get_loss_criterion(LOSS_SELECT, WEIGHT_LOSS_FLAG, normalized_weights):
-        if LOSS_SELECT == 'CE':
-            if WEIGHT_LOSS_FLAG:
-                criterion = nn.CrossEntropyLoss(weight=normalized_weights)
-            else:
-                criterion = nn.CrossEntropyLoss()
-        elif LOSS_SELECT == 'NLL':
-            if WEIGHT_LOSS_FLAG:
-                criterion = nn.NLLLoss(weight=normalized_weights)
-            else:
-                criterion = nn.NLLLoss()
-        else:
-            raise ValueError("Invalid LOSS_SELECT value.")
-        return criterion
     #%% train
     best_acc = 0
+    normalized_weights = normalized_weights.to(device)
+    # reconstruction + classification loss from model.py, the weighted terms are off as before
+    criterion = lambda pred, labels, aux: sparse_autoencoder_loss(model, aux["decode"], pred, labels, aux["input"], 0.7, 1, 0, 0, normalized_weights)[0]
+    metrics_logger = MetricsLogger(metrics_log, flush_interval=log_interval,
+                                   enabled=not MULTI_GPU_FLAG or torch.distributed.get_rank() == 0)
+    trainer = Trainer(model, optimizer, criterion, device, class_num,
+                      forward_fn = expression_forward,
+                      log_interval = log_interval,
+                      is_main_process = not MULTI_GPU_FLAG or torch.distributed.get_rank() == 0,
+                      metrics_logger = metrics_logger)
     for epoch in range(max_epoch):
         scheduler.step()
-        confusion_matrix_all = np.zeros((class_num, class_num))
-        for i , data in enumerate(train_loader, 0):
-            features1_count, features2_gene_idx, labels = data
-            features1_count, features2_gene_idx, labels = features1_count.float().to(device), features2_gene_idx.float().to(device), labels.to(device)
-            optimizer.zero_grad()
-            model = model.train()
-            f_encode, f_decode , pred = model(features1_count)
-            normalized_weights = normalized_weights.to(device)
-            loss, mse_loss, sparsity_loss, ce_loss = sparse_autoencoder_loss(model, f_decode, pred, labels, features1_count, 0.7, 1, 0, 0, normalized_weights)
-            # criterion = get_loss_criterion(LOSS_SELECT, WEIGHT_LOSS_FLAG, normalized_weights)
-            # if LOSS_SELECT == 'NLL':
-            #     pred = F.log_softmax(pred, dim=1)
-            # loss = criterion(pred, labels)
-            # loss = F.nll_loss(F.log_softmax(pred, dim=1), labels)
-
-            loss.backward()
-            optimizer.step()
-            pred_labels = torch.argmax(pred, dim=1)
-            correct = torch.sum(pred_labels == labels)/float(batch_size)
-            if MULTI_GPU_FLAG:
-                if torch.distributed.get_rank() == 0:
-                    print(f"[{epoch}: {i}/({len(train_loader)})] train loss: {loss.item()} accuracy: {correct.item()}")
-            else:
-                print(f"[{epoch}: {i}/{len(train_loader)}] train loss: {loss.item()} accuracy: {correct.item()}")
-            pred_labels_np = pred_labels.cpu().numpy()
-            labels_np = labels.cpu().numpy()
-            for idx_batch in range(labels_np.shape[0]):
-                label_i = labels_np[idx_batch]
-                pred_i = pred_labels_np[idx_batch]
-                confusion_matrix_all[label_i,pred_i] += 1
+        confusion_matrix_all = trainer.train_epoch(train_loader, epoch)
+        trainer.print_timing(epoch)
+        print(f"[{epoch}] train accuracy: {trainer.train_meter.accuracy(confusion_matrix_all)}")
         print(confusion_matrix_all)
         
         if epoch % eval_interval == 0:
-            confusion_matrix_all = np.zeros((class_num, class_num))
-            correct_all = 0
-            total_valset = 0
-            for i, data in enumerate(val_loader, 0):
-                features1_count, features2_gene_idx, labels = data
-                features1_count, features2_gene_idx, labels = features1_count.float().to(device), features2_gene_idx.float().to(device), labels.to(device)
-                model = model.eval()
-                f_encode, f_decode , pred = model(features1_count)
-                pred_labels = pred.data.max(1)[1]
-                correct = torch.sum(pred_labels == labels)
-                correct_all += correct.item()
-                total_valset += features1_count.shape[0]
-                # print("debug_total_valset{}_correct_all{}".format(total_valset, correct_all))
-                print(f"[{epoch}: {i}/{len(val_loader)}] val accuracy: {correct.item()/float(batch_size)}")
-                pred_labels_np = pred_labels.cpu().numpy()
-                labels_np = labels.cpu().numpy()
-                for idx_batch in range(labels_np.shape[0]):
-                    label_i = labels_np[idx_batch]
-                    pred_i = pred_labels_np[idx_batch]
-                    confusion_matrix_all[label_i,pred_i] += 1
-            # if MULTI_GPU_FLAG:
-            #     all_reduce(correct_all, op=ReduceOp.SUM)
-            #     correct_all = correct_all.cpu().numpy()/len(val_loader)
-            
-            # else:
-            #     correct_all = correct_all.cpu().numpy()/len(val_loader)
-            correct_all = correct_all/float(total_valset)
+            confusion_matrix_all = trainer.evaluate(val_loader)
+            correct_all = trainer.eval_meter.accuracy(confusion_matrix_all)
+            metrics_logger.log_event("val", step=epoch, accuracy=correct_all)
             print("final accuracy {}".format(correct_all))
             print("best accuracy {}".format(best_acc))
             
@@ -250,62 +196,13 @@ def main():
             # print("so far best model test accuracy {}".format(test_acc))
         torch.save(model.state_dict(), f"{outf}/cls_model_geneSpaceD_{gene_space_dim}_transfeat_{feature_transform}_attenpool_{atention_pooling_flag}_{epoch}.pth")
 
-    total_correct = 0
-    total_testset = 0
-    confusion_matrix_all_test = np.zeros((class_num, class_num))
-    for i,data in enumerate(test_loader, 0):
-        features1_count, features2_gene_idx, labels = data
-        features1_count, features2_gene_idx, labels = features1_count.float().to(device), features2_gene_idx.float().to(device), labels.to(device)
-        model = model.eval()
-        f_encode, f_decode , pred = model(features1_count)
-        pred_choice = pred.data.max(1)[1]
-        correct = torch.sum(pred_choice == labels)
-        total_correct += correct.item()
-        total_testset += features1_count.size()[0]
-
-        pred_labels_np = pred_choice.cpu().numpy()
-        labels_np = labels.cpu().numpy()
-        for idx_batch in range(labels_np.shape[0]):
-            label_i = labels_np[idx_batch]
-            pred_i = pred_labels_np[idx_batch]
-            confusion_matrix_all_test[label_i,pred_i] += 1
+    confusion_matrix_all_test = trainer.evaluate(test_loader)
+    metrics_logger.log_event("test", accuracy=trainer.eval_meter.accuracy(confusion_matrix_all_test))
+    metrics_logger.close()
 
-    print("final accuracy {}".format(total_correct / float(total_testset)))
+    print("final accuracy {}".format(trainer.eval_meter.accuracy(confusion_matrix_all_test)))
     print(confusion_matrix_all_test)
     
-    def compute_metrics(cm):
-        # Initialize variables
-        TP = np.diag(cm)
-        FP = np.sum(cm, axis=0) - TP
-        FN = np.sum(cm, axis=1) - TP
-        TN = np.sum(cm) - (FP + FN + TP)
-
-        # Precision, Recall and F1 Score for each class
-        precision = TP / (TP + FP+1e-6)
-        recall = TP / (TP + FN+1e-6)
-        f1_score = 2 * (precision * recall) / (precision + recall+1e-6)
-
-        # Micro averaging (considering all classes together)
-        micro_precision = np.sum(TP) / (np.sum(TP) + np.sum(FP)+1e-6)
-        micro_recall = np.sum(TP) / (np.sum(TP) + np.sum(FN)+1e-6)
-        micro_f1_score = 2 * (micro_precision * micro_recall) / (micro_precision + micro_recall+1e-6)
-
-        # Macro averaging (taking the average across classes)
-        macro_precision = np.mean(precision)
-        macro_recall = np.mean(recall)
-        macro_f1_score = np.mean(f1_score)
-
-        return {
-            "Micro Precision": micro_precision,
-            "Micro Recall": micro_recall,
-            "Micro F1 Score": micro_f1_score,
-            "Macro Precision": macro_precision,
-            "Macro Recall": macro_recall,
-            "Macro F1 Score": macro_f1_score,
-            "Per Class Precision": precision.tolist(),
-            "Per Class Recall": recall.tolist(),
-            "Per Class F1 Score": f1_score.tolist()
-        }
     metrics = compute_metrics(confusion_matrix_all_test)
     # Print the metrics
     for k, v in metrics.items():